@@ -1,24 +1,137 @@
 import os
+import secrets
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .cache import TTLCache, make_cache
 
 
 db = SQLAlchemy()
 migrate = Migrate()
 
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores ``ON DELETE CASCADE`` unless enforcement is switched on
+    for every connection."""
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
 class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Resolved API keys are cached per worker. Revocations and role changes
+    # made through the API drop the local entry and leave a per-user marker
+    # in the RESPONSE_CACHE_URL store that other workers check on each hit;
+    # without a shared store (or for changes made outside the API) they are
+    # picked up once the TTL expires.
+    API_KEY_CACHE_SIZE = int(os.getenv('API_KEY_CACHE_SIZE', 10000))
+    API_KEY_CACHE_TTL = int(os.getenv('API_KEY_CACHE_TTL', 60))
+    # Keys expire after this many days (0 disables expiry); expired keys are
+    # removed by ``flask api-keys prune``. last_used_at is written at most
+    # once per API_KEY_TOUCH_INTERVAL seconds per key.
+    API_KEY_TTL_DAYS = int(os.getenv('API_KEY_TTL_DAYS', 30))
+    API_KEY_TOUCH_INTERVAL = int(os.getenv('API_KEY_TOUCH_INTERVAL', 300))
+    # Lets the sign-in webhook hand out the same token again while it is
+    # valid. When unset, a random key is generated once and kept in the
+    # instance folder so every worker and restart shares it.
+    SECRET_KEY = os.getenv('SECRET_KEY')
+    # KPI and list responses are cached per pipeline version. Leave the URL
+    # unset for an in-process LRU, or point it at Redis so gunicorn workers
+    # share one cache.
+    RESPONSE_CACHE_URL = os.getenv('RESPONSE_CACHE_URL')
+    RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 2048))
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+    # Days of board changes kept for ``/pipelines/<id>/changes`` before
+    # ``flask changes compact`` removes them.
+    CHANGE_LOG_RETENTION_DAYS = int(os.getenv('CHANGE_LOG_RETENTION_DAYS', 7))
+    # Live board events: how often each worker polls the change log for
+    # writes made by other workers, and the keep-alive interval of idle
+    # streams, both in seconds.
+    EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', 1.0))
+    EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', 15))
+    # Pipelines and stages soft deleted with ``Prefer: respond-async`` are
+    # hidden at once and purged afterwards PURGE_BATCH_SIZE rows per
+    # transaction, on a background thread that also sweeps every
+    # PURGE_INTERVAL seconds, unless PURGE_IN_BACKGROUND is off (then
+    # schedule ``flask purge run``).
+    PURGE_BATCH_SIZE = int(os.getenv('PURGE_BATCH_SIZE', 1000))
+    PURGE_INTERVAL = float(os.getenv('PURGE_INTERVAL', 300))
+    PURGE_IN_BACKGROUND = os.getenv('PURGE_IN_BACKGROUND', '1') not in ('0', 'false', 'no')
+
+
+def load_secret_key(app):
+    """Fall back to a random ``SECRET_KEY`` persisted in the instance folder.
+
+    The first process to start writes it; the others, and later restarts,
+    read the same file.  Linking a fully written temporary file into place
+    keeps a concurrent reader from seeing it half written.
+    """
+    if app.config.get('SECRET_KEY'):
+        return
+    path = os.path.join(app.instance_path, 'secret_key')
+    if not os.path.exists(path):
+        os.makedirs(app.instance_path, exist_ok=True)
+        temp = f'{path}.{os.getpid()}'
+        with open(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(temp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp)
+    with open(path) as f:
+        app.config['SECRET_KEY'] = f.read().strip()
 
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    load_secret_key(app)
 
     db.init_app(app)
     migrate.init_app(app, db)
 
+    app.extensions['api_key_cache'] = TTLCache(
+        maxsize=app.config.get('API_KEY_CACHE_SIZE', 10000),
+        ttl=app.config.get('API_KEY_CACHE_TTL', 60),
+    )
+    app.extensions['api_key_revocations'] = make_cache(
+        app.config.get('RESPONSE_CACHE_URL'),
+        maxsize=app.config.get('API_KEY_CACHE_SIZE', 10000),
+        ttl=app.config.get('API_KEY_CACHE_TTL', 60),
+        prefix='kanban:auth:',
+    )
+    app.extensions['response_cache'] = make_cache(
+        app.config.get('RESPONSE_CACHE_URL'),
+        maxsize=app.config.get('RESPONSE_CACHE_SIZE', 2048),
+        ttl=app.config.get('RESPONSE_CACHE_TTL', 300),
+    )
+
+    from .events import EventBus
+    app.extensions['event_bus'] = EventBus(app, poll_interval=app.config.get('EVENTS_POLL_INTERVAL', 1.0),
+                                           background=app.config.get('EVENTS_IN_BACKGROUND', True))
+
+    from .pipelines.purge import PurgeWorker
+    purge_worker = app.extensions['purge_worker'] = PurgeWorker(
+        app,
+        batch_size=app.config.get('PURGE_BATCH_SIZE', 1000),
+        enabled=app.config.get('PURGE_IN_BACKGROUND', True),
+        interval=app.config.get('PURGE_INTERVAL', 300),
+    )
+    # Started by the first request rather than here, so CLI commands such
+    # as ``flask db upgrade`` never run it.
+    app.before_request(purge_worker.start)
+
+    from .api_keys import record_api_key_use
+    app.teardown_request(record_api_key_use)
+
     # Import models so they are registered with SQLAlchemy before migrations
     from . import models  # noqa: F401
 
@@ -34,4 +147,7 @@ def create_app(config_class=Config):
     from .admin import admin_bp
     app.register_blueprint(admin_bp)
 
+    from .commands import register_commands
+    register_commands(app)
+
     return app
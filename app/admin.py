@@ -1,23 +1,57 @@
-from flask import Blueprint, request, jsonify, g
+import json
+
+from flask import Blueprint, request, jsonify, g, current_app, stream_with_context
 
 from . import db
 from .models import User
-from .pipelines import super_admin_required
+from .pipelines import super_admin_required, api_key_cache, invalidate_user_keys, response_cache
+from .pipelines.imports import iter_lines, iter_records
+from .pipelines.listing import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_cursor, encode_cursor
+from .provisioning import sync_users
 
 admin_bp = Blueprint('admin', __name__)
 
 
+USER_EXPORT_BATCH_SIZE = 1000
+
+
+def _user_rows(query):
+    return ({'user_id': user_id, 'role': role, 'account_id': account_id}
+            for user_id, role, account_id in db.session.execute(query))
+
+
 @admin_bp.route('/admin/users', methods=['GET'])
 @super_admin_required
 def list_users():
-    users = User.query.all()
-    return jsonify([
-        {
-            'user_id': u.user_id,
-            'role': u.role,
-            'account_id': u.account_id,
-        } for u in users
-    ])
+    """Users ordered by id, optionally filtered by ``account_id`` and ``role``.
+
+    Pages of ``limit`` rows (default 100) continue from the ``cursor``
+    returned in ``X-Next-Cursor``. ``?format=ndjson`` streams every
+    matching user instead.
+    """
+    query = db.select(User.user_id, User.role, User.account_id).order_by(User.user_id)
+    try:
+        if request.args.get('account_id'):
+            query = query.where(User.account_id == int(request.args['account_id']))
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        if request.args.get('cursor'):
+            query = query.where(User.user_id > decode_cursor(request.args['cursor'], size=1)[0])
+    except ValueError:
+        return jsonify({'error': 'Invalid account_id, limit or cursor'}), 400
+    if request.args.get('role'):
+        query = query.where(User.role == request.args['role'])
+
+    if request.args.get('format') == 'ndjson':
+        rows = _user_rows(query.execution_options(yield_per=USER_EXPORT_BATCH_SIZE))
+        body = stream_with_context(json.dumps(row) + '\n' for row in rows)
+        return current_app.response_class(body, mimetype='application/x-ndjson')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+    users = list(_user_rows(query.limit(limit + 1)))
+    response = jsonify(users[:limit])
+    if len(users) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor([users[limit - 1]['user_id']])
+    return response
 
 
 @admin_bp.route('/admin/users/<int:user_id>/role', methods=['PUT'])
@@ -30,4 +64,33 @@ def update_user_role(user_id):
     user = User.query.get_or_404(user_id)
     user.role = role
     db.session.commit()
+    invalidate_user_keys(user.user_id)
     return jsonify({'user_id': user.user_id, 'role': user.role, 'account_id': user.account_id})
+
+
+@admin_bp.route('/admin/users/sync', methods=['POST'])
+@super_admin_required
+def sync_users_endpoint():
+    """Create or update many users from a JSON list or a streamed NDJSON body.
+
+    Each record has ``account_id``, ``user_id``, ``email``, ``name`` and an
+    optional ``role``; missing accounts are created.
+    """
+    if request.mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            return jsonify({'error': 'Body must be a JSON list of users'}), 400
+        records = enumerate(data, start=1)
+    else:
+        records = iter_records(iter_lines(request.stream), 'ndjson')
+    result = sync_users(records)
+    db.session.commit()
+    for user_id in result.changed_principals:
+        invalidate_user_keys(user_id)
+    return jsonify(result.summary())
+
+
+@admin_bp.route('/admin/cache-stats', methods=['GET'])
+@super_admin_required
+def cache_stats():
+    return jsonify({'api_keys': api_key_cache().stats(), 'responses': response_cache().stats()})
@@ -0,0 +1,113 @@
+"""API key issuing, lookup and pruning.
+
+Only a SHA-256 digest of each token is stored, so lookups compare a
+fixed-length value and a leaked table does not leak usable tokens.  Keys
+expire after ``API_KEY_TTL_DAYS`` and are removed by ``flask api-keys
+prune``.
+
+Keys minted by the sign-in webhook are derived from ``SECRET_KEY`` and a
+per-key nonce, which lets repeated sign-ins get the same still-valid token
+back instead of adding a row each time.  ``create_app`` makes sure a
+``SECRET_KEY`` is always set.
+"""
+import hashlib
+import hmac
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from flask import current_app, g
+
+from . import db
+from .models import ApiKey
+
+# Characters of the token kept in clear so admins can tell keys apart.
+KEY_PREFIX_LENGTH = 8
+PRUNE_BATCH_SIZE = 1000
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _derive_token(secret, user_id, nonce):
+    message = f'{user_id}:{nonce}'.encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def default_expiry(now=None):
+    days = current_app.config.get('API_KEY_TTL_DAYS', 30)
+    if not days:
+        return None
+    return (now or datetime.utcnow()) + timedelta(days=days)
+
+
+def issue_api_key(user_id, scopes='', expires_at=None, token=None, nonce=None):
+    """Add a key for ``user_id`` to the session and return ``(token, api_key)``."""
+    token = token or uuid4().hex
+    api_key = ApiKey(key_hash=hash_token(token), key_prefix=token[:KEY_PREFIX_LENGTH], user_id=user_id,
+                     scopes=scopes, expires_at=expires_at, nonce=nonce)
+    db.session.add(api_key)
+    return token, api_key
+
+
+def webhook_token(user_id):
+    """Token for a sign-in, reusing the user's webhook key while it is fresh.
+
+    A key is reused while at least half of its lifetime is left, so clients
+    never receive a token that is about to expire.
+    """
+    secret = current_app.config['SECRET_KEY']
+    now = datetime.utcnow()
+    days = current_app.config.get('API_KEY_TTL_DAYS', 30)
+    fresh = ApiKey.expires_at.is_(None) if not days else ApiKey.expires_at > now + timedelta(days=days) / 2
+    candidates = (db.session.query(ApiKey.key_hash, ApiKey.nonce)
+                  .filter(ApiKey.user_id == user_id, ApiKey.nonce.isnot(None), fresh)
+                  .order_by(ApiKey.id.desc())
+                  .limit(5))
+    for key_hash, nonce in candidates:
+        token = _derive_token(secret, user_id, nonce)
+        # A rotated SECRET_KEY derives a different token; skip those keys.
+        if hmac.compare_digest(hash_token(token), key_hash):
+            return token
+    nonce = uuid4().hex
+    token = _derive_token(secret, user_id, nonce)
+    issue_api_key(user_id, expires_at=default_expiry(now), token=token, nonce=nonce)
+    return token
+
+
+def touch_api_key(key_id, last_used_at):
+    """Mark the key used by this request, at most once per ``API_KEY_TOUCH_INTERVAL`` seconds.
+
+    The write happens in ``record_api_key_use`` once the request is over.
+    """
+    interval = timedelta(seconds=current_app.config.get('API_KEY_TOUCH_INTERVAL', 300))
+    if last_used_at is not None and datetime.utcnow() - last_used_at < interval:
+        return
+    g.api_key_used = key_id
+
+
+def record_api_key_use(exc=None):
+    """``teardown_request`` hook writing ``last_used_at`` on its own connection,
+    so authentication never commits or rolls back the view's session."""
+    key_id = g.pop('api_key_used', None)
+    if key_id is None:
+        return
+    with db.engine.begin() as conn:
+        conn.execute(ApiKey.__table__.update()
+                     .where(ApiKey.id == key_id)
+                     .values(last_used_at=datetime.utcnow()))
+
+
+def prune_expired_keys(batch_size=PRUNE_BATCH_SIZE):
+    """Delete expired keys ``batch_size`` rows per transaction; return the count."""
+    table = ApiKey.__table__
+    deleted = 0
+    while True:
+        expired = (db.select(table.c.id)
+                   .where(table.c.expires_at < datetime.utcnow())
+                   .limit(batch_size))
+        count = db.session.execute(table.delete().where(table.c.id.in_(expired))).rowcount
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
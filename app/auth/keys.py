@@ -1,10 +1,12 @@
+from datetime import datetime, timedelta
+
 from flask import request, jsonify, g
-from uuid import uuid4
 
 from .. import db
+from ..api_keys import default_expiry, issue_api_key
 from ..models import ApiKey, User
 from . import auth_bp
-from ..pipelines import login_required, super_admin_required
+from ..pipelines import login_required, super_admin_required, invalidate_user_keys
 
 
 @auth_bp.route('/api-keys', methods=['POST'])
@@ -22,11 +24,19 @@ def create_api_key():
             return jsonify({'error': 'Forbidden'}), 403
         target_user = User.query.get_or_404(target_user_id)
 
-    token = uuid4().hex
-    api_key = ApiKey(key=token, user=target_user, scopes=','.join(scopes))
-    db.session.add(api_key)
+    expires_in_days = data.get('expires_in_days')
+    if expires_in_days is None:
+        expires_at = default_expiry()
+    elif isinstance(expires_in_days, int) and expires_in_days >= 0:
+        # 0 issues a key that never expires.
+        expires_at = datetime.utcnow() + timedelta(days=expires_in_days) if expires_in_days else None
+    else:
+        return jsonify({'error': 'expires_in_days must be a non-negative integer'}), 400
+
+    token, api_key = issue_api_key(target_user.user_id, ','.join(scopes), expires_at)
     db.session.commit()
-    return jsonify({'token': token, 'user_id': target_user.user_id, 'scopes': scopes}), 201
+    return jsonify({'token': token, 'user_id': target_user.user_id, 'scopes': scopes,
+                    'expires_at': expires_at.isoformat() if expires_at else None}), 201
 
 
 @auth_bp.route('/api-keys/<int:key_id>', methods=['DELETE'])
@@ -38,4 +48,5 @@ def revoke_api_key(key_id):
         return jsonify({'error': 'Forbidden'}), 403
     db.session.delete(api_key)
     db.session.commit()
+    invalidate_user_keys(api_key.user_id)
     return '', 204
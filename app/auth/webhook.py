@@ -1,11 +1,32 @@
 from flask import request, jsonify
-from uuid import uuid4
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 
 from .. import db
-from ..models import Account, User, ApiKey
+from ..api_keys import webhook_token
+from ..models import Account, User
 from . import auth_bp
 
 
+def insert_ignore(table, **values):
+    """Insert a row unless it violates a unique constraint.
+
+    Uses ``INSERT ... ON CONFLICT DO NOTHING`` where the dialect has it and
+    a savepoint that swallows the ``IntegrityError`` elsewhere.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        db.session.execute(postgresql.insert(table).values(**values).on_conflict_do_nothing())
+    elif dialect == 'sqlite':
+        db.session.execute(sqlite.insert(table).values(**values).on_conflict_do_nothing())
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(**values))
+        except IntegrityError:
+            pass
+
+
 @auth_bp.route('/auth/webhook', methods=['GET'])
 def auth_webhook():
     # When Chatwoot triggers this webhook it now sends the data as query
@@ -16,33 +37,31 @@ def auth_webhook():
     if missing:
         return jsonify({'error': f'Missing fields: {", ".join(missing)}'}), 400
 
-    account_id = data['account_id']
-    user_id = data['user_id']
+    try:
+        account_id = int(data['account_id'])
+        user_id = int(data['user_id'])
+    except ValueError:
+        return jsonify({'error': 'account_id and user_id must be integers'}), 400
     user_email = data['user_email']
     user_name = data['user_name']
 
-    # Get or create account
-    account = Account.query.get(account_id)
-    if account is None:
-        account = Account(id=account_id, name=f'Account {account_id}')
-        db.session.add(account)
-
-    # Validate user
-    user = User.query.get(user_id)
-    if user:
-        if (user.user_email != user_email or
-                user.user_name != user_name or
-                user.account_id != account_id):
-            return jsonify({'error': 'user_id conflict with existing user'}), 400
-    else:
-        user = User(user_id=user_id, user_email=user_email,
-                    user_name=user_name, account=account)
-        db.session.add(user)
-
-    # Generate token
-    token = uuid4().hex
-    api_key = ApiKey(key=token, user=user)
-    db.session.add(api_key)
+    # Provision the account and user without a read-then-insert race:
+    # concurrent sign-ins of the same agent insert-or-skip, then validate
+    # whatever row won.
+    insert_ignore(Account.__table__, id=account_id, name=f'Account {account_id}')
+    insert_ignore(User.__table__, user_id=user_id, user_email=user_email,
+                  user_name=user_name, account_id=account_id)
+    user = (db.session.query(User.user_email, User.user_name, User.account_id)
+            .filter(User.user_id == user_id)
+            .first())
+    if user is None:
+        db.session.rollback()
+        return jsonify({'error': 'user_email already belongs to another user'}), 400
+    if tuple(user) != (user_email, user_name, account_id):
+        db.session.rollback()
+        return jsonify({'error': 'user_id conflict with existing user'}), 400
+
+    token = webhook_token(user_id)
     db.session.commit()
 
     return jsonify({'token': token})
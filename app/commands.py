@@ -0,0 +1,123 @@
+import click
+from flask.cli import AppGroup
+
+kpis_cli = AppGroup('kpis', help='Maintain the KPI rollup tables.')
+
+
+@kpis_cli.command('rebuild')
+@click.option('--check-only', is_flag=True, help='Only report drift, do not rebuild.')
+def rebuild_kpis(check_only):
+    """Recompute KPI rollups from raw negotiations and verify them."""
+    from .pipelines.rollups import rebuild_rollups, verify_rollups
+
+    drift = verify_rollups()
+    click.echo(f'{len(drift)} rollup bucket(s) out of sync')
+    for bucket, expected, actual in drift[:20]:
+        click.echo(f'  {bucket}: expected {expected}, found {actual}')
+    if check_only:
+        if drift:
+            raise SystemExit(1)
+        return
+    rebuild_rollups()
+    drift = verify_rollups()
+    if drift:
+        raise click.ClickException(f'{len(drift)} bucket(s) still differ after rebuild')
+    click.echo('Rollups rebuilt and verified')
+
+
+stages_cli = AppGroup('stages', help='Maintain the per-stage counters.')
+
+
+@stages_cli.command('reconcile')
+@click.option('--check-only', is_flag=True, help='Only report drift, do not fix it.')
+def reconcile_stages(check_only):
+    """Compare stage counters with raw negotiations and fix drifted stages."""
+    from .pipelines.counters import reconcile_counters, verify_counters
+
+    drift = verify_counters()
+    click.echo(f'{len(drift)} stage(s) out of sync')
+    for stage_id, expected, actual in drift[:20]:
+        click.echo(f'  stage {stage_id}: expected {expected}, found {actual}')
+    if check_only:
+        if drift:
+            raise SystemExit(1)
+        return
+    reconcile_counters([stage_id for stage_id, _, _ in drift])
+    drift = verify_counters()
+    if drift:
+        raise click.ClickException(f'{len(drift)} stage(s) still differ after reconciling')
+    click.echo('Stage counters reconciled')
+
+
+positions_cli = AppGroup('positions', help='Maintain negotiation ordering.')
+
+
+@positions_cli.command('rebalance')
+@click.option('--stage-id', type=int, multiple=True, help='Stage to renumber; repeatable.')
+@click.option('--min-gap', type=int, default=2, show_default=True,
+              help='Without --stage-id, renumber stages with neighbours closer than this.')
+def rebalance_positions(stage_id, min_gap):
+    """Restore the gaps between negotiation positions."""
+    from . import db
+    from .pipelines.ordering import crowded_stages, rebalance_stage
+
+    stage_ids = stage_id or crowded_stages(min_gap)
+    for sid in stage_ids:
+        rebalance_stage(sid)
+        db.session.commit()
+    click.echo(f'Rebalanced {len(stage_ids)} stage(s)')
+
+
+changes_cli = AppGroup('changes', help='Maintain the board change log.')
+
+
+@changes_cli.command('compact')
+@click.option('--older-than-days', type=int, default=None,
+              help='Retention in days; defaults to CHANGE_LOG_RETENTION_DAYS.')
+def compact_change_log(older_than_days):
+    """Delete old change-log entries in bounded chunks."""
+    from flask import current_app
+    from .pipelines.changes import compact_changes
+
+    if older_than_days is None:
+        older_than_days = current_app.config['CHANGE_LOG_RETENTION_DAYS']
+    click.echo(f'Removed {compact_changes(older_than_days)} change(s)')
+
+
+api_keys_cli = AppGroup('api-keys', help='Maintain API keys.')
+
+
+@api_keys_cli.command('prune')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='Keys deleted per transaction.')
+def prune_api_keys(batch_size):
+    """Delete expired API keys in short transactions."""
+    from .api_keys import prune_expired_keys
+
+    click.echo(f'Removed {prune_expired_keys(batch_size)} expired key(s)')
+
+
+purge_cli = AppGroup('purge', help='Remove deleted pipelines and stages.')
+
+
+@purge_cli.command('run')
+@click.option('--batch-size', type=int, default=None,
+              help='Rows deleted per transaction; defaults to PURGE_BATCH_SIZE.')
+def run_purge(batch_size):
+    """Purge soft-deleted pipelines and stages in bounded batches."""
+    from flask import current_app
+    from .pipelines.purge import purge_deleted
+
+    if batch_size is None:
+        batch_size = current_app.config['PURGE_BATCH_SIZE']
+    pipelines, stages, rows = purge_deleted(batch_size)
+    click.echo(f'Purged {pipelines} pipeline(s), {stages} stage(s) and {rows} row(s)')
+
+
+def register_commands(app):
+    app.cli.add_command(kpis_cli)
+    app.cli.add_command(stages_cli)
+    app.cli.add_command(positions_cli)
+    app.cli.add_command(changes_cli)
+    app.cli.add_command(api_keys_cli)
+    app.cli.add_command(purge_cli)
@@ -0,0 +1,184 @@
+"""Live board events pushed over Server-Sent Events.
+
+Each worker process runs one ``EventBus``.  A single background poller
+reads new ``change_log`` rows and fans them out to the in-process
+subscribers of the affected pipeline, so the database sees one query per
+poll interval per process however many streams are open.  Commits made by
+the same process wake the poller immediately; commits from other workers
+are picked up on the next poll.
+
+Idle streams only block on a queue, so under gevent workers (see
+``gunicorn.conf.py``) each one costs a greenlet instead of a worker.
+"""
+import json
+import queue
+import threading
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import ChangeLog
+
+SUBSCRIBER_QUEUE_SIZE = 1000
+POLL_BATCH = 1000
+# Sequence values are allocated at insert time, so a concurrent transaction
+# can commit a lower seq after a higher one was already delivered.  Each
+# poll re-reads this many seqs behind the newest one and skips duplicates.
+REORDER_WINDOW = 100
+
+
+class Subscription:
+    """Bounded queue of changes for one open stream."""
+
+    def __init__(self, pipeline_id):
+        self.pipeline_id = pipeline_id
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, change):
+        try:
+            self._queue.put_nowait(change)
+        except queue.Full:
+            # A client this far behind has to reload the board anyway.
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Next change, or ``None`` after ``timeout`` seconds without one."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """Fans committed changes out to open streams.
+
+    With ``background`` off no poller thread is started; whoever owns the
+    bus calls ``poll`` instead (the tests do, as they share one in-memory
+    connection with the request thread).
+    """
+
+    def __init__(self, app, poll_interval=1.0, background=True):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.background = background
+        self.last_seq = None
+        self._start_seq = None
+        self._seen = set()
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self, pipeline_id):
+        """Register a stream; must be called inside an app context."""
+        subscription = Subscription(pipeline_id)
+        with self._lock:
+            self._subscribers.setdefault(pipeline_id, set()).add(subscription)
+            if self._thread is None and (self.background or self.last_seq is None):
+                self.last_seq = self._start_seq = db.session.query(db.func.max(ChangeLog.seq)).scalar() or 0
+                self._seen.clear()
+                if self.background:
+                    self._thread = threading.Thread(target=self._run, name='event-bus', daemon=True)
+                    self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.pipeline_id, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.pipeline_id, None)
+
+    def connections(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def wake(self):
+        self._wake.set()
+
+    def publish(self, changes):
+        for change in changes:
+            with self._lock:
+                subscribers = list(self._subscribers.get(change['pipeline_id'], ()))
+            for subscription in subscribers:
+                subscription.put(change)
+
+    def poll(self):
+        """Fan out committed changes newer than the last poll.
+
+        Returns ``True`` when a full batch was read and more may be waiting.
+        """
+        low = max(self.last_seq - REORDER_WINDOW, self._start_seq)
+        rows = db.session.execute(
+            db.select(ChangeLog.seq, ChangeLog.pipeline_id, ChangeLog.entity, ChangeLog.entity_id,
+                      ChangeLog.action, ChangeLog.payload, ChangeLog.created_at)
+            .where(ChangeLog.seq > low)
+            .order_by(ChangeLog.seq)
+            .limit(POLL_BATCH)).all()
+        fresh = [row for row in rows if row.seq not in self._seen]
+        for row in fresh:
+            self._seen.add(row.seq)
+            self.last_seq = max(self.last_seq, row.seq)
+        self._seen = {seq for seq in self._seen if seq > self.last_seq - REORDER_WINDOW}
+        self.publish([{'seq': row.seq, 'pipeline_id': row.pipeline_id, 'entity': row.entity,
+                       'entity_id': row.entity_id, 'action': row.action, 'payload': row.payload,
+                       'created_at': row.created_at.isoformat()} for row in fresh])
+        return len(rows) == POLL_BATCH
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                try:
+                    while self.poll():
+                        pass
+                except Exception:
+                    current_app.logger.exception('Event bus poll failed')
+                finally:
+                    db.session.remove()
+
+
+def format_event(change):
+    return f"id: {change['seq']}\nevent: {change['entity']}.{change['action']}\ndata: {json.dumps(change)}\n\n"
+
+
+def event_stream(bus, subscription, backlog=(), heartbeat=15):
+    """Yield SSE frames for ``subscription`` until the client goes away.
+
+    ``backlog`` holds changes replayed for a reconnecting client; live
+    changes it already covers are skipped.
+    """
+    last_seq = backlog[-1]['seq'] if backlog else 0
+    try:
+        yield 'retry: 3000\n\n'
+        for change in backlog:
+            yield format_event(change)
+        while True:
+            if subscription.overflowed:
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            change = subscription.get(heartbeat)
+            if change is None:
+                # Comment frames keep proxies from timing the stream out and
+                # surface disconnected clients on the next write.
+                yield ': keep-alive\n\n'
+            elif change['seq'] > last_seq:
+                yield format_event(change)
+    finally:
+        bus.unsubscribe(subscription)
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_event_bus(session):
+    if session.info.pop('changes_recorded', False) and has_app_context():
+        bus = current_app.extensions.get('event_bus')
+        if bus is not None:
+            bus.wake()
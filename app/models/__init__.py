@@ -1,5 +1,5 @@
 from .. import db
-from datetime import datetime
+from datetime import datetime, date
 
 class Account(db.Model):
     __tablename__ = 'accounts'
@@ -12,6 +12,11 @@ class Account(db.Model):
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Admin listing filters, paged on user_id.
+        db.Index('ix_users_account_user', 'account_id', 'user_id'),
+        db.Index('ix_users_role_user', 'role', 'user_id'),
+    )
     user_id = db.Column(db.Integer, primary_key=True)
     user_email = db.Column(db.String(120), unique=True, nullable=False)
     user_name = db.Column(db.String(120), nullable=False)
@@ -26,47 +31,87 @@ class User(db.Model):
 
 pipeline_users = db.Table(
     'pipeline_users',
-    db.Column('pipeline_id', db.Integer, db.ForeignKey('pipelines.id'), primary_key=True),
-    db.Column('user_id', db.Integer, db.ForeignKey('users.user_id'), primary_key=True)
+    db.Column('pipeline_id', db.Integer, db.ForeignKey('pipelines.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('users.user_id'), primary_key=True),
+    db.Index('ix_pipeline_users_user_id', 'user_id'),
 )
 
 stage_users = db.Table(
     'stage_users',
-    db.Column('stage_id', db.Integer, db.ForeignKey('stages.id'), primary_key=True),
+    db.Column('stage_id', db.Integer, db.ForeignKey('stages.id', ondelete='CASCADE'), primary_key=True),
     db.Column('user_id', db.Integer, db.ForeignKey('users.user_id'), primary_key=True)
 )
 
 
 class Pipeline(db.Model):
     __tablename__ = 'pipelines'
+    __table_args__ = (
+        db.Index('ix_pipelines_account_position', 'account_id', 'position'),
+        db.Index('ix_pipelines_deleted_at', 'deleted_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     position = db.Column(db.Integer)
     account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'))
+    # Bumped by every write that changes what the pipeline's read endpoints
+    # return; used to key cached responses.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Highest change-log seq removed by compaction; feeds polled from an
+    # older seq have missed changes and must reload.
+    changes_floor = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Set when the pipeline is deleted; the rows are removed later, in
+    # batches, by ``app.pipelines.purge``.
+    deleted_at = db.Column(db.DateTime)
 
     account = db.relationship('Account', back_populates='pipelines')
-    stages = db.relationship('Stage', back_populates='pipeline', cascade='all, delete-orphan')
-    users = db.relationship('User', secondary='pipeline_users', back_populates='pipelines')
+    # Child rows go with ON DELETE CASCADE instead of being loaded and
+    # deleted one by one.
+    stages = db.relationship('Stage', back_populates='pipeline', cascade='all, delete-orphan',
+                             passive_deletes=True)
+    users = db.relationship('User', secondary='pipeline_users', back_populates='pipelines',
+                            passive_deletes=True)
 
 
 class Stage(db.Model):
     __tablename__ = 'stages'
+    __table_args__ = (
+        db.Index('ix_stages_pipeline_position', 'pipeline_id', 'position'),
+        db.Index('ix_stages_deleted_at', 'deleted_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
     position = db.Column(db.Integer)
-    pipeline_id = db.Column(db.Integer, db.ForeignKey('pipelines.id'))
+    pipeline_id = db.Column(db.Integer, db.ForeignKey('pipelines.id', ondelete='CASCADE'))
+    # Column totals, maintained with the KPI rollups by
+    # ``app.pipelines.counters``.
+    deal_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    deal_value_sum = db.Column(db.Numeric(14, 2), nullable=False, default=0, server_default='0')
+    open_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Soft delete, see ``Pipeline.deleted_at``.
+    deleted_at = db.Column(db.DateTime)
 
     pipeline = db.relationship('Pipeline', back_populates='stages')
-    users = db.relationship('User', secondary='stage_users', back_populates='stages')
-    negotiations = db.relationship('Negotiation', back_populates='stage', cascade='all, delete-orphan')
+    users = db.relationship('User', secondary='stage_users', back_populates='stages', passive_deletes=True)
+    negotiations = db.relationship('Negotiation', back_populates='stage', cascade='all, delete-orphan',
+                                   passive_deletes=True)
 
 
 class Negotiation(db.Model):
     __tablename__ = 'negotiations'
+    __table_args__ = (
+        # Board ordering and position shifts inside a stage.
+        db.Index('ix_negotiations_stage_position', 'stage_id', 'position'),
+        # KPI filters: status counts and date ranges per stage.
+        db.Index('ix_negotiations_stage_status_created', 'stage_id', 'status', 'created_at'),
+        # Partial-day edges of KPI date ranges.
+        db.Index('ix_negotiations_stage_created', 'stage_id', 'created_at'),
+        # KPI seller filter.
+        db.Index('ix_negotiations_owner_created', 'owner_id', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(120), nullable=False)
     position = db.Column(db.Integer)
-    stage_id = db.Column(db.Integer, db.ForeignKey('stages.id'))
+    stage_id = db.Column(db.Integer, db.ForeignKey('stages.id', ondelete='CASCADE'))
     owner_id = db.Column(db.Integer, db.ForeignKey('users.user_id'))
     value = db.Column(db.Numeric(10, 2), default=0)
     status = db.Column(db.String(20), default='open')
@@ -77,12 +122,103 @@ class Negotiation(db.Model):
     owner = db.relationship('User')
 
 
+# Keyset pagination of negotiation lists (``app.pipelines.listing``), which
+# sorts rows without a position as position 0.
+db.Index('ix_negotiations_stage_page_key', Negotiation.stage_id,
+         db.func.coalesce(Negotiation.position, db.literal_column('0')), Negotiation.id)
+
+
+class KpiRollup(db.Model):
+    """Deal count and value per (pipeline, stage, owner, status, creation day).
+
+    Maintained alongside negotiation writes by ``app.pipelines.rollups``.
+    Missing owners, statuses and creation dates are stored as the sentinels
+    below so every bucket has a complete primary key.
+    """
+    __tablename__ = 'kpi_rollups'
+    NO_OWNER = 0
+    NO_STATUS = ''
+    UNDATED = date.min
+
+    pipeline_id = db.Column(db.Integer, db.ForeignKey('pipelines.id', ondelete='CASCADE'), primary_key=True)
+    stage_id = db.Column(db.Integer, db.ForeignKey('stages.id', ondelete='CASCADE'), primary_key=True)
+    owner_id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    deal_count = db.Column(db.Integer, nullable=False, default=0)
+    value_sum = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_kpi_rollups_pipeline_day', 'pipeline_id', 'day'),
+        db.Index('ix_kpi_rollups_pipeline_owner_day', 'pipeline_id', 'owner_id', 'day'),
+    )
+
+
+class StageTransition(db.Model):
+    """One row per negotiation entering a stage, including its creation.
+
+    Append-only history for funnel and dwell-time analytics; written by the
+    flush hooks in ``app.pipelines.transitions``.  ``negotiation_id`` is not
+    a foreign key so history survives the negotiation.
+    """
+    __tablename__ = 'stage_transitions'
+    __table_args__ = (
+        db.Index('ix_stage_transitions_pipeline_negotiation', 'pipeline_id', 'negotiation_id', 'moved_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    pipeline_id = db.Column(db.Integer, db.ForeignKey('pipelines.id', ondelete='CASCADE'), nullable=False)
+    negotiation_id = db.Column(db.Integer, nullable=False)
+    # ``None`` for the transition that creates the negotiation, or when the
+    # previous stage was overwritten without ever being loaded.
+    from_stage_id = db.Column(db.Integer)
+    to_stage_id = db.Column(db.Integer, nullable=False)
+    owner_id = db.Column(db.Integer)
+    moved_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ChangeLog(db.Model):
+    """Append-only record of writes to a pipeline, read by the change feed.
+
+    ``pipeline_id`` is deliberately not a foreign key so the deletion of a
+    pipeline can itself be logged; old rows are removed by compaction.
+    """
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_pipeline_seq', 'pipeline_id', 'seq'),
+        db.Index('ix_change_log_created_at', 'created_at'),
+        # Without AUTOINCREMENT SQLite reuses the seqs of compacted rows,
+        # which would hide new entries from clients past them.
+        {'sqlite_autoincrement': True},
+    )
+    seq = db.Column(db.Integer, primary_key=True)
+    pipeline_id = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer)
+    action = db.Column(db.String(30), nullable=False)
+    payload = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
 class ApiKey(db.Model):
+    """An API token, stored as its SHA-256 digest (see ``app.api_keys``)."""
     __tablename__ = 'api_keys'
+    __table_args__ = (
+        db.Index('ix_api_keys_key_prefix', 'key_prefix'),
+        # Pruning and the webhook's search for a reusable key.
+        db.Index('ix_api_keys_expires_at', 'expires_at'),
+        db.Index('ix_api_keys_user_id', 'user_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    key = db.Column(db.String(255), unique=True, nullable=False)
+    key_hash = db.Column(db.String(64), unique=True, nullable=False)
+    key_prefix = db.Column(db.String(8), nullable=False)
     scopes = db.Column(db.String(255))
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # ``None`` never expires.
+    expires_at = db.Column(db.DateTime)
+    last_used_at = db.Column(db.DateTime)
+    # Set on keys minted by the sign-in webhook, whose token is derived from
+    # it and SECRET_KEY so it can be handed out again.
+    nonce = db.Column(db.String(32))
 
     user = db.relationship('User', back_populates='api_keys')
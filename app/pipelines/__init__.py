@@ -1,19 +1,91 @@
-from flask import Blueprint, request, jsonify, g
+from flask import Blueprint, request, jsonify, g, current_app, make_response, stream_with_context, abort
 from functools import wraps
+import hashlib
+import json
+import time
+from collections import namedtuple
+from datetime import datetime
+from urllib.parse import urlencode
 
 from .. import db
-from ..models import Pipeline, Stage, Negotiation, ApiKey, User
-from datetime import datetime
+from ..api_keys import hash_token, touch_api_key
+from ..models import Pipeline, Stage, Negotiation, ApiKey, User, pipeline_users
+from .kpis import (SERIES_BUCKETS, parse_account_kpi_args, parse_kpi_args, kpi_rows, kpi_series,
+                   summarize_account_kpis, summarize_kpis)
+from .analytics import pipeline_funnel
+from .ordering import POSITION_GAP, StagePlacement, next_position, position_at, set_positions
+from .imports import (NegotiationLookups, parse_negotiation, iter_lines, iter_records,
+                      import_negotiations)
+from .exports import generate_csv, generate_ndjson
+from .listing import PAGE_KEY, parse_list_args, negotiation_page
+from ..events import event_stream
+from .changes import (ChangesGone, CHANGES_PAGE_SIZE, MAX_CHANGES_PAGE_SIZE, changes_since,
+                      latest_seqs, negotiation_payload, record_change, record_changes)
+from . import rollups  # noqa: F401  registers the rollup flush hooks
+from . import transitions  # noqa: F401  registers the stage transition flush hook
 
 pipelines_bp = Blueprint('pipelines', __name__)
 
 
+# Lightweight stand-in for ``User`` stored in the API key cache so that an
+# authenticated request does not need to touch the database. ``expires_at``
+# is the key's expiry and ``cached_at`` the wall-clock time it was resolved.
+Principal = namedtuple('Principal', ['user_id', 'role', 'account_id', 'expires_at', 'cached_at'])
+
+
+def api_key_cache():
+    return current_app.extensions['api_key_cache']
+
+
+def api_key_revocations():
+    return current_app.extensions['api_key_revocations']
+
+
+def _revocation_key(user_id):
+    return f'user:{user_id}'
+
+
+def _is_stale(principal):
+    if principal.expires_at is not None and principal.expires_at <= datetime.utcnow():
+        return True
+    # Another worker may have revoked a key or changed the role since this
+    # principal was cached.
+    revoked_at = api_key_revocations().get(_revocation_key(principal.user_id))
+    return revoked_at is not None and float(revoked_at) >= principal.cached_at
+
+
 def get_current_user():
     token = request.headers.get('X-API-Key')
     if not token:
         return None
-    api_key = ApiKey.query.filter_by(key=token).first()
-    return api_key.user if api_key else None
+    key_hash = hash_token(token)
+    cache = api_key_cache()
+    principal = cache.get(key_hash)
+    if principal is not None and _is_stale(principal):
+        cache.delete(key_hash)
+        principal = None
+    if principal is None:
+        # Taken before the lookup so a revocation committed meanwhile wins.
+        cached_at = time.time()
+        row = (db.session.query(User.user_id, User.role, User.account_id, ApiKey.expires_at,
+                                ApiKey.id, ApiKey.last_used_at)
+               .join(ApiKey, ApiKey.user_id == User.user_id)
+               .filter(ApiKey.key_hash == key_hash,
+                       (ApiKey.expires_at.is_(None)) | (ApiKey.expires_at > datetime.utcnow()))
+               .first())
+        if row is None:
+            return None
+        principal = Principal(*row[:4], cached_at)
+        cache.set(key_hash, principal)
+        touch_api_key(row.id, row.last_used_at)
+    return principal
+
+
+def invalidate_user_keys(user_id):
+    """Drop cached principals of ``user_id`` here and, through the shared
+    revocation marker, on every other worker."""
+    api_key_cache().delete_where(lambda principal: principal.user_id == user_id)
+    api_key_revocations().set(_revocation_key(user_id), repr(time.time()))
 
 
 def login_required(f):
@@ -49,18 +121,191 @@ def super_admin_required(f):
     return wrapper
 
 
+@pipelines_bp.before_app_request
+def _reset_authorization():
+    g.pop('accessible_pipeline_ids', None)
+
+
+def accessible_pipeline_ids():
+    """Ids of the pipelines the current user may open.
+
+    Account-owned pipelines plus those shared with the user, resolved with
+    one query and memoized on ``g`` for the rest of the request.
+    """
+    if 'accessible_pipeline_ids' not in g:
+        query = accessible_pipelines_query(g.current_user).with_entities(Pipeline.id)
+        g.accessible_pipeline_ids = {pid for (pid,) in query}
+    return g.accessible_pipeline_ids
+
+
+def can_access_pipeline(pipeline_id, account_id):
+    # Pipelines of the user's own account are always in the set, so only
+    # shared pipelines need it resolved.
+    return account_id == g.current_user.account_id or pipeline_id in accessible_pipeline_ids()
+
+
 def pipeline_access_required(f):
     @wraps(f)
     def wrapper(pipeline_id, *args, **kwargs):
         pipeline = Pipeline.query.get_or_404(pipeline_id)
-        user = g.current_user
-        if pipeline.account_id != user.account_id and user not in pipeline.users:
+        if pipeline.deleted_at is not None:
+            abort(404)
+        if not can_access_pipeline(pipeline.id, pipeline.account_id):
             return jsonify({'error': 'Forbidden'}), 403
         g.pipeline = pipeline
         return f(pipeline_id, *args, **kwargs)
     return wrapper
 
 
+def load_negotiation(negotiation_id):
+    """Return ``(negotiation, pipeline_id, account_id)`` in one statement, or 404."""
+    row = (db.session.query(Negotiation, Stage.pipeline_id, Pipeline.account_id)
+           .outerjoin(Stage, Negotiation.stage_id == Stage.id)
+           .outerjoin(Pipeline, Stage.pipeline_id == Pipeline.id)
+           .filter(Negotiation.id == negotiation_id, Stage.deleted_at.is_(None), Pipeline.deleted_at.is_(None))
+           .first())
+    if row is None:
+        abort(404)
+    return row
+
+
+def load_stage_scope(stage_id):
+    """Return ``(pipeline_id, account_id)`` of a stage in one statement, or 404."""
+    row = (db.session.query(Stage.pipeline_id, Pipeline.account_id)
+           .join(Pipeline, Stage.pipeline_id == Pipeline.id)
+           .filter(Stage.id == stage_id, Stage.deleted_at.is_(None), Pipeline.deleted_at.is_(None))
+           .first())
+    if row is None:
+        abort(404)
+    return row
+
+
+def live_stage_or_404(stage_id):
+    """Load a stage that has not been deleted, or abort with 404."""
+    stage = Stage.query.get_or_404(stage_id)
+    if stage.deleted_at is not None:
+        abort(404)
+    return stage
+
+
+def is_id(value):
+    """Whether a JSON value can name a row: an integer that is not a boolean."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def prefers_async():
+    """Whether the client asked for a soft delete with ``Prefer: respond-async``."""
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def response_cache():
+    return current_app.extensions['response_cache']
+
+
+def bump_pipeline_versions(*pipeline_ids):
+    """Invalidate cached reads of the given pipelines.
+
+    Must be called by every write so the new version is committed in the
+    same transaction as the change it describes.
+    """
+    ids = {pid for pid in pipeline_ids if pid is not None}
+    if ids:
+        Pipeline.query.filter(Pipeline.id.in_(ids)).update(
+            {'version': Pipeline.version + 1}, synchronize_session=False)
+
+
+def make_etag(*parts):
+    """Weak validator for the current request built from a change marker."""
+    return hashlib.sha1(repr((request.full_path,) + parts).encode()).hexdigest()[:20]
+
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag):
+    """A 304 response if the client already holds ``etag``, else ``None``."""
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(current_app.response_class(status=304), etag)
+    return None
+
+
+def conditional_response(marker):
+    """Answer ``If-None-Match`` from ``marker`` before running the view.
+
+    ``marker`` gets the view arguments and returns a tuple that changes
+    whenever the response would; it must be cheaper than the view itself.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = make_etag(*marker(*args, **kwargs))
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                with_etag(response, etag)
+            return response
+        return wrapper
+    return decorator
+
+
+# Pipeline-scoped reads change exactly when the pipeline version is bumped;
+# the version is already loaded by ``pipeline_access_required``.
+pipeline_etag = conditional_response(lambda pipeline_id, *args, **kwargs: ('pipeline', g.pipeline.version))
+
+
+def _accessible_pipelines_marker():
+    # Versions only grow, and the id sum catches a delete followed by a create.
+    user = g.current_user
+    count, id_sum, version_sum = accessible_pipelines_query(user).with_entities(
+        db.func.count(Pipeline.id),
+        db.func.coalesce(db.func.sum(Pipeline.id), 0),
+        db.func.coalesce(db.func.sum(Pipeline.version), 0)).one()
+    return ('pipelines', user.user_id, count, id_sum, version_sum)
+
+
+accessible_pipelines_etag = conditional_response(lambda *args, **kwargs: _accessible_pipelines_marker())
+
+
+# Response headers that are part of the payload and must survive a cache hit.
+CACHED_HEADERS = ('X-Next-Cursor',)
+
+
+def cached_response(f):
+    """Serve a pipeline-scoped GET from the response cache.
+
+    Entries are keyed on the pipeline version loaded by
+    ``pipeline_access_required``, so a write never has to purge anything:
+    bumping the version makes older entries unreachable.
+    """
+    @wraps(f)
+    def wrapper(pipeline_id, *args, **kwargs):
+        query = urlencode(sorted(request.args.items(multi=True)))
+        key = f'pipeline:{pipeline_id}:v{g.pipeline.version}:{request.path}?{query}'
+        cache = response_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            headers, body = json.loads(cached)
+            return current_app.response_class(body, mimetype='application/json', headers=headers)
+        response = make_response(f(pipeline_id, *args, **kwargs))
+        if response.status_code == 200:
+            headers = {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers}
+            cache.set(key, json.dumps([headers, response.get_data(as_text=True)]))
+        return response
+    return wrapper
+
+
+def accessible_pipelines_query(user):
+    member_of = db.select(pipeline_users.c.pipeline_id).where(pipeline_users.c.user_id == user.user_id)
+    return Pipeline.query.filter((Pipeline.account_id == user.account_id) | (Pipeline.id.in_(member_of)),
+                                 Pipeline.deleted_at.is_(None))
+
+
 @pipelines_bp.route('/pipelines', methods=['POST'])
 @supervisor_required
 def create_pipeline():
@@ -72,22 +317,86 @@ def create_pipeline():
     max_pos = db.session.query(db.func.max(Pipeline.position)).filter_by(account_id=user.account_id).scalar() or 0
     pipeline = Pipeline(name=name, account_id=user.account_id, position=max_pos + 1)
     db.session.add(pipeline)
-    pipeline.users.append(user)
+    pipeline.users.append(db.session.get(User, user.user_id))
+    db.session.flush()
+    record_change(pipeline.id, 'pipeline', pipeline.id, 'created',
+                  {'name': pipeline.name, 'position': pipeline.position})
     db.session.commit()
     return jsonify({'id': pipeline.id, 'name': pipeline.name}), 201
 
 
 @pipelines_bp.route('/pipelines', methods=['GET'])
 @supervisor_required
+@accessible_pipelines_etag
 def list_pipelines():
-    user = g.current_user
-    pipelines = Pipeline.query.filter((Pipeline.account_id == user.account_id) | (Pipeline.users.contains(user))).order_by(Pipeline.position).all()
+    pipelines = accessible_pipelines_query(g.current_user).order_by(Pipeline.position).all()
     return jsonify([{'id': p.id, 'name': p.name} for p in pipelines])
 
 
+def stage_summary(stage):
+    """Stage fields shared by the stage endpoints and the board."""
+    return {'id': stage.id, 'name': stage.name, 'deal_count': stage.deal_count,
+            'deal_value_sum': float(stage.deal_value_sum or 0), 'open_count': stage.open_count}
+
+
+def build_board(pipelines):
+    """Nest stages and ordered negotiations under ``pipelines``.
+
+    Uses one query for all stages and one for all negotiations regardless of
+    how many pipelines or stages are involved.  Each pipeline carries the
+    change feed ``cursor`` to poll ``/changes`` or ``/events`` from.
+    """
+    pipeline_ids = [p.id for p in pipelines]
+    if not pipeline_ids:
+        return []
+    # Read before the snapshot: a write committed in between is then replayed
+    # by the feed rather than missed.
+    cursors = latest_seqs(pipelines)
+    board = [{'id': p.id, 'name': p.name, 'cursor': cursors[p.id], 'stages': []} for p in pipelines]
+    by_pipeline = {p['id']: p for p in board}
+    stages = (db.session.query(Stage.id, Stage.name, Stage.pipeline_id, Stage.deal_count,
+                               Stage.deal_value_sum, Stage.open_count)
+              .filter(Stage.pipeline_id.in_(pipeline_ids), Stage.deleted_at.is_(None))
+              .order_by(Stage.pipeline_id, Stage.position)
+              .all())
+    by_stage = {}
+    for stage in stages:
+        by_stage[stage.id] = {**stage_summary(stage), 'negotiations': []}
+        by_pipeline[stage.pipeline_id]['stages'].append(by_stage[stage.id])
+    negotiations = (db.session.query(Negotiation.id, Negotiation.title, Negotiation.stage_id,
+                                     Negotiation.owner_id, Negotiation.value, Negotiation.status)
+                    .join(Stage, Negotiation.stage_id == Stage.id)
+                    .filter(Stage.pipeline_id.in_(pipeline_ids), Stage.deleted_at.is_(None))
+                    .order_by(*PAGE_KEY))
+    for nid, title, stage_id, owner_id, value, status in negotiations:
+        by_stage[stage_id]['negotiations'].append({
+            'id': nid, 'title': title, 'owner_id': owner_id,
+            'value': float(value or 0), 'status': status,
+        })
+    return board
+
+
+@pipelines_bp.route('/pipelines/board', methods=['GET'])
+@supervisor_required
+@accessible_pipelines_etag
+def account_board():
+    pipelines = accessible_pipelines_query(g.current_user).order_by(Pipeline.position).all()
+    return jsonify(build_board(pipelines))
+
+
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/board', methods=['GET'])
+@login_required
+@pipeline_access_required
+@pipeline_etag
+@cached_response
+def pipeline_board(pipeline_id):
+    return jsonify(build_board([g.pipeline])[0])
+
+
 @pipelines_bp.route('/pipelines/<int:pipeline_id>', methods=['GET'])
 @supervisor_required
 @pipeline_access_required
+@pipeline_etag
 def get_pipeline(pipeline_id):
     pipeline = g.pipeline
     return jsonify({'id': pipeline.id, 'name': pipeline.name})
@@ -101,6 +410,8 @@ def update_pipeline(pipeline_id):
     name = data.get('name')
     if name:
         g.pipeline.name = name
+    record_change(pipeline_id, 'pipeline', pipeline_id, 'updated', {'name': g.pipeline.name})
+    bump_pipeline_versions(pipeline_id)
     db.session.commit()
     return jsonify({'id': g.pipeline.id, 'name': g.pipeline.name})
 
@@ -109,6 +420,18 @@ def update_pipeline(pipeline_id):
 @supervisor_required
 @pipeline_access_required
 def delete_pipeline(pipeline_id):
+    """Delete the pipeline; the database cascades to its stages and deals.
+
+    With ``Prefer: respond-async`` the pipeline is only hidden and its rows
+    are purged in the background.
+    """
+    record_change(pipeline_id, 'pipeline', pipeline_id, 'deleted')
+    bump_pipeline_versions(pipeline_id)
+    if prefers_async():
+        g.pipeline.deleted_at = datetime.utcnow()
+        db.session.commit()
+        current_app.extensions['purge_worker'].wake()
+        return '', 202
     db.session.delete(g.pipeline)
     db.session.commit()
     return '', 204
@@ -119,14 +442,14 @@ def delete_pipeline(pipeline_id):
 def reorder_pipelines():
     data = request.get_json() or {}
     ids = data.get('pipeline_ids')
-    if not ids or not isinstance(ids, list):
-        return jsonify({'error': 'pipeline_ids must be a list'}), 400
-    user = g.current_user
-    pipelines = Pipeline.query.filter(Pipeline.id.in_(ids)).all()
-    if any(p.account_id != user.account_id and user not in p.users for p in pipelines):
+    if not ids or not isinstance(ids, list) or not all(is_id(i) for i in ids):
+        return jsonify({'error': 'pipeline_ids must be a list of integers'}), 400
+    if not set(ids) <= accessible_pipeline_ids():
         return jsonify({'error': 'Forbidden'}), 403
-    for position, pid in enumerate(ids, start=1):
-        Pipeline.query.filter_by(id=pid).update({'position': position})
+    set_positions(Pipeline.__table__, ids)
+    record_changes([{'pipeline_id': pid, 'entity': 'pipeline', 'entity_id': pid, 'action': 'reordered',
+                     'payload': {'position': position}} for position, pid in enumerate(ids, start=1)])
+    bump_pipeline_versions(*ids)
     db.session.commit()
     return '', 204
 
@@ -142,7 +465,10 @@ def create_stage(pipeline_id):
     max_pos = db.session.query(db.func.max(Stage.position)).filter_by(pipeline_id=pipeline_id).scalar() or 0
     stage = Stage(name=name, pipeline_id=pipeline_id, position=max_pos + 1)
     db.session.add(stage)
-    stage.users.append(g.current_user)
+    stage.users.append(db.session.get(User, g.current_user.user_id))
+    db.session.flush()
+    record_change(pipeline_id, 'stage', stage.id, 'created', {'name': stage.name, 'position': stage.position})
+    bump_pipeline_versions(pipeline_id)
     db.session.commit()
     return jsonify({'id': stage.id, 'name': stage.name}), 201
 
@@ -150,32 +476,38 @@ def create_stage(pipeline_id):
 @pipelines_bp.route('/pipelines/<int:pipeline_id>/stages', methods=['GET'])
 @supervisor_required
 @pipeline_access_required
+@pipeline_etag
+@cached_response
 def list_stages(pipeline_id):
-    stages = Stage.query.filter_by(pipeline_id=pipeline_id).order_by(Stage.position).all()
-    return jsonify([{'id': s.id, 'name': s.name} for s in stages])
+    stages = (Stage.query.filter(Stage.pipeline_id == pipeline_id, Stage.deleted_at.is_(None))
+              .order_by(Stage.position).all())
+    return jsonify([stage_summary(s) for s in stages])
 
 
 @pipelines_bp.route('/pipelines/<int:pipeline_id>/stages/<int:stage_id>', methods=['GET'])
 @supervisor_required
 @pipeline_access_required
+@pipeline_etag
 def get_stage(pipeline_id, stage_id):
-    stage = Stage.query.get_or_404(stage_id)
+    stage = live_stage_or_404(stage_id)
     if stage.pipeline_id != pipeline_id:
         return jsonify({'error': 'Invalid stage'}), 400
-    return jsonify({'id': stage.id, 'name': stage.name})
+    return jsonify(stage_summary(stage))
 
 
 @pipelines_bp.route('/pipelines/<int:pipeline_id>/stages/<int:stage_id>', methods=['PUT'])
 @supervisor_required
 @pipeline_access_required
 def update_stage(pipeline_id, stage_id):
-    stage = Stage.query.get_or_404(stage_id)
+    stage = live_stage_or_404(stage_id)
     if stage.pipeline_id != pipeline_id:
         return jsonify({'error': 'Invalid stage'}), 400
     data = request.get_json() or {}
     name = data.get('name')
     if name:
         stage.name = name
+    record_change(pipeline_id, 'stage', stage_id, 'updated', {'name': stage.name})
+    bump_pipeline_versions(pipeline_id)
     db.session.commit()
     return jsonify({'id': stage.id, 'name': stage.name})
 
@@ -184,9 +516,16 @@ def update_stage(pipeline_id, stage_id):
 @supervisor_required
 @pipeline_access_required
 def delete_stage(pipeline_id, stage_id):
-    stage = Stage.query.get_or_404(stage_id)
+    stage = live_stage_or_404(stage_id)
     if stage.pipeline_id != pipeline_id:
         return jsonify({'error': 'Invalid stage'}), 400
+    record_change(pipeline_id, 'stage', stage_id, 'deleted')
+    bump_pipeline_versions(pipeline_id)
+    if prefers_async():
+        stage.deleted_at = datetime.utcnow()
+        db.session.commit()
+        current_app.extensions['purge_worker'].wake()
+        return '', 202
     db.session.delete(stage)
     db.session.commit()
     return '', 204
@@ -198,68 +537,226 @@ def delete_stage(pipeline_id, stage_id):
 def reorder_stages(pipeline_id):
     data = request.get_json() or {}
     ids = data.get('stage_ids')
-    if not ids or not isinstance(ids, list):
-        return jsonify({'error': 'stage_ids must be a list'}), 400
-    stages = Stage.query.filter(Stage.id.in_(ids), Stage.pipeline_id == pipeline_id).all()
+    if not ids or not isinstance(ids, list) or not all(is_id(i) for i in ids):
+        return jsonify({'error': 'stage_ids must be a list of integers'}), 400
+    stages = Stage.query.filter(Stage.id.in_(ids), Stage.pipeline_id == pipeline_id,
+                                Stage.deleted_at.is_(None)).all()
     if len(stages) != len(ids):
         return jsonify({'error': 'Invalid stages'}), 400
-    for position, sid in enumerate(ids, start=1):
-        Stage.query.filter_by(id=sid).update({'position': position})
+    set_positions(Stage.__table__, ids)
+    record_change(pipeline_id, 'pipeline', pipeline_id, 'stages_reordered', {'stage_ids': ids})
+    bump_pipeline_versions(pipeline_id)
     db.session.commit()
     return '', 204
 
 
-def can_edit_negotiation(user, negotiation):
+def can_edit_negotiation(user, negotiation, account_id):
+    """``account_id`` is the account owning the negotiation's pipeline."""
     if user.role == 'supervisor':
-        return negotiation.stage.pipeline.account_id == user.account_id
+        return account_id == user.account_id
     return negotiation.owner_id == user.user_id
 
 
 @pipelines_bp.route('/pipelines/<int:pipeline_id>/negotiations', methods=['GET'])
 @login_required
 @pipeline_access_required
+@pipeline_etag
+@cached_response
 def list_pipeline_negotiations(pipeline_id):
-    stages = Stage.query.filter_by(pipeline_id=pipeline_id).all()
-    negotiations = (Negotiation.query
-                    .filter(Negotiation.stage_id.in_([s.id for s in stages]))
-                    .order_by(Negotiation.position)
-                    .all())
-    return jsonify([{'id': n.id, 'title': n.title, 'stage_id': n.stage_id} for n in negotiations])
+    stage_ids = db.select(Stage.id).where(Stage.pipeline_id == pipeline_id, Stage.deleted_at.is_(None))
+    return negotiation_list([Negotiation.stage_id.in_(stage_ids)], ('title', 'stage_id'))
+
+
+def negotiation_list(filters, default_fields):
+    """Negotiations, paged when ``limit`` or ``cursor`` is given; the next
+    cursor goes in ``X-Next-Cursor``."""
+    try:
+        fields, limit, key = parse_list_args(request.args, default_fields)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    items, next_cursor = negotiation_page(filters, fields, limit, key)
+    response = jsonify(items)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/negotiations', methods=['POST'])
+@login_required
+@pipeline_access_required
+def create_negotiation(pipeline_id):
+    data = request.get_json() or {}
+    user = g.current_user
+    try:
+        values = parse_negotiation(data, NegotiationLookups(g.pipeline), default_owner=user.user_id)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    if user.role != 'supervisor' and values['owner_id'] != user.user_id:
+        return jsonify({'error': 'Forbidden'}), 403
+    position = data.get('position')
+    if position is not None and (not isinstance(position, int) or position < 1):
+        return jsonify({'error': 'Invalid position'}), 400
+    if position is not None:
+        values['position'] = position_at(values['stage_id'], position)
+    else:
+        values['position'] = next_position(values['stage_id'])
+    negotiation = Negotiation(**values)
+    db.session.add(negotiation)
+    db.session.flush()
+    record_change(pipeline_id, 'negotiation', negotiation.id, 'created', negotiation_payload(negotiation))
+    bump_pipeline_versions(pipeline_id)
+    db.session.commit()
+    return jsonify({'id': negotiation.id, 'title': negotiation.title, 'stage_id': negotiation.stage_id,
+                    'owner_id': negotiation.owner_id, 'value': float(negotiation.value),
+                    'status': negotiation.status}), 201
+
+
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/negotiations/import', methods=['POST'])
+@supervisor_required
+@pipeline_access_required
+def import_pipeline_negotiations(pipeline_id):
+    """Bulk-create negotiations from a streamed NDJSON or CSV body.
+
+    The format comes from ``?format=`` or the request content type. Rows
+    name their stage by ``stage`` (name) or ``stage_id``. Every batch of
+    ``IMPORT_BATCH_SIZE`` rows is committed on its own, so an import cut
+    short keeps the batches written before it.
+    """
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'csv' if request.mimetype in ('text/csv', 'application/csv') else 'ndjson'
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    records = iter_records(iter_lines(request.stream), fmt)
+
+    def commit_batch():
+        bump_pipeline_versions(pipeline_id)
+        db.session.commit()
+
+    summary = import_negotiations(g.pipeline, records, default_owner=g.current_user.user_id,
+                                  on_batch=commit_batch)
+    return jsonify(summary)
+
+
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/negotiations/export', methods=['GET'])
+@login_required
+@pipeline_access_required
+def export_pipeline_negotiations(pipeline_id):
+    fmt = request.args.get('format', 'ndjson')
+    if fmt == 'csv':
+        body, mimetype = generate_csv(pipeline_id), 'text/csv'
+    elif fmt == 'ndjson':
+        body, mimetype = generate_ndjson(pipeline_id), 'application/x-ndjson'
+    else:
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    response = current_app.response_class(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=pipeline-{pipeline_id}.{fmt}'
+    return response
+
+
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/changes', methods=['GET'])
+@login_required
+@pipeline_access_required
+def pipeline_changes(pipeline_id):
+    """Changes to the pipeline after ``since``; resume from the returned ``cursor``."""
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', CHANGES_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'since and limit must be integers'}), 400
+    if since < 0 or not 1 <= limit <= MAX_CHANGES_PAGE_SIZE:
+        return jsonify({'error': f'since must be >= 0 and limit between 1 and {MAX_CHANGES_PAGE_SIZE}'}), 400
+    try:
+        changes, has_more = changes_since(g.pipeline, since, limit)
+    except ChangesGone:
+        return jsonify({'error': 'Changes since this cursor were compacted; reload the board',
+                        'floor': g.pipeline.changes_floor}), 410
+    cursor = changes[-1]['seq'] if changes else since
+    return jsonify({'changes': changes, 'cursor': cursor, 'has_more': has_more})
+
+
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/events', methods=['GET'])
+@login_required
+@pipeline_access_required
+def pipeline_events(pipeline_id):
+    """Server-Sent Events stream of the pipeline's changes as they commit.
+
+    A reconnecting client's ``Last-Event-ID`` (or ``?since=``) replays what
+    it missed from the change log first; one too far behind gets a 410.  The stream does not hold a
+    database connection while idle.
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(since) if since else None
+    except ValueError:
+        return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+    bus = current_app.extensions['event_bus']
+    subscription = bus.subscribe(pipeline_id)
+    backlog, has_more = [], False
+    if since is not None:
+        try:
+            backlog, has_more = changes_since(g.pipeline, since, MAX_CHANGES_PAGE_SIZE)
+        except ChangesGone:
+            bus.unsubscribe(subscription)
+            return jsonify({'error': 'Changes since this event were compacted; reload the board',
+                            'floor': g.pipeline.changes_floor}), 410
+    if has_more:
+        # Live events would continue past the part of the backlog not replayed.
+        bus.unsubscribe(subscription)
+        return jsonify({'error': f'More than {MAX_CHANGES_PAGE_SIZE} changes missed; reload the board'}), 410
+    stream = event_stream(bus, subscription, backlog, current_app.config.get('EVENTS_HEARTBEAT', 15))
+    response = current_app.response_class(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @pipelines_bp.route('/pipelines/<int:pipeline_id>/stages/<int:stage_id>/negotiations', methods=['GET'])
 @login_required
 @pipeline_access_required
+@pipeline_etag
 def list_stage_negotiations(pipeline_id, stage_id):
-    stage = Stage.query.get_or_404(stage_id)
+    stage = live_stage_or_404(stage_id)
     if stage.pipeline_id != pipeline_id:
         return jsonify({'error': 'Invalid stage'}), 400
-    negotiations = Negotiation.query.filter_by(stage_id=stage_id).order_by(Negotiation.position).all()
-    return jsonify([{'id': n.id, 'title': n.title} for n in negotiations])
+    return negotiation_list([Negotiation.stage_id == stage_id], ('title',))
 
 
 @pipelines_bp.route('/negotiations/<int:negotiation_id>', methods=['GET'])
 @login_required
 def get_negotiation(negotiation_id):
-    negotiation = Negotiation.query.get_or_404(negotiation_id)
-    user = g.current_user
-    if negotiation.stage.pipeline.account_id != user.account_id:
+    owner = (db.session.query(Pipeline.account_id, Pipeline.version)
+             .join(Stage, Stage.pipeline_id == Pipeline.id)
+             .join(Negotiation, Negotiation.stage_id == Stage.id)
+             .filter(Negotiation.id == negotiation_id, Stage.deleted_at.is_(None), Pipeline.deleted_at.is_(None))
+             .first())
+    if owner is None:
+        abort(404)
+    if owner.account_id != g.current_user.account_id:
         return jsonify({'error': 'Forbidden'}), 403
-    return jsonify({'id': negotiation.id, 'title': negotiation.title,
-                    'stage_id': negotiation.stage_id, 'owner_id': negotiation.owner_id})
+    etag = make_etag('negotiation', owner.version)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    negotiation = db.session.get(Negotiation, negotiation_id)
+    return with_etag(jsonify({'id': negotiation.id, 'title': negotiation.title,
+                              'stage_id': negotiation.stage_id, 'owner_id': negotiation.owner_id}), etag)
 
 
 @pipelines_bp.route('/negotiations/<int:negotiation_id>', methods=['PUT'])
 @login_required
 def update_negotiation(negotiation_id):
-    negotiation = Negotiation.query.get_or_404(negotiation_id)
+    negotiation, pipeline_id, account_id = load_negotiation(negotiation_id)
     user = g.current_user
-    if not can_edit_negotiation(user, negotiation):
+    if not can_edit_negotiation(user, negotiation, account_id):
         return jsonify({'error': 'Forbidden'}), 403
     data = request.get_json() or {}
     title = data.get('title')
     if title:
         negotiation.title = title
+    record_change(pipeline_id, 'negotiation', negotiation.id, 'updated', {'title': negotiation.title})
+    bump_pipeline_versions(pipeline_id)
     db.session.commit()
     return jsonify({'id': negotiation.id, 'title': negotiation.title})
 
@@ -267,55 +764,153 @@ def update_negotiation(negotiation_id):
 @pipelines_bp.route('/negotiations/<int:negotiation_id>/move', methods=['POST'])
 @login_required
 def move_negotiation(negotiation_id):
-    negotiation = Negotiation.query.get_or_404(negotiation_id)
+    negotiation, old_pipeline_id, account_id = load_negotiation(negotiation_id)
     user = g.current_user
-    if not can_edit_negotiation(user, negotiation):
+    if not can_edit_negotiation(user, negotiation, account_id):
         return jsonify({'error': 'Forbidden'}), 403
     data = request.get_json() or {}
     new_stage_id = data.get('stage_id')
     position = data.get('position')
     if new_stage_id is None:
         return jsonify({'error': 'stage_id required'}), 400
-    new_stage = Stage.query.get_or_404(new_stage_id)
-    if new_stage.pipeline.account_id != user.account_id:
+    if position is not None and (not isinstance(position, int) or position < 1):
+        return jsonify({'error': 'Invalid position'}), 400
+    new_pipeline_id, new_account_id = load_stage_scope(new_stage_id)
+    if new_account_id != user.account_id:
         return jsonify({'error': 'Forbidden'}), 403
-    negotiation.stage_id = new_stage_id
     if position is not None:
-        if not isinstance(position, int) or position < 1:
-            return jsonify({'error': 'Invalid position'}), 400
-        Negotiation.query.filter(
-            Negotiation.stage_id == new_stage_id,
-            Negotiation.position >= position
-        ).update({
-            'position': Negotiation.position + 1
-        }, synchronize_session=False)
-        negotiation.position = position
+        new_position = position_at(new_stage_id, position, exclude_id=negotiation.id)
     else:
-        max_pos = db.session.query(db.func.max(Negotiation.position)).filter_by(stage_id=new_stage_id).scalar() or 0
-        negotiation.position = max_pos + 1
+        new_position = next_position(new_stage_id)
+    payload = {'from_stage_id': negotiation.stage_id, 'stage_id': new_stage_id, 'position': position}
+    negotiation.stage_id = new_stage_id
+    negotiation.position = new_position
+    for pid in {old_pipeline_id, new_pipeline_id}:
+        record_change(pid, 'negotiation', negotiation.id, 'moved', payload)
+    bump_pipeline_versions(old_pipeline_id, new_pipeline_id)
     db.session.commit()
-    return jsonify({'id': negotiation.id, 'stage_id': negotiation.stage_id})
+    return jsonify({'id': negotiation_id, 'stage_id': new_stage_id})
+
+
+MAX_BATCH_MOVES = 5000
+
+
+@pipelines_bp.route('/negotiations/move', methods=['POST'])
+@login_required
+def move_negotiations():
+    """Apply many moves in one transaction and report a result per item.
+
+    Permissions for every item are checked with two queries, positions for
+    all items come from one ``StagePlacement`` (at most two more queries and
+    one renumbering per crowded stage), and the changed rows are flushed
+    together.
+    """
+    data = request.get_json() or {}
+    moves = data.get('moves')
+    if not moves or not isinstance(moves, list):
+        return jsonify({'error': 'moves must be a list'}), 400
+    if len(moves) > MAX_BATCH_MOVES:
+        return jsonify({'error': f'At most {MAX_BATCH_MOVES} moves per request'}), 400
+    user = g.current_user
+
+    items = [m for m in moves if isinstance(m, dict)]
+    negotiation_ids = {m.get('negotiation_id') for m in items if is_id(m.get('negotiation_id'))}
+    stage_ids = {m.get('stage_id') for m in items if is_id(m.get('stage_id'))}
+    negotiations = {
+        n.id: (n, account_id, pipeline_id)
+        for n, account_id, pipeline_id in (
+            db.session.query(Negotiation, Pipeline.account_id, Stage.pipeline_id)
+            .outerjoin(Stage, Negotiation.stage_id == Stage.id)
+            .outerjoin(Pipeline, Stage.pipeline_id == Pipeline.id)
+            .filter(Negotiation.id.in_(negotiation_ids),
+                    Stage.deleted_at.is_(None), Pipeline.deleted_at.is_(None)))
+    }
+    stages = {
+        sid: (pipeline_id, account_id)
+        for sid, pipeline_id, account_id in (
+            db.session.query(Stage.id, Stage.pipeline_id, Pipeline.account_id)
+            .join(Pipeline, Stage.pipeline_id == Pipeline.id)
+            .filter(Stage.id.in_(stage_ids), Stage.deleted_at.is_(None), Pipeline.deleted_at.is_(None)))
+    }
+
+    results = []
+    accepted = []
+    seen = set()
+    for move in moves:
+        move = move if isinstance(move, dict) else {}
+        nid = move.get('negotiation_id')
+        stage_id = move.get('stage_id')
+        position = move.get('position')
+        result = {'negotiation_id': nid}
+        results.append(result)
+        if nid is None or stage_id is None:
+            result.update(status=400, error='negotiation_id and stage_id required')
+        elif not is_id(nid) or not is_id(stage_id):
+            result.update(status=400, error='negotiation_id and stage_id must be integers')
+        elif position is not None and (not isinstance(position, int) or position < 1):
+            result.update(status=400, error='Invalid position')
+        elif nid in seen:
+            result.update(status=400, error='Duplicate negotiation')
+        elif nid not in negotiations:
+            result.update(status=404, error='Negotiation not found')
+        elif stage_id not in stages:
+            result.update(status=404, error='Stage not found')
+        else:
+            negotiation, account_id, _ = negotiations[nid]
+            if (not can_edit_negotiation(user, negotiation, account_id) or
+                    stages[stage_id][1] != user.account_id):
+                result.update(status=403, error='Forbidden')
+            else:
+                accepted.append((negotiation, stage_id, position, result))
+        if is_id(nid):
+            seen.add(nid)
+
+    placement = StagePlacement({stage_id for _, stage_id, position, _ in accepted if position is not None},
+                               {stage_id for _, stage_id, _, _ in accepted})
+    touched = set()
+    changes = []
+    for negotiation, stage_id, position, result in accepted:
+        old_pipeline_id = negotiations[negotiation.id][2]
+        touched.add(old_pipeline_id)
+        touched.add(stages[stage_id][0])
+        payload = {'from_stage_id': negotiation.stage_id, 'stage_id': stage_id, 'position': position}
+        changes.extend({'pipeline_id': pid, 'entity': 'negotiation', 'entity_id': negotiation.id,
+                        'action': 'moved', 'payload': payload}
+                       for pid in {old_pipeline_id, stages[stage_id][0]})
+        placement.remove(negotiation.stage_id, negotiation.position, negotiation.id)
+        negotiation.position = placement.place(negotiation.id, stage_id, position)
+        negotiation.stage_id = stage_id
+        result.update(status=200, stage_id=stage_id)
+    if accepted:
+        placement.finish([negotiation for negotiation, _, _, _ in accepted])
+        record_changes(changes)
+        bump_pipeline_versions(*touched)
+        db.session.commit()
+    return jsonify({'results': results})
 
 
 @pipelines_bp.route('/stages/<int:stage_id>/negotiations/reorder', methods=['POST'])
 @login_required
 def reorder_negotiations(stage_id):
-    stage = Stage.query.get_or_404(stage_id)
+    pipeline_id, account_id = load_stage_scope(stage_id)
     user = g.current_user
-    if stage.pipeline.account_id != user.account_id:
+    if account_id != user.account_id:
         return jsonify({'error': 'Forbidden'}), 403
     data = request.get_json() or {}
     ids = data.get('negotiation_ids')
-    if not ids or not isinstance(ids, list):
-        return jsonify({'error': 'negotiation_ids must be a list'}), 400
-    negotiations = Negotiation.query.filter(Negotiation.id.in_(ids), Negotiation.stage_id == stage_id).all()
-    if len(negotiations) != len(ids):
+    if not ids or not isinstance(ids, list) or not all(is_id(i) for i in ids):
+        return jsonify({'error': 'negotiation_ids must be a list of integers'}), 400
+    owners = (db.session.query(Negotiation.owner_id)
+              .filter(Negotiation.id.in_(ids), Negotiation.stage_id == stage_id)
+              .all())
+    if len(owners) != len(ids):
         return jsonify({'error': 'Invalid negotiations'}), 400
     if user.role != 'supervisor':
-        if any(n.owner_id != user.user_id for n in negotiations):
+        if any(owner_id != user.user_id for (owner_id,) in owners):
             return jsonify({'error': 'Forbidden'}), 403
-    for pos, nid in enumerate(ids, start=1):
-        Negotiation.query.filter_by(id=nid).update({'position': pos})
+    set_positions(Negotiation.__table__, ids, step=POSITION_GAP)
+    record_change(pipeline_id, 'stage', stage_id, 'negotiations_reordered', {'negotiation_ids': ids})
+    bump_pipeline_versions(pipeline_id)
     db.session.commit()
     return '', 204
 
@@ -323,75 +918,62 @@ def reorder_negotiations(stage_id):
 @pipelines_bp.route('/pipelines/<int:pipeline_id>/kpis', methods=['GET'])
 @login_required
 @pipeline_access_required
+@pipeline_etag
+@cached_response
 def pipeline_kpis(pipeline_id):
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    seller_id = request.args.get('seller_id')
+    try:
+        query = parse_kpi_args(request.args)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify(summarize_kpis(kpi_rows(pipeline_id, query)))
 
-    query = (Negotiation.query
-             .join(Stage)
-             .filter(Stage.pipeline_id == pipeline_id))
 
-    if seller_id:
-        query = query.filter(Negotiation.owner_id == int(seller_id))
-
-    if start_date:
-        try:
-            start_dt = datetime.fromisoformat(start_date)
-        except ValueError:
-            return jsonify({'error': 'Invalid start_date'}), 400
-        query = query.filter(Negotiation.created_at >= start_dt)
+@pipelines_bp.route('/kpis', methods=['GET'])
+@login_required
+@accessible_pipelines_etag
+def account_kpis():
+    """KPIs of every accessible pipeline, or of ``pipeline_ids``, in one response.
+
+    Uses the same rollup and edge queries as ``/pipelines/<id>/kpis``, run
+    once over all the pipelines and grouped by pipeline.
+    """
+    try:
+        query = parse_kpi_args(request.args)
+        top, requested = parse_account_kpi_args(request.args)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    pipelines = (accessible_pipelines_query(g.current_user)
+                 .with_entities(Pipeline.id, Pipeline.name)
+                 .order_by(Pipeline.position, Pipeline.id).all())
+    if requested is not None:
+        if not requested <= {pid for pid, _ in pipelines}:
+            return jsonify({'error': 'Forbidden'}), 403
+        pipelines = [(pid, name) for pid, name in pipelines if pid in requested]
+    rows = kpi_rows([pid for pid, _ in pipelines], query, by_pipeline=True) if pipelines else []
+    return jsonify(summarize_account_kpis(pipelines, rows, top))
 
-    if end_date:
-        try:
-            end_dt = datetime.fromisoformat(end_date)
-        except ValueError:
-            return jsonify({'error': 'Invalid end_date'}), 400
-        query = query.filter(Negotiation.created_at <= end_dt)
-
-    total_value = query.with_entities(db.func.coalesce(db.func.sum(Negotiation.value), 0)).scalar() or 0
-    total_open = query.filter(Negotiation.status == 'open').count()
-    total_count = query.count()
-    won_count = query.filter(Negotiation.status == 'won').count()
-    win_rate = won_count / total_count if total_count else 0
-
-    deals_per_stage = (
-        db.session.query(Stage.name, db.func.count(Negotiation.id))
-        .join(Negotiation)
-        .filter(Stage.pipeline_id == pipeline_id)
-    )
-    if seller_id:
-        deals_per_stage = deals_per_stage.filter(Negotiation.owner_id == int(seller_id))
-    if start_date:
-        deals_per_stage = deals_per_stage.filter(Negotiation.created_at >= start_dt)
-    if end_date:
-        deals_per_stage = deals_per_stage.filter(Negotiation.created_at <= end_dt)
-    deals_per_stage = deals_per_stage.group_by(Stage.name).all()
-    deals_per_stage = [{'stage': name, 'count': count} for name, count in deals_per_stage]
-
-    value_per_seller = (
-        db.session.query(User.user_id, User.user_name, db.func.coalesce(db.func.sum(Negotiation.value), 0))
-        .join(Negotiation, Negotiation.owner_id == User.user_id)
-        .join(Stage, Negotiation.stage_id == Stage.id)
-        .filter(Stage.pipeline_id == pipeline_id)
-    )
-    if start_date:
-        value_per_seller = value_per_seller.filter(Negotiation.created_at >= start_dt)
-    if end_date:
-        value_per_seller = value_per_seller.filter(Negotiation.created_at <= end_dt)
-    if seller_id:
-        value_per_seller = value_per_seller.filter(User.user_id == int(seller_id))
-    value_per_seller = value_per_seller.group_by(User.user_id, User.user_name).all()
-    value_per_seller = [
-        {'seller_id': uid, 'seller_name': uname, 'value': float(val)}
-        for uid, uname, val in value_per_seller
-    ]
-
-    return jsonify({
-        'total_value': float(total_value),
-        'open_deals': total_open,
-        'win_rate': win_rate,
-        'deals_per_stage': deals_per_stage,
-        'value_per_seller': value_per_seller
-    })
 
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/kpis/series', methods=['GET'])
+@login_required
+@pipeline_access_required
+@pipeline_etag
+@cached_response
+def pipeline_kpi_series(pipeline_id):
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in SERIES_BUCKETS:
+        return jsonify({'error': f'bucket must be one of {", ".join(SERIES_BUCKETS)}'}), 400
+    try:
+        query = parse_kpi_args(request.args)
+        series = kpi_series(pipeline_id, query, bucket)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'bucket': bucket, 'series': series})
+
+
+@pipelines_bp.route('/pipelines/<int:pipeline_id>/funnel', methods=['GET'])
+@login_required
+@pipeline_access_required
+@pipeline_etag
+@cached_response
+def pipeline_funnel_report(pipeline_id):
+    return jsonify(pipeline_funnel(pipeline_id))
@@ -0,0 +1,153 @@
+"""Funnel and velocity analytics over ``stage_transitions``.
+
+Transitions are read as plain columns in ``yield_per`` partitions and packed
+into NumPy arrays; every metric is then computed with vectorised operations
+over the whole history, so the Python-level work grows with the number of
+stages and sellers rather than with the number of rows.
+"""
+import numpy as np
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from .. import db
+from ..models import Stage, StageTransition, User
+
+# Rows fetched per round trip while loading transitions.
+ANALYTICS_PARTITION_SIZE = 100000
+DWELL_PERCENTILES = (50, 90)
+
+
+class epoch_of(FunctionElement):
+    """Seconds since the Unix epoch of a timestamp column."""
+    type = db.Float()
+    inherit_cache = True
+
+
+@compiles(epoch_of)
+def _epoch_of_default(element, compiler, **kw):
+    return 'EXTRACT(EPOCH FROM %s)' % compiler.process(element.clauses, **kw)
+
+
+@compiles(epoch_of, 'sqlite')
+def _epoch_of_sqlite(element, compiler, **kw):
+    return "CAST(strftime('%%s', %s) AS REAL)" % compiler.process(element.clauses, **kw)
+
+
+def load_transitions(pipeline_id):
+    """Return ``(negotiation_ids, stage_ids, owner_ids, seconds)`` arrays.
+
+    Rows are ordered by negotiation and time; a missing owner is ``0``.
+    """
+    stmt = (db.select(StageTransition.negotiation_id, StageTransition.to_stage_id,
+                      db.func.coalesce(StageTransition.owner_id, 0),
+                      epoch_of(StageTransition.moved_at))
+            .where(StageTransition.pipeline_id == pipeline_id)
+            .order_by(StageTransition.negotiation_id, StageTransition.moved_at, StageTransition.id)
+            .execution_options(yield_per=ANALYTICS_PARTITION_SIZE))
+    # Row objects are not tuples; NumPy converts plain tuples far faster.
+    parts = [np.array([tuple(row) for row in rows], dtype=np.float64)
+             for rows in db.session.execute(stmt).partitions()]
+    table = np.concatenate(parts) if parts else np.empty((0, 4))
+    ids, stages, owners = (table[:, i].astype(np.int64) for i in range(3))
+    return ids, stages, owners, table[:, 3]
+
+
+def _group_percentiles(groups, values, size):
+    """Percentiles of non-negative ``values`` per integer group in ``range(size)``.
+
+    Each value is offset by ``group * span`` so a single ``np.sort`` orders
+    the groups and the values inside them; every percentile is then
+    interpolated linearly (NumPy's default method) with array indexing.
+    Returns an array of shape ``(size, len(DWELL_PERCENTILES))`` with NaN
+    for empty groups.
+    """
+    result = np.full((size, len(DWELL_PERCENTILES)), np.nan)
+    if not len(values):
+        return result
+    span = values.max() + 1
+    keyed = np.sort(groups * span + values)
+    bounds = np.searchsorted(keyed, np.arange(size + 1) * span)
+    counts = np.diff(bounds)
+    present = np.flatnonzero(counts)
+    positions = (bounds[present, None]
+                 + np.array(DWELL_PERCENTILES) / 100 * (counts[present, None] - 1))
+    low = np.floor(positions).astype(np.int64)
+    high = np.ceil(positions).astype(np.int64)
+    offset = present[:, None] * span
+    result[present] = (keyed[low] - offset) + (keyed[high] - keyed[low]) * (positions - low)
+    return result
+
+
+def _hours(seconds):
+    return None if np.isnan(seconds) else round(float(seconds) / 3600, 2)
+
+
+def funnel_metrics(stages, ids, stage_ids, owner_ids, seconds):
+    """Compute funnel, dwell and seller velocity from transition arrays.
+
+    ``stages`` is the pipeline's ordered ``(id, name)`` list; transitions
+    into stages that no longer exist are ignored.  A negotiation counts as
+    having reached every stage up to the furthest one it ever entered.
+    Dwell only covers completed stays, i.e. the time between entering a
+    stage and the next transition of the same negotiation.
+    """
+    size = len(stages)
+    rank_of = np.full(max((sid for sid, _ in stages), default=0) + 1, -1, dtype=np.int64)
+    rank_of[[sid for sid, _ in stages]] = np.arange(size)
+    known = stage_ids < len(rank_of)
+    ranks = np.full(len(stage_ids), -1, dtype=np.int64)
+    ranks[known] = rank_of[stage_ids[known]]
+    keep = ranks >= 0
+    ids, ranks, owner_ids, seconds = ids[keep], ranks[keep], owner_ids[keep], seconds[keep]
+
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.empty(0, dtype=np.int64)
+    furthest = np.maximum.reduceat(ranks, starts) if len(ids) else np.empty(0, dtype=np.int64)
+    reached = np.bincount(furthest, minlength=size)[::-1].cumsum()[::-1]
+    entered = np.bincount(ranks, minlength=size)
+
+    # Step i -> i + 1 within one negotiation: time spent in the stage
+    # entered at row i, attributed to the owner at that point.
+    same = ids[1:] == ids[:-1]
+    dwell = (seconds[1:] - seconds[:-1])[same]
+    from_rank = ranks[:-1][same]
+    advanced = ranks[1:][same] > from_rank
+    mover = owner_ids[:-1][same]
+    dwell_pct = _group_percentiles(from_rank, dwell, size)
+
+    stage_rows = []
+    for rank, (stage_id, name) in enumerate(stages):
+        following = reached[rank + 1] if rank + 1 < size else None
+        stage_rows.append({
+            'stage_id': stage_id,
+            'name': name,
+            'entered': int(entered[rank]),
+            'reached': int(reached[rank]),
+            'conversion': (round(float(following / reached[rank]), 4)
+                           if following is not None and reached[rank] else None),
+            'dwell_hours': {f'p{p}': _hours(v) for p, v in zip(DWELL_PERCENTILES, dwell_pct[rank])},
+        })
+
+    sellers, seller_index = np.unique(mover, return_inverse=True)
+    moves = np.bincount(seller_index, minlength=len(sellers))
+    advances = np.bincount(seller_index, weights=advanced, minlength=len(sellers))
+    median = _group_percentiles(seller_index, dwell, len(sellers))[:, 0]
+    seller_rows = [
+        {'seller_id': int(seller) or None, 'moves': int(moves[i]), 'advances': int(advances[i]),
+         'median_hours_per_move': _hours(median[i])}
+        for i, seller in enumerate(sellers)
+    ]
+    return {'deals': int(len(starts)), 'stages': stage_rows, 'sellers': seller_rows}
+
+
+def pipeline_funnel(pipeline_id):
+    """Funnel, dwell and seller velocity for one pipeline."""
+    stages = [(sid, name) for sid, name in db.session.query(Stage.id, Stage.name)
+              .filter(Stage.pipeline_id == pipeline_id, Stage.deleted_at.is_(None))
+              .order_by(Stage.position, Stage.id)]
+    result = funnel_metrics(stages, *load_transitions(pipeline_id))
+    seller_ids = [row['seller_id'] for row in result['sellers'] if row['seller_id']]
+    names = dict(db.session.query(User.user_id, User.user_name)
+                 .filter(User.user_id.in_(seller_ids))) if seller_ids else {}
+    for row in result['sellers']:
+        row['seller_name'] = names.get(row['seller_id'])
+    return result
@@ -0,0 +1,108 @@
+"""Append-only change feed for incremental board sync.
+
+Mutating endpoints call ``record_change`` (or ``record_changes`` for bulk
+writes) before committing, so each entry lands in the same transaction as
+the change it describes.  Clients poll ``/pipelines/<id>/changes?since=``
+with the last ``seq`` they applied.  Compaction drops old entries and
+raises the pipeline's ``changes_floor``; a client behind the floor gets a
+410 and reloads the board.
+"""
+from datetime import datetime, timedelta
+
+from .. import db
+from ..models import ChangeLog, Pipeline
+
+CHANGES_PAGE_SIZE = 500
+MAX_CHANGES_PAGE_SIZE = 1000
+# Rows deleted per statement when compacting.
+COMPACT_CHUNK = 10000
+
+
+class ChangesGone(Exception):
+    """The requested ``since`` predates the retained change log."""
+
+
+def negotiation_payload(negotiation):
+    return {'title': negotiation.title, 'stage_id': negotiation.stage_id,
+            'owner_id': negotiation.owner_id, 'value': float(negotiation.value or 0),
+            'status': negotiation.status}
+
+
+def record_change(pipeline_id, entity, entity_id, action, payload=None):
+    db.session.info['changes_recorded'] = True
+    db.session.add(ChangeLog(pipeline_id=pipeline_id, entity=entity, entity_id=entity_id,
+                             action=action, payload=payload))
+
+
+def record_changes(entries):
+    """Insert many change entries (dicts of ``ChangeLog`` columns) at once."""
+    if entries:
+        db.session.info['changes_recorded'] = True
+        db.session.execute(ChangeLog.__table__.insert(), entries)
+
+
+def serialize_change(row):
+    return {'seq': row.seq, 'entity': row.entity, 'entity_id': row.entity_id,
+            'action': row.action, 'payload': row.payload,
+            'created_at': row.created_at.isoformat()}
+
+
+def latest_seqs(pipelines):
+    """Map each pipeline's id to the newest ``seq`` in its feed.
+
+    A pipeline without retained entries maps to its ``changes_floor``, which
+    is still a valid ``since``.
+    """
+    seqs = {p.id: p.changes_floor for p in pipelines}
+    if seqs:
+        rows = (db.session.query(ChangeLog.pipeline_id, db.func.max(ChangeLog.seq))
+                .filter(ChangeLog.pipeline_id.in_(list(seqs)))
+                .group_by(ChangeLog.pipeline_id))
+        for pipeline_id, seq in rows:
+            seqs[pipeline_id] = max(seq, seqs[pipeline_id])
+    return seqs
+
+
+def changes_since(pipeline, since, limit=CHANGES_PAGE_SIZE):
+    """Return ``(changes, has_more)`` for entries of ``pipeline`` after ``since``.
+
+    Raises ``ChangesGone`` if compaction already removed entries the client
+    has not seen.
+    """
+    if since < pipeline.changes_floor:
+        raise ChangesGone()
+    rows = db.session.execute(
+        db.select(ChangeLog.seq, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.action,
+                  ChangeLog.payload, ChangeLog.created_at)
+        .where(ChangeLog.pipeline_id == pipeline.id, ChangeLog.seq > since)
+        .order_by(ChangeLog.seq)
+        .limit(limit + 1)).all()
+    return [serialize_change(row) for row in rows[:limit]], len(rows) > limit
+
+
+def compact_changes(older_than_days):
+    """Delete entries older than ``older_than_days`` in bounded chunks.
+
+    Each pipeline's ``changes_floor`` is raised to the newest seq removed
+    from its feed before the rows go.  Returns the number of rows deleted.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    last_seq = db.session.query(db.func.max(ChangeLog.seq)).filter(ChangeLog.created_at < cutoff).scalar()
+    if last_seq is None:
+        return 0
+    floors = (db.session.query(ChangeLog.pipeline_id, db.func.max(ChangeLog.seq))
+              .filter(ChangeLog.seq <= last_seq)
+              .group_by(ChangeLog.pipeline_id))
+    for pipeline_id, seq in floors.all():
+        Pipeline.query.filter(Pipeline.id == pipeline_id, Pipeline.changes_floor < seq).update(
+            {'changes_floor': seq}, synchronize_session=False)
+    db.session.commit()
+    table = ChangeLog.__table__
+    deleted = 0
+    while True:
+        chunk = db.select(table.c.seq).where(table.c.seq <= last_seq).order_by(table.c.seq).limit(COMPACT_CHUNK)
+        count = db.session.execute(table.delete().where(table.c.seq.in_(chunk))).rowcount
+        db.session.commit()
+        deleted += count
+        if count < COMPACT_CHUNK:
+            return deleted
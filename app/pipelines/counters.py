@@ -0,0 +1,103 @@
+"""Per-stage column totals: ``deal_count``, ``deal_value_sum`` and ``open_count``.
+
+The counters move with the KPI rollup deltas (see ``rollups.apply_deltas``),
+so every write path that keeps the rollups right keeps them right as well,
+in the same transaction.  ``verify_counters`` and ``reconcile_counters``
+recompute them from the raw negotiations.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import bindparam
+
+from .. import db
+from ..models import Negotiation, Pipeline, Stage
+
+# Stages recomputed per UPDATE by ``reconcile_counters``.
+RECONCILE_CHUNK = 1000
+
+
+def stage_deltas(deltas):
+    """Fold rollup deltas (bucket -> [count, value]) into per-stage totals."""
+    totals = defaultdict(lambda: [0, Decimal(0), 0])
+    for (stage_id, _owner, status, _day), (count, value) in deltas.items():
+        entry = totals[stage_id]
+        entry[0] += count
+        entry[1] += value
+        if status == 'open':
+            entry[2] += count
+    return {stage_id: entry for stage_id, entry in totals.items() if any(entry)}
+
+
+def apply_stage_deltas(connection, deltas):
+    """Add rollup ``deltas`` to the stage counters with relative updates.
+
+    Stages are updated in id order so concurrent transactions lock their
+    rows in the same order.
+    """
+    totals = stage_deltas(deltas)
+    if not totals:
+        return
+    table = Stage.__table__
+    connection.execute(
+        table.update().where(table.c.id == bindparam('b_id')).values(
+            deal_count=table.c.deal_count + bindparam('b_count'),
+            deal_value_sum=table.c.deal_value_sum + bindparam('b_value'),
+            open_count=table.c.open_count + bindparam('b_open')),
+        [{'b_id': stage_id, 'b_count': count, 'b_value': value, 'b_open': open_count}
+         for stage_id, (count, value, open_count) in sorted(totals.items())])
+
+
+def _raw_counters():
+    is_open = db.case((Negotiation.status == 'open', 1), else_=0)
+    return (db.select(Negotiation.stage_id.label('stage_id'),
+                      db.func.count(Negotiation.id).label('deal_count'),
+                      db.func.coalesce(db.func.sum(Negotiation.value), 0).label('deal_value_sum'),
+                      db.func.coalesce(db.func.sum(is_open), 0).label('open_count'))
+            .where(Negotiation.stage_id.isnot(None))
+            .group_by(Negotiation.stage_id))
+
+
+def verify_counters():
+    """Return ``(stage_id, expected, actual)`` for every live stage whose counters drifted.
+
+    Values are ``(deal_count, deal_value_sum, open_count)`` triples.
+    """
+    def totals(row):
+        return (row.deal_count, round(Decimal(str(row.deal_value_sum)), 2), row.open_count)
+
+    expected = {row.stage_id: totals(row) for row in db.session.execute(_raw_counters())}
+    zero = (0, Decimal('0.00'), 0)
+    drift = []
+    for row in db.session.execute(db.select(Stage.id.label('stage_id'), Stage.deal_count,
+                                            Stage.deal_value_sum, Stage.open_count)
+                                  .where(Stage.deleted_at.is_(None)).order_by(Stage.id)):
+        actual = totals(row)
+        if expected.get(row.stage_id, zero) != actual:
+            drift.append((row.stage_id, expected.get(row.stage_id, zero), actual))
+    return drift
+
+
+def reconcile_counters(stage_ids):
+    """Recompute the counters of ``stage_ids`` from their negotiations.
+
+    Stages are fixed ``RECONCILE_CHUNK`` at a time, one commit per chunk;
+    the owning pipelines' versions are bumped in the same commit so cached
+    responses stop serving the drifted totals.
+    """
+    table = Stage.__table__
+    for offset in range(0, len(stage_ids), RECONCILE_CHUNK):
+        chunk = stage_ids[offset:offset + RECONCILE_CHUNK]
+        raw = _raw_counters().where(Negotiation.stage_id.in_(chunk)).subquery()
+
+        def recomputed(column):
+            return db.func.coalesce(
+                db.select(raw.c[column]).where(raw.c.stage_id == table.c.id).scalar_subquery(), 0)
+
+        db.session.execute(table.update().where(table.c.id.in_(chunk)).values(
+            deal_count=recomputed('deal_count'),
+            deal_value_sum=recomputed('deal_value_sum'),
+            open_count=recomputed('open_count')))
+        Pipeline.query.filter(Pipeline.id.in_(db.select(Stage.pipeline_id).where(Stage.id.in_(chunk)))).update(
+            {'version': Pipeline.version + 1}, synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,51 @@
+"""Streaming export of a pipeline's negotiations.
+
+Rows come from a column-only query executed with ``yield_per`` so the
+driver uses a server-side cursor where it can (psycopg2) and only one
+partition of rows is held in memory at a time.
+"""
+import csv
+import io
+import json
+
+from .. import db
+from ..models import Negotiation, Stage
+from .listing import PAGE_KEY, plain_value
+
+EXPORT_COLUMNS = ('id', 'title', 'stage_id', 'stage', 'position', 'owner_id',
+                  'value', 'status', 'created_at', 'closed_at')
+EXPORT_BATCH_SIZE = 1000
+
+
+def _export_query(pipeline_id):
+    return (db.select(Negotiation.id, Negotiation.title, Negotiation.stage_id, Stage.name,
+                      Negotiation.position, Negotiation.owner_id, Negotiation.value,
+                      Negotiation.status, Negotiation.created_at, Negotiation.closed_at)
+            .join(Stage, Negotiation.stage_id == Stage.id)
+            .where(Stage.pipeline_id == pipeline_id, Stage.deleted_at.is_(None))
+            .order_by(*PAGE_KEY)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE))
+
+
+def iter_partitions(pipeline_id):
+    """Yield lists of export rows as plain Python values."""
+    result = db.session.execute(_export_query(pipeline_id))
+    for partition in result.partitions():
+        yield [[plain_value(v) for v in row] for row in partition]
+
+
+def generate_ndjson(pipeline_id):
+    for rows in iter_partitions(pipeline_id):
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+
+
+def generate_csv(pipeline_id):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue()
+    for rows in iter_partitions(pipeline_id):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
@@ -0,0 +1,201 @@
+"""Negotiation creation and streaming bulk import.
+
+Imports read the request body incrementally, resolve stage names and owner
+ids through lookup maps built once per request and write rows with batched
+multi-row INSERTs, so memory stays bounded whatever the size of the file.
+"""
+import codecs
+import csv
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from .. import db
+from ..models import Negotiation, Stage, User
+from .changes import record_changes
+from .ordering import POSITION_GAP
+from .rollups import add_delta, apply_deltas, new_deltas
+from .transitions import record_transitions
+
+STATUSES = ('open', 'won', 'lost')
+# Negotiation.value is NUMERIC(10, 2).
+MAX_VALUE = Decimal(10) ** 8
+IMPORT_BATCH_SIZE = 1000
+# Per-row errors echoed back to the client; the total is always reported.
+MAX_REPORTED_ERRORS = 100
+
+
+class NegotiationLookups:
+    """Stage and owner maps for one pipeline, loaded once per request."""
+
+    def __init__(self, pipeline):
+        stages = (db.session.query(Stage.id, Stage.name)
+                  .filter(Stage.pipeline_id == pipeline.id, Stage.deleted_at.is_(None)).all())
+        self.stage_ids = {sid for sid, _ in stages}
+        self.stages_by_name = {name: sid for sid, name in stages}
+        self.owner_ids = {uid for (uid,) in db.session.query(User.user_id)
+                          .filter(User.account_id == pipeline.account_id)}
+
+    def resolve_stage(self, record):
+        if record.get('stage_id') not in (None, ''):
+            try:
+                stage_id = int(record['stage_id'])
+            except (TypeError, ValueError):
+                raise ValueError('Invalid stage_id') from None
+            if stage_id not in self.stage_ids:
+                raise ValueError('Unknown stage_id')
+            return stage_id
+        name = record.get('stage')
+        if not name:
+            raise ValueError('stage or stage_id required')
+        if name not in self.stages_by_name:
+            raise ValueError(f'Unknown stage: {name}')
+        return self.stages_by_name[name]
+
+    def resolve_owner(self, record, default=None):
+        owner_id = record.get('owner_id')
+        if owner_id in (None, ''):
+            return default
+        try:
+            owner_id = int(owner_id)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid owner_id') from None
+        if owner_id not in self.owner_ids:
+            raise ValueError('Unknown owner_id')
+        return owner_id
+
+
+def parse_negotiation(record, lookups, default_owner=None):
+    """Validate one incoming record and return column values for it.
+
+    Raises ``ValueError`` with a client-facing message on invalid input.
+    """
+    title = record.get('title')
+    if not title or not isinstance(title, str):
+        raise ValueError('Missing title')
+    if len(title) > 120:
+        raise ValueError('title longer than 120 characters')
+    status = record.get('status') or 'open'
+    if status not in STATUSES:
+        raise ValueError(f'status must be one of {", ".join(STATUSES)}')
+    try:
+        value = Decimal(str(record.get('value') or 0))
+    except InvalidOperation:
+        raise ValueError('Invalid value') from None
+    if not value.is_finite() or abs(value) >= MAX_VALUE:
+        raise ValueError('Invalid value')
+    created_at = record.get('created_at')
+    if created_at:
+        try:
+            created_at = datetime.fromisoformat(created_at)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid created_at') from None
+    else:
+        created_at = datetime.utcnow()
+    return {
+        'title': title,
+        'stage_id': lookups.resolve_stage(record),
+        'owner_id': lookups.resolve_owner(record, default_owner),
+        'value': value,
+        'status': status,
+        'created_at': created_at,
+        'closed_at': created_at if status != 'open' else None,
+    }
+
+
+def iter_lines(stream, chunk_size=64 * 1024):
+    """Yield decoded lines from a binary stream without reading it whole."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        pending += decoder.decode(chunk or b'', final=not chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line + '\n'
+        if not chunk:
+            if pending:
+                yield pending
+            return
+
+
+def iter_records(lines, fmt):
+    """Yield ``(line_number, record_or_error)`` pairs from NDJSON or CSV lines."""
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield number, ValueError('Invalid JSON')
+            continue
+        if not isinstance(record, dict):
+            yield number, ValueError('Each line must be a JSON object')
+            continue
+        yield number, record
+
+
+def import_negotiations(pipeline, records, default_owner=None, on_batch=None):
+    """Insert ``records`` into ``pipeline`` in batches and summarise the result.
+
+    Rows are appended to their stage.  Each batch updates rollups and stage
+    transitions and adds one ``imported`` change log entry listing its ids,
+    then calls ``on_batch``, which lets the caller commit batch by batch so
+    a large file never holds one long transaction.
+    """
+    lookups = NegotiationLookups(pipeline)
+    last_position = dict(
+        db.session.query(Negotiation.stage_id, db.func.max(Negotiation.position))
+        .filter(Negotiation.stage_id.in_(lookups.stage_ids))
+        .group_by(Negotiation.stage_id)
+        .all()
+    ) if lookups.stage_ids else {}
+    table = Negotiation.__table__
+    created = failed = 0
+    errors = []
+    batch = []
+
+    def flush():
+        deltas = new_deltas()
+        for row in batch:
+            add_delta(deltas, row, 1)
+        ids = db.session.execute(
+            table.insert().returning(table.c.id, sort_by_parameter_order=True), batch).scalars().all()
+        apply_deltas(db.session.connection(), deltas)
+        record_transitions(db.session.connection(), [
+            {'negotiation_id': nid, 'from_stage_id': None, 'to_stage_id': row['stage_id'],
+             'owner_id': row['owner_id'], 'moved_at': row['created_at']}
+            for nid, row in zip(ids, batch)])
+        record_changes([
+            {'pipeline_id': pipeline.id, 'entity': 'pipeline', 'entity_id': pipeline.id, 'action': 'imported',
+             'payload': {'negotiation_ids': ids,
+                         'stage_ids': sorted({row['stage_id'] for row in batch})}}])
+        batch.clear()
+        if on_batch is not None:
+            on_batch()
+
+    for number, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            row = parse_negotiation(record, lookups, default_owner)
+        except ValueError as exc:
+            failed += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'line': number, 'error': str(exc)})
+            continue
+        position = (last_position.get(row['stage_id']) or 0) + POSITION_GAP
+        last_position[row['stage_id']] = position
+        row['position'] = position
+        batch.append(row)
+        created += 1
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    return {'created': created, 'failed': failed, 'errors': errors}
@@ -0,0 +1,314 @@
+"""KPI aggregation over negotiations.
+
+Whole days inside the requested range are answered from ``kpi_rollups``;
+only the partial days at either edge of the range read raw negotiations.
+Time series are grouped from the daily rollup buckets alone.
+"""
+import heapq
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from .. import db
+from ..models import KpiRollup, Negotiation, Stage, User
+
+KpiQuery = namedtuple('KpiQuery', ['seller_id', 'start', 'end'])
+SERIES_BUCKETS = ('day', 'week', 'month')
+# Buckets returned by one series request, gaps included.
+MAX_SERIES_BUCKETS = 1000
+DEFAULT_TOP_SELLERS = 10
+MAX_TOP_SELLERS = 100
+
+
+def parse_kpi_args(args):
+    """Read ``seller_id``, ``start_date`` and ``end_date`` from a query string.
+
+    Raises ``ValueError`` with a client-facing message on invalid input.
+    """
+    seller_id = args.get('seller_id')
+    if seller_id:
+        try:
+            seller_id = int(seller_id)
+        except ValueError:
+            raise ValueError('Invalid seller_id') from None
+    start = end = None
+    if args.get('start_date'):
+        try:
+            start = datetime.fromisoformat(args['start_date'])
+        except ValueError:
+            raise ValueError('Invalid start_date') from None
+    if args.get('end_date'):
+        try:
+            end = datetime.fromisoformat(args['end_date'])
+        except ValueError:
+            raise ValueError('Invalid end_date') from None
+    return KpiQuery(seller_id or None, start, end)
+
+
+def parse_account_kpi_args(args):
+    """Read ``top`` and the optional comma-separated ``pipeline_ids`` filter.
+
+    Raises ``ValueError`` with a client-facing message on invalid input.
+    """
+    top = args.get('top') or DEFAULT_TOP_SELLERS
+    try:
+        top = int(top)
+    except ValueError:
+        raise ValueError('Invalid top') from None
+    if not 1 <= top <= MAX_TOP_SELLERS:
+        raise ValueError(f'top must be between 1 and {MAX_TOP_SELLERS}')
+    pipeline_ids = None
+    if args.get('pipeline_ids'):
+        try:
+            pipeline_ids = {int(pid) for pid in args['pipeline_ids'].split(',')}
+        except ValueError:
+            raise ValueError('Invalid pipeline_ids') from None
+    return top, pipeline_ids
+
+
+def _midnight(day):
+    return datetime.combine(day, time.min)
+
+
+def split_range(start, end):
+    """Split the inclusive ``[start, end]`` range into rollup days and raw edges.
+
+    Returns ``(days, edges)``: ``days`` is a ``(first, stop)`` pair of dates
+    (either may be ``None`` for an open bound, ``stop`` is exclusive) or
+    ``None`` when no whole day is covered; ``edges`` is a list of filter
+    clause lists on ``Negotiation.created_at``.
+    """
+    first = None
+    if start is not None:
+        first = start.date() if start == _midnight(start.date()) else start.date() + timedelta(days=1)
+    stop = end.date() if end is not None else None
+    if first is not None and stop is not None and first >= stop:
+        edge = [Negotiation.created_at >= start, Negotiation.created_at <= end]
+        return None, [edge]
+    edges = []
+    if start is not None and start != _midnight(first):
+        edges.append([Negotiation.created_at >= start, Negotiation.created_at < _midnight(first)])
+    if end is not None:
+        edges.append([Negotiation.created_at >= _midnight(stop), Negotiation.created_at <= end])
+    return (first, stop), edges
+
+
+def _pipeline_scope(column, pipelines):
+    """Filter ``column`` on one pipeline id or on a collection of them."""
+    return column == pipelines if isinstance(pipelines, int) else column.in_(pipelines)
+
+
+def raw_kpi_rows(pipelines, query, filters=(), by_pipeline=False):
+    """Aggregate raw negotiations of one or more pipelines in a single scan.
+
+    Returns one row per (stage name, owner) with the deal count, summed value
+    and open/won counts computed as conditional aggregates.  With
+    ``by_pipeline`` each row starts with its pipeline id.
+    """
+    keys = [Stage.pipeline_id] if by_pipeline else []
+    is_open = db.case((Negotiation.status == 'open', 1), else_=0)
+    is_won = db.case((Negotiation.status == 'won', 1), else_=0)
+    q = (db.session.query(*keys, Stage.name, Negotiation.owner_id, User.user_name,
+                          db.func.count(Negotiation.id),
+                          db.func.coalesce(db.func.sum(Negotiation.value), 0),
+                          db.func.sum(is_open),
+                          db.func.sum(is_won))
+         .join(Stage, Negotiation.stage_id == Stage.id)
+         .outerjoin(User, Negotiation.owner_id == User.user_id)
+         .filter(_pipeline_scope(Stage.pipeline_id, pipelines), Stage.deleted_at.is_(None), *filters))
+    if query.seller_id:
+        q = q.filter(Negotiation.owner_id == query.seller_id)
+    return q.group_by(*keys, Stage.name, Negotiation.owner_id, User.user_name).all()
+
+
+def rollup_kpi_rows(pipelines, query, days, by_pipeline=False):
+    """Same shape as ``raw_kpi_rows`` but summed from the rollup buckets."""
+    first, stop = days
+    keys = [KpiRollup.pipeline_id] if by_pipeline else []
+    is_open = db.case((KpiRollup.status == 'open', KpiRollup.deal_count), else_=0)
+    is_won = db.case((KpiRollup.status == 'won', KpiRollup.deal_count), else_=0)
+    q = (db.session.query(*keys, Stage.name, KpiRollup.owner_id, User.user_name,
+                          db.func.sum(KpiRollup.deal_count),
+                          db.func.coalesce(db.func.sum(KpiRollup.value_sum), 0),
+                          db.func.sum(is_open),
+                          db.func.sum(is_won))
+         .join(Stage, KpiRollup.stage_id == Stage.id)
+         .outerjoin(User, KpiRollup.owner_id == User.user_id)
+         .filter(_pipeline_scope(KpiRollup.pipeline_id, pipelines), Stage.deleted_at.is_(None)))
+    if query.seller_id:
+        q = q.filter(KpiRollup.owner_id == query.seller_id)
+    if query.start is not None or query.end is not None:
+        q = q.filter(KpiRollup.day > KpiRollup.UNDATED)
+    if first is not None:
+        q = q.filter(KpiRollup.day >= first)
+    if stop is not None:
+        q = q.filter(KpiRollup.day < stop)
+    return q.group_by(*keys, Stage.name, KpiRollup.owner_id, User.user_name).all()
+
+
+def kpi_rows(pipelines, query, by_pipeline=False):
+    """Rollup rows for the whole days of the range plus raw rows for its edges.
+
+    At most three queries whatever the number of pipelines.
+    """
+    days, edges = split_range(query.start, query.end)
+    rows = []
+    if days is not None:
+        rows.extend(rollup_kpi_rows(pipelines, query, days, by_pipeline))
+    for edge in edges:
+        rows.extend(raw_kpi_rows(pipelines, query, edge, by_pipeline))
+    return rows
+
+
+def summarize_kpis(rows):
+    total_value = total_open = total_count = won_count = 0
+    per_stage = {}
+    per_seller = {}
+    for stage_name, owner_id, owner_name, count, value, open_count, won in rows:
+        if not count:
+            continue
+        value = float(value or 0)
+        total_value += value
+        total_open += open_count or 0
+        total_count += count
+        won_count += won or 0
+        per_stage[stage_name] = per_stage.get(stage_name, 0) + count
+        if owner_name is not None:
+            seller = per_seller.setdefault(owner_id, {'seller_id': owner_id, 'seller_name': owner_name, 'value': 0.0})
+            seller['value'] += value
+    return {
+        'total_value': total_value,
+        'open_deals': total_open,
+        'win_rate': won_count / total_count if total_count else 0,
+        'deals_per_stage': [{'stage': name, 'count': per_stage[name]} for name in sorted(per_stage)],
+        'value_per_seller': [per_seller[uid] for uid in sorted(per_seller)],
+    }
+
+
+def summarize_account_kpis(pipelines, rows, top=DEFAULT_TOP_SELLERS):
+    """Account totals, one ``summarize_kpis`` block per pipeline and top sellers.
+
+    ``pipelines`` is the ordered ``(id, name)`` list to report on; ``rows``
+    come from ``kpi_rows(..., by_pipeline=True)``.  Sellers are ranked by
+    value across all pipelines, with their deal and won counts.
+    """
+    by_pipeline = {pipeline_id: [] for pipeline_id, _ in pipelines}
+    sellers = {}
+    for pipeline_id, stage_name, owner_id, owner_name, count, value, open_count, won in rows:
+        by_pipeline[pipeline_id].append((stage_name, owner_id, owner_name, count, value, open_count, won))
+        if owner_name is None or not count:
+            continue
+        seller = sellers.setdefault(owner_id, {'seller_id': owner_id, 'seller_name': owner_name,
+                                               'value': 0.0, 'deals': 0, 'won_deals': 0})
+        seller['value'] += float(value or 0)
+        seller['deals'] += count
+        seller['won_deals'] += won or 0
+    totals = summarize_kpis([row[1:] for row in rows])
+    return {
+        'total_value': totals['total_value'],
+        'open_deals': totals['open_deals'],
+        'win_rate': totals['win_rate'],
+        'pipelines': [{'pipeline_id': pipeline_id, 'name': name, **summarize_kpis(by_pipeline[pipeline_id])}
+                      for pipeline_id, name in pipelines],
+        'top_sellers': heapq.nlargest(top, sellers.values(), key=lambda s: (s['value'], -s['seller_id'])),
+    }
+
+
+class week_of(FunctionElement):
+    """Monday of the ISO week containing a date column."""
+    type = db.Date()
+    inherit_cache = True
+
+
+class month_of(FunctionElement):
+    """First day of the month containing a date column."""
+    type = db.Date()
+    inherit_cache = True
+
+
+@compiles(week_of)
+def _week_of_default(element, compiler, **kw):
+    return "CAST(date_trunc('week', %s) AS DATE)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(week_of, 'sqlite')
+def _week_of_sqlite(element, compiler, **kw):
+    # 'weekday 0' moves forward to the next Sunday (or stays on one).
+    return "date(%s, 'weekday 0', '-6 days')" % compiler.process(element.clauses, **kw)
+
+
+@compiles(month_of)
+def _month_of_default(element, compiler, **kw):
+    return "CAST(date_trunc('month', %s) AS DATE)" % compiler.process(element.clauses, **kw)
+
+
+@compiles(month_of, 'sqlite')
+def _month_of_sqlite(element, compiler, **kw):
+    return "date(%s, 'start of month')" % compiler.process(element.clauses, **kw)
+
+
+def bucket_start(day, bucket):
+    """Python counterpart of the SQL truncation used for ``bucket``."""
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start, bucket):
+    if bucket == 'week':
+        return start + timedelta(days=7)
+    if bucket == 'month':
+        return date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+
+def kpi_series(pipeline_id, query, bucket):
+    """Per-bucket totals for the creation days covered by ``query``.
+
+    Runs one grouped query over the daily rollups; ``start`` and ``end``
+    select whole days.  Buckets without deals are filled with zeroes.
+    Raises ``ValueError`` when the range spans more than
+    ``MAX_SERIES_BUCKETS`` buckets.
+    """
+    period = {'day': lambda column: column, 'week': week_of, 'month': month_of}[bucket]
+    start = period(KpiRollup.day).label('start')
+    is_open = db.case((KpiRollup.status == 'open', KpiRollup.deal_count), else_=0)
+    is_won = db.case((KpiRollup.status == 'won', KpiRollup.deal_count), else_=0)
+    q = (db.session.query(start,
+                          db.func.sum(KpiRollup.deal_count),
+                          db.func.coalesce(db.func.sum(KpiRollup.value_sum), 0),
+                          db.func.sum(is_open),
+                          db.func.sum(is_won))
+         .join(Stage, KpiRollup.stage_id == Stage.id)
+         .filter(KpiRollup.pipeline_id == pipeline_id, KpiRollup.day > KpiRollup.UNDATED,
+                 Stage.deleted_at.is_(None)))
+    if query.seller_id:
+        q = q.filter(KpiRollup.owner_id == query.seller_id)
+    if query.start is not None:
+        q = q.filter(KpiRollup.day >= query.start.date())
+    if query.end is not None:
+        q = q.filter(KpiRollup.day <= query.end.date())
+    rows = {day: totals for day, *totals in q.group_by(start).order_by(start)}
+
+    first = bucket_start(query.start.date(), bucket) if query.start else min(rows, default=None)
+    last = bucket_start(query.end.date(), bucket) if query.end else max(rows, default=None)
+    series = []
+    current = first
+    while current is not None and current <= last:
+        if len(series) >= MAX_SERIES_BUCKETS:
+            raise ValueError(f'Range spans more than {MAX_SERIES_BUCKETS} buckets')
+        count, value, open_count, won = rows.get(current, (0, 0, 0, 0))
+        series.append({
+            'start': current.isoformat(),
+            'deals': count or 0,
+            'total_value': float(value or 0),
+            'open_deals': open_count or 0,
+            'won_deals': won or 0,
+            'win_rate': (won or 0) / count if count else 0,
+        })
+        current = next_bucket(current, bucket)
+    return series
@@ -0,0 +1,112 @@
+"""Keyset pagination and field selection for negotiation lists.
+
+Pages are ordered on ``(stage_id, position, id)``; the cursor handed back
+to the client is the key of the last row it received, so fetching the next
+page is an index range scan however deep the client has paged.  Without
+``limit`` or ``cursor`` the whole list is returned, as it was before
+pagination existed, so clients that ignore ``X-Next-Cursor`` see every row.  Rows
+written without a position sort as position 0, so they can neither break
+the cursor nor drop out of the key comparison.
+"""
+import base64
+import json
+
+from .. import db
+from ..models import Negotiation
+
+FIELDS = {
+    'title': Negotiation.title,
+    'stage_id': Negotiation.stage_id,
+    'position': Negotiation.position,
+    'owner_id': Negotiation.owner_id,
+    'value': Negotiation.value,
+    'status': Negotiation.status,
+    'created_at': Negotiation.created_at,
+    'closed_at': Negotiation.closed_at,
+}
+# Page size when a cursor is given without a limit.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Matches ix_negotiations_stage_page_key; the 0 is a literal so the
+# expression is identical to the indexed one.
+PAGE_POSITION = db.func.coalesce(Negotiation.position, db.literal_column('0'))
+PAGE_KEY = (Negotiation.stage_id, PAGE_POSITION, Negotiation.id)
+
+
+def plain_value(value):
+    """Convert a column value into something ``json`` can serialise."""
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if not isinstance(value, (int, str)):
+        return float(value)
+    return value
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size=len(PAGE_KEY)):
+    """Inverse of ``encode_cursor`` for a key of ``size`` integers.
+
+    ``null`` entries, found in cursors issued before NULL positions were
+    coalesced, read as 0.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError('Invalid cursor') from None
+    if not isinstance(key, list) or len(key) != size:
+        raise ValueError('Invalid cursor')
+    key = [0 if k is None else k for k in key]
+    if not all(isinstance(k, int) for k in key):
+        raise ValueError('Invalid cursor')
+    return key
+
+
+def parse_list_args(args, default_fields):
+    """Read ``fields``, ``limit`` and ``cursor`` from a query string.
+
+    Returns ``(fields, limit, key)``; ``limit`` is ``None`` when neither
+    ``limit`` nor ``cursor`` is given. Raises ``ValueError`` with a
+    client-facing message on invalid input.
+    """
+    fields = default_fields
+    if args.get('fields'):
+        fields = tuple(dict.fromkeys(f for f in args['fields'].split(',') if f and f != 'id'))
+        unknown = [f for f in fields if f not in FIELDS]
+        if unknown:
+            raise ValueError(f'Unknown field: {unknown[0]}')
+    key = decode_cursor(args['cursor']) if args.get('cursor') else None
+    if 'limit' not in args and key is None:
+        return fields, None, None
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid limit') from None
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    return fields, limit, key
+
+
+def negotiation_page(filters, fields, limit, key=None):
+    """Return ``(items, next_cursor)`` for negotiations matching ``filters``.
+
+    Only the requested columns are selected; ``next_cursor`` is ``None`` on
+    the last page. A ``limit`` of ``None`` returns every matching row.
+    """
+    stmt = (db.select(*PAGE_KEY, *(FIELDS[f] for f in fields))
+            .where(*filters)
+            .order_by(*PAGE_KEY))
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    if key is not None:
+        stmt = stmt.where(db.tuple_(*PAGE_KEY) > db.tuple_(*key))
+    rows = db.session.execute(stmt).all()
+    more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+    offset = len(PAGE_KEY)
+    items = [{'id': row[2], **{f: plain_value(v) for f, v in zip(fields, row[offset:])}} for row in rows]
+    return items, encode_cursor(rows[-1][:offset]) if more else None
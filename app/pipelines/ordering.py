@@ -0,0 +1,174 @@
+"""Sparse ordering of negotiations inside a stage.
+
+Positions are stored as integers spaced ``POSITION_GAP`` apart, so inserting
+a card between two others only writes the moved row: it takes the midpoint
+of its neighbours.  When two neighbours end up adjacent the stage is
+renumbered once and the insert retried.  Clients keep addressing cards by
+their 1-based index in the stage.  Rows written without a position count
+as position 0 everywhere, matching the list endpoints, so every database
+agrees on where they sit.
+"""
+from bisect import bisect_left
+
+from .. import db
+from ..models import Negotiation
+from .listing import PAGE_POSITION as POSITION
+
+POSITION_GAP = 1024
+# Rows renumbered per UPDATE statement; keeps bound parameters well below
+# the SQLite and Postgres limits.
+REORDER_CHUNK = 1000
+
+
+def set_positions(table, ids, step=1):
+    """Give ``ids`` the positions ``step, 2 * step, ...`` in list order.
+
+    Issues one ``UPDATE ... SET position = CASE id WHEN ... END`` per
+    ``REORDER_CHUNK`` rows instead of one statement per row.
+    """
+    for offset in range(0, len(ids), REORDER_CHUNK):
+        chunk = ids[offset:offset + REORDER_CHUNK]
+        positions = {row_id: (offset + i) * step for i, row_id in enumerate(chunk, start=1)}
+        db.session.execute(
+            table.update()
+            .where(table.c.id.in_(chunk))
+            .values(position=db.case(positions, value=table.c.id))
+        )
+
+
+def next_position(stage_id):
+    """Position that appends a negotiation to the end of ``stage_id``."""
+    max_pos = db.session.query(db.func.max(POSITION)).filter_by(stage_id=stage_id).scalar() or 0
+    return max_pos + POSITION_GAP
+
+
+def _neighbours(stage_id, index, exclude_id):
+    """Positions of the cards that would sit before and after slot ``index``."""
+    query = (db.session.query(POSITION)
+             .filter(Negotiation.stage_id == stage_id)
+             .order_by(POSITION, Negotiation.id))
+    if exclude_id is not None:
+        query = query.filter(Negotiation.id != exclude_id)
+    if index == 1:
+        after = query.limit(1).scalar()
+        return 0, after
+    rows = [pos for (pos,) in query.offset(index - 2).limit(2)]
+    if not rows:
+        return None, None
+    return rows[0], rows[1] if len(rows) > 1 else None
+
+
+def position_at(stage_id, index, exclude_id=None):
+    """Return a position placing a negotiation at 1-based ``index`` of the stage.
+
+    ``exclude_id`` is the negotiation being moved, which must not count as
+    its own neighbour.  Rebalances the stage if the neighbours are adjacent.
+    """
+    for _ in range(2):
+        before, after = _neighbours(stage_id, index, exclude_id)
+        if before is None:
+            return next_position(stage_id)
+        if after is None:
+            return before + POSITION_GAP
+        if after - before > 1:
+            return (before + after) // 2
+        rebalance_stage(stage_id)
+    raise RuntimeError(f'Could not find a free position in stage {stage_id}')
+
+
+def rebalance_stage(stage_id):
+    """Renumber the stage's negotiations ``POSITION_GAP`` apart, keeping order."""
+    ids = [nid for (nid,) in (db.session.query(Negotiation.id)
+                              .filter(Negotiation.stage_id == stage_id)
+                              .order_by(POSITION, Negotiation.id))]
+    set_positions(Negotiation.__table__, ids, step=POSITION_GAP)
+
+
+class StagePlacement:
+    """Positions for many negotiations placed into stages in one request.
+
+    Stages that receive a placement by index have their ``(position, id)``
+    order read once with a single query; placements then take the midpoint
+    of their neighbours in memory, like ``position_at``.  A stage that runs
+    out of room is renumbered in memory and written back once by ``finish``.
+    Append-only stages just need their highest position, read in one
+    grouped query.  Rows without a position count as position 0.
+    """
+
+    def __init__(self, ordered_stage_ids, append_stage_ids=()):
+        self._orders = {sid: [] for sid in ordered_stage_ids}
+        if self._orders:
+            rows = (db.session.query(Negotiation.stage_id, POSITION, Negotiation.id)
+                    .filter(Negotiation.stage_id.in_(list(self._orders))))
+            for stage_id, position, nid in rows:
+                self._orders[stage_id].append((position, nid))
+            for order in self._orders.values():
+                order.sort()
+        append_only = set(append_stage_ids) - set(self._orders)
+        self._last = dict(
+            db.session.query(Negotiation.stage_id, db.func.max(POSITION))
+            .filter(Negotiation.stage_id.in_(append_only))
+            .group_by(Negotiation.stage_id)
+        ) if append_only else {}
+        self._crowded = set()
+
+    def remove(self, stage_id, position, negotiation_id):
+        """Forget a negotiation leaving ``stage_id`` so it is nobody's neighbour."""
+        order = self._orders.get(stage_id)
+        if order is None:
+            return
+        key = (position or 0, negotiation_id)
+        i = bisect_left(order, key)
+        if i < len(order) and order[i] == key:
+            del order[i]
+
+    def place(self, negotiation_id, stage_id, index=None):
+        """Return the position for ``negotiation_id`` at 1-based ``index`` (or the end)."""
+        order = self._orders.get(stage_id)
+        if order is None:
+            position = (self._last.get(stage_id) or 0) + POSITION_GAP
+            self._last[stage_id] = position
+            return position
+        if index is None or index > len(order):
+            index = len(order) + 1
+        if index > len(order):
+            position = (order[-1][0] if order else 0) + POSITION_GAP
+        else:
+            before = order[index - 2][0] if index > 1 else 0
+            if order[index - 1][0] - before <= 1:
+                self._renumber(stage_id)
+                before = order[index - 2][0] if index > 1 else 0
+            position = (before + order[index - 1][0]) // 2
+        order.insert(index - 1, (position, negotiation_id))
+        return position
+
+    def _renumber(self, stage_id):
+        order = self._orders[stage_id]
+        order[:] = [(i * POSITION_GAP, nid) for i, (_, nid) in enumerate(order, start=1)]
+        self._crowded.add(stage_id)
+
+    def finish(self, negotiations):
+        """Renumber crowded stages once and bring ``negotiations`` in line.
+
+        ``negotiations`` are the moved ORM rows; their ``position`` is updated
+        before the renumbering ``UPDATE`` autoflushes them.
+        """
+        final = {}
+        for stage_id in self._crowded:
+            self._renumber(stage_id)
+            final.update((nid, position) for position, nid in self._orders[stage_id])
+        for negotiation in negotiations:
+            if negotiation.id in final:
+                negotiation.position = final[negotiation.id]
+        for stage_id in sorted(self._crowded):
+            set_positions(Negotiation.__table__, [nid for _, nid in self._orders[stage_id]],
+                          step=POSITION_GAP)
+
+
+def crowded_stages(min_gap=2):
+    """Stage ids where two consecutive negotiations are less than ``min_gap`` apart."""
+    gap = (POSITION - db.func.lag(POSITION).over(
+        partition_by=Negotiation.stage_id, order_by=(POSITION, Negotiation.id))).label('gap')
+    gaps = db.select(Negotiation.stage_id, gap).subquery()
+    return [stage_id for (stage_id,) in db.session.execute(
+        db.select(gaps.c.stage_id).where(gaps.c.gap < min_gap).group_by(gaps.c.stage_id))]
@@ -0,0 +1,136 @@
+"""Removal of soft-deleted pipelines and stages.
+
+A soft delete (``Prefer: respond-async``) only sets ``deleted_at``; every
+read filters those rows out.  The rows themselves are removed here
+``batch_size`` at a time, one transaction per batch, so no statement holds
+locks for long.  The remaining children (rollups, memberships, counters) go
+with the parent row through ``ON DELETE CASCADE``.  Change-log entries are
+left to compaction so feed clients still see the deletion.
+"""
+import logging
+import threading
+
+from .. import db
+from ..models import Negotiation, Pipeline, Stage, StageTransition
+
+PURGE_BATCH_SIZE = 1000
+# Seconds between sweeps for rows left behind by a restart or crash.
+PURGE_INTERVAL = 300
+
+log = logging.getLogger(__name__)
+
+
+def _delete_in_batches(table, key, where, batch_size):
+    """Delete rows matching ``where`` in chunks of ``batch_size``; return the count."""
+    removed = 0
+    while True:
+        chunk = db.select(key).where(where).limit(batch_size)
+        count = db.session.execute(table.delete().where(key.in_(chunk))).rowcount
+        db.session.commit()
+        removed += count
+        if count < batch_size:
+            return removed
+
+
+def purge_stage(stage_id, batch_size=PURGE_BATCH_SIZE):
+    """Delete a stage's negotiations in batches, then the stage row itself."""
+    table = Negotiation.__table__
+    removed = _delete_in_batches(table, table.c.id, table.c.stage_id == stage_id, batch_size)
+    db.session.execute(Stage.__table__.delete().where(Stage.__table__.c.id == stage_id))
+    db.session.commit()
+    return removed
+
+
+def purge_pipeline(pipeline_id, batch_size=PURGE_BATCH_SIZE):
+    """Purge every stage and the history of a pipeline, then the pipeline row."""
+    removed = 0
+    stage_ids = [sid for (sid,) in db.session.query(Stage.id).filter(Stage.pipeline_id == pipeline_id)]
+    for stage_id in stage_ids:
+        removed += purge_stage(stage_id, batch_size)
+    transitions = StageTransition.__table__
+    removed += _delete_in_batches(transitions, transitions.c.id,
+                                  transitions.c.pipeline_id == pipeline_id, batch_size)
+    db.session.execute(Pipeline.__table__.delete().where(Pipeline.__table__.c.id == pipeline_id))
+    db.session.commit()
+    return removed
+
+
+def purge_deleted(batch_size=PURGE_BATCH_SIZE):
+    """Purge everything soft-deleted so far.
+
+    Returns ``(pipelines, stages, rows)``: the pipelines and stages removed
+    and the number of child rows deleted along the way.
+    """
+    pipelines = stages = rows = 0
+    for (pipeline_id,) in db.session.query(Pipeline.id).filter(Pipeline.deleted_at.isnot(None)).all():
+        rows += purge_pipeline(pipeline_id, batch_size)
+        pipelines += 1
+    for (stage_id,) in db.session.query(Stage.id).filter(Stage.deleted_at.isnot(None)).all():
+        rows += purge_stage(stage_id, batch_size)
+        stages += 1
+    return pipelines, stages, rows
+
+
+class PurgeWorker:
+    """Runs ``purge_deleted`` on a daemon thread.
+
+    The thread starts with the first request a process serves, sweeps once
+    straight away for rows a restart or crash left behind, then again every
+    ``interval`` seconds or as soon as ``wake`` is called after a soft
+    delete.  Deployments that prefer a scheduled job can disable it with
+    ``PURGE_IN_BACKGROUND`` and run ``flask purge run`` instead.
+    """
+
+    def __init__(self, app, batch_size=PURGE_BATCH_SIZE, enabled=True, interval=PURGE_INTERVAL):
+        self.app = app
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """Start the thread if it is not running; cheap enough for every request."""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stopping = False
+                self._wake.set()
+                self._thread = threading.Thread(target=self._run, name='purge-worker', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Sweep now rather than at the next interval."""
+        if not self.enabled:
+            return
+        self._wake.set()
+        self.start()
+
+    def stop(self, timeout=None):
+        """Stop the thread after one last sweep and wait for it."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        thread.join(timeout)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    purge_deleted(self.batch_size)
+                except Exception:
+                    log.exception('Purging deleted pipelines failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            if self._stopping:
+                with self._lock:
+                    self._thread = None
+                return
@@ -0,0 +1,212 @@
+"""Incremental maintenance of the ``kpi_rollups`` table.
+
+Every ORM flush that creates, changes or deletes a ``Negotiation`` records
+the matching +1/-1 deltas against its rollup bucket inside the same
+transaction.  Code paths that write negotiations with Core statements call
+``apply_deltas`` themselves.  The same deltas drive the per-stage counters
+in ``counters``.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import FunctionElement
+
+from .. import db
+from ..models import KpiRollup, Negotiation, Pipeline, Stage
+from .counters import apply_stage_deltas
+
+TRACKED = ('stage_id', 'owner_id', 'status', 'value', 'created_at')
+
+
+class day_of(FunctionElement):
+    """Calendar day of a timestamp column, portable across SQLite and Postgres."""
+    type = db.Date()
+    inherit_cache = True
+
+
+@compiles(day_of)
+def _day_of_default(element, compiler, **kw):
+    return 'CAST(%s AS DATE)' % compiler.process(element.clauses, **kw)
+
+
+@compiles(day_of, 'sqlite')
+def _day_of_sqlite(element, compiler, **kw):
+    return 'date(%s)' % compiler.process(element.clauses, **kw)
+
+
+def bucket(stage_id, owner_id, status, created_at):
+    return (stage_id,
+            owner_id or KpiRollup.NO_OWNER,
+            status or KpiRollup.NO_STATUS,
+            created_at.date() if created_at else KpiRollup.UNDATED)
+
+
+def as_decimal(value):
+    return Decimal(str(value)) if value is not None else Decimal(0)
+
+
+def add_delta(deltas, values, sign):
+    """Accumulate ``sign`` times the negotiation described by ``values``."""
+    if values['stage_id'] is None:
+        return
+    key = bucket(values['stage_id'], values['owner_id'], values['status'], values['created_at'])
+    entry = deltas[key]
+    entry[0] += sign
+    entry[1] += sign * as_decimal(values['value'])
+
+
+def new_deltas():
+    return defaultdict(lambda: [0, Decimal(0)])
+
+
+def _upsert(connection):
+    table = KpiRollup.__table__
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(table)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(table)
+    else:
+        return None
+    return stmt.on_conflict_do_update(
+        index_elements=[c.name for c in table.primary_key],
+        set_={
+            'deal_count': table.c.deal_count + stmt.excluded.deal_count,
+            'value_sum': table.c.value_sum + stmt.excluded.value_sum,
+        },
+    )
+
+
+def apply_deltas(connection, deltas):
+    """Add ``deltas`` (bucket -> [count, value]) to the rollup table and
+    the stage counters.
+
+    Buckets whose stage no longer exists are skipped; their rollup rows go
+    away with the stage.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta[0] or delta[1]}
+    if not deltas:
+        return
+    apply_stage_deltas(connection, deltas)
+    stage_ids = {key[0] for key in deltas}
+    pipelines = dict(connection.execute(
+        db.select(Stage.id, Stage.pipeline_id).where(Stage.id.in_(stage_ids))).all())
+    rows = [
+        {'pipeline_id': pipelines[stage_id], 'stage_id': stage_id, 'owner_id': owner_id,
+         'status': status, 'day': day, 'deal_count': count, 'value_sum': value}
+        for (stage_id, owner_id, status, day), (count, value) in deltas.items()
+        if pipelines.get(stage_id) is not None
+    ]
+    if not rows:
+        return
+    stmt = _upsert(connection)
+    if stmt is not None:
+        connection.execute(stmt, rows)
+        return
+    table = KpiRollup.__table__
+    for row in rows:
+        key = [table.c[name] == row[name] for name in ('pipeline_id', 'stage_id', 'owner_id', 'status', 'day')]
+        updated = connection.execute(table.update().where(*key).values(
+            deal_count=table.c.deal_count + row['deal_count'],
+            value_sum=table.c.value_sum + row['value_sum'])).rowcount
+        if not updated:
+            connection.execute(table.insert().values(**row))
+
+
+@event.listens_for(Session, 'before_flush')
+def _capture_previous_state(session, flush_context, instances):
+    previous = {}
+    unknown = []
+    changed = [obj for obj in session.dirty
+               if isinstance(obj, Negotiation) and session.is_modified(obj, include_collections=False)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Negotiation)]
+    for obj in changed + deleted:
+        state = inspect(obj)
+        values = {}
+        for attr in TRACKED:
+            history = state.attrs[attr].history
+            if history.deleted:
+                values[attr] = history.deleted[0]
+            elif history.unchanged:
+                values[attr] = history.unchanged[0]
+            elif history.added:
+                # Overwritten without the old value ever being loaded.
+                unknown.append(obj.id)
+                break
+            else:
+                values[attr] = getattr(obj, attr)
+        else:
+            previous[obj.id] = values
+    if unknown:
+        columns = [getattr(Negotiation, attr) for attr in TRACKED]
+        for row in session.connection().execute(
+                db.select(Negotiation.id, *columns).where(Negotiation.id.in_(unknown))):
+            previous[row.id] = {attr: getattr(row, attr) for attr in TRACKED}
+    session.info['kpi_previous'] = previous
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_deltas(session, flush_context):
+    previous = session.info.pop('kpi_previous', {})
+    deltas = new_deltas()
+    for obj in session.new:
+        if isinstance(obj, Negotiation):
+            add_delta(deltas, {attr: getattr(obj, attr) for attr in TRACKED}, 1)
+    for obj in session.dirty:
+        if isinstance(obj, Negotiation) and obj.id in previous:
+            add_delta(deltas, previous[obj.id], -1)
+            add_delta(deltas, {attr: getattr(obj, attr) for attr in TRACKED}, 1)
+    for obj in session.deleted:
+        if isinstance(obj, Negotiation) and obj.id in previous:
+            add_delta(deltas, previous[obj.id], -1)
+    apply_deltas(session.connection(), deltas)
+
+
+def _raw_buckets():
+    return (db.select(Stage.pipeline_id, Negotiation.stage_id,
+                      db.func.coalesce(Negotiation.owner_id, KpiRollup.NO_OWNER).label('owner_id'),
+                      db.func.coalesce(Negotiation.status, KpiRollup.NO_STATUS).label('status'),
+                      db.func.coalesce(day_of(Negotiation.created_at), KpiRollup.UNDATED).label('day'),
+                      db.func.count(Negotiation.id).label('deal_count'),
+                      db.func.coalesce(db.func.sum(Negotiation.value), 0).label('value_sum'))
+            .join(Stage, Negotiation.stage_id == Stage.id)
+            .group_by(Stage.pipeline_id, Negotiation.stage_id, 'owner_id', 'status', 'day'))
+
+
+def rebuild_rollups():
+    """Recompute every rollup bucket from the raw negotiations.
+
+    Every pipeline's version is bumped in the same transaction, so cached
+    KPI responses and ETags built from the old buckets are dropped.
+    """
+    table = KpiRollup.__table__
+    db.session.execute(table.delete())
+    raw = _raw_buckets()
+    db.session.execute(table.insert().from_select(
+        ['pipeline_id', 'stage_id', 'owner_id', 'status', 'day', 'deal_count', 'value_sum'], raw))
+    Pipeline.query.update({'version': Pipeline.version + 1}, synchronize_session=False)
+    db.session.commit()
+
+
+def verify_rollups():
+    """Compare rollups with a fresh aggregation and return mismatching buckets.
+
+    Each mismatch is ``(bucket, expected, actual)`` where the values are
+    ``(deal_count, value_sum)`` pairs.
+    """
+    def key(row):
+        return (row.pipeline_id, row.stage_id, row.owner_id, row.status, str(row.day))
+
+    def totals(row):
+        return (row.deal_count, round(as_decimal(row.value_sum), 2))
+
+    expected = {key(r): totals(r) for r in db.session.execute(_raw_buckets())}
+    actual = {key(r): totals(r) for r in db.session.execute(db.select(KpiRollup.__table__))
+              if r.deal_count or r.value_sum}
+    return [(k, expected.get(k), actual.get(k))
+            for k in sorted(set(expected) | set(actual))
+            if expected.get(k) != actual.get(k)]
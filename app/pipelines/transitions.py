@@ -0,0 +1,51 @@
+"""Recording of stage transitions.
+
+Every flush that creates a negotiation or changes its ``stage_id`` appends
+a ``stage_transitions`` row in the same transaction.  Code paths that write
+negotiations with Core statements call ``record_transitions`` themselves.
+"""
+from datetime import datetime
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from .. import db
+from ..models import Negotiation, Stage, StageTransition
+
+
+def record_transitions(connection, rows):
+    """Insert transition dicts, filling ``pipeline_id`` from ``to_stage_id``.
+
+    Rows whose target stage no longer exists are dropped.
+    """
+    if not rows:
+        return
+    stage_ids = {row['to_stage_id'] for row in rows}
+    pipelines = dict(connection.execute(
+        db.select(Stage.id, Stage.pipeline_id).where(Stage.id.in_(stage_ids))).all())
+    rows = [{**row, 'pipeline_id': pipelines[row['to_stage_id']]}
+            for row in rows if pipelines.get(row['to_stage_id']) is not None]
+    if rows:
+        connection.execute(StageTransition.__table__.insert(), rows)
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_stage_changes(session, flush_context):
+    now = datetime.utcnow()
+    rows = []
+    for obj in session.new:
+        if isinstance(obj, Negotiation) and obj.stage_id is not None:
+            rows.append({'negotiation_id': obj.id, 'from_stage_id': None, 'to_stage_id': obj.stage_id,
+                         'owner_id': obj.owner_id, 'moved_at': obj.created_at or now})
+    for obj in session.dirty:
+        if not isinstance(obj, Negotiation):
+            continue
+        history = inspect(obj).attrs.stage_id.history
+        if not history.added or history.added[0] is None:
+            continue
+        from_stage_id = history.deleted[0] if history.deleted else None
+        if from_stage_id == history.added[0]:
+            continue
+        rows.append({'negotiation_id': obj.id, 'from_stage_id': from_stage_id,
+                     'to_stage_id': history.added[0], 'owner_id': obj.owner_id, 'moved_at': now})
+    record_transitions(session.connection(), rows)
@@ -0,0 +1,129 @@
+"""Bulk provisioning of accounts and users.
+
+Records are processed in chunks: each chunk is diffed against the database
+with a handful of ``IN`` queries and written with one multi-row INSERT for
+new accounts, one for new users and one executemany UPDATE for changed
+users, so the statement count does not grow with the number of agents.
+"""
+from . import db
+from .models import Account, User
+
+SYNC_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+USER_FIELDS = ('user_email', 'user_name', 'role', 'account_id')
+
+
+def parse_user_record(record):
+    """Validate one record and return the user's column values.
+
+    Raises ``ValueError`` with a client-facing message on invalid input.
+    """
+    if not isinstance(record, dict):
+        raise ValueError('Each record must be an object')
+    try:
+        account_id = int(record['account_id'])
+        user_id = int(record['user_id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('account_id and user_id must be integers') from None
+    email = record.get('email', record.get('user_email'))
+    name = record.get('name', record.get('user_name'))
+    for field, value in (('email', email), ('name', name)):
+        if not isinstance(value, str) or not value or len(value) > 120:
+            raise ValueError(f'{field} must be a non-empty string of at most 120 characters')
+    role = record.get('role')
+    if role is not None and (not isinstance(role, str) or len(role) > 50):
+        raise ValueError('role must be a string of at most 50 characters')
+    return {'user_id': user_id, 'user_email': email, 'user_name': name,
+            'role': role, 'account_id': account_id}
+
+
+class SyncResult:
+    def __init__(self):
+        self.accounts_created = self.created = self.updated = self.unchanged = self.failed = 0
+        self.errors = []
+        # Users whose role or account changed; cached principals must go.
+        self.changed_principals = set()
+
+    def fail(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def summary(self):
+        return {'accounts_created': self.accounts_created, 'created': self.created,
+                'updated': self.updated, 'unchanged': self.unchanged,
+                'failed': self.failed, 'errors': sorted(self.errors, key=lambda e: e['line'])}
+
+
+def _sync_chunk(chunk, result):
+    # Later records for the same user win.
+    by_user = {}
+    for line, values in chunk:
+        by_user[values['user_id']] = (line, values)
+
+    existing = {row.user_id: row for row in db.session.execute(
+        db.select(User.user_id, *(getattr(User, f) for f in USER_FIELDS))
+        .where(User.user_id.in_(by_user)))}
+    emails = {values['user_email'] for _, values in by_user.values()}
+    email_owner = dict(db.session.execute(
+        db.select(User.user_email, User.user_id).where(User.user_email.in_(emails))).all())
+    claimed = {}
+    inserts, updates = [], []
+    for user_id, (line, values) in by_user.items():
+        owner = claimed.setdefault(values['user_email'], email_owner.get(values['user_email'], user_id))
+        if owner != user_id:
+            result.fail(line, 'email already belongs to another user')
+            continue
+        current = existing.get(user_id)
+        if current is None:
+            inserts.append(values)
+            continue
+        if values['role'] is None:
+            values['role'] = current.role
+        if all(getattr(current, f) == values[f] for f in USER_FIELDS):
+            result.unchanged += 1
+            continue
+        if (current.role, current.account_id) != (values['role'], values['account_id']):
+            result.changed_principals.add(user_id)
+        updates.append({'b_user_id': user_id, **{f: values[f] for f in USER_FIELDS}})
+
+    account_ids = {values['account_id'] for values in inserts} | {u['account_id'] for u in updates}
+    known = {aid for (aid,) in db.session.execute(
+        db.select(Account.id).where(Account.id.in_(account_ids)))} if account_ids else set()
+    new_accounts = [{'id': aid, 'name': f'Account {aid}'} for aid in sorted(account_ids - known)]
+    if new_accounts:
+        db.session.execute(Account.__table__.insert(), new_accounts)
+    if inserts:
+        db.session.execute(User.__table__.insert(), inserts)
+    if updates:
+        table = User.__table__
+        db.session.execute(
+            table.update().where(table.c.user_id == db.bindparam('b_user_id'))
+            .values({f: db.bindparam(f) for f in USER_FIELDS}),
+            updates)
+    result.accounts_created += len(new_accounts)
+    result.created += len(inserts)
+    result.updated += len(updates)
+
+
+def sync_users(records):
+    """Create or update users from ``(line, record)`` pairs; the caller commits.
+
+    ``record`` may be an exception raised while reading that line.
+    """
+    result = SyncResult()
+    chunk = []
+    for line, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise record
+            chunk.append((line, parse_user_record(record)))
+        except ValueError as exc:
+            result.fail(line, str(exc))
+            continue
+        if len(chunk) >= SYNC_BATCH_SIZE:
+            _sync_chunk(chunk, result)
+            chunk = []
+    if chunk:
+        _sync_chunk(chunk, result)
+    return result
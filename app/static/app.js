@@ -22,31 +22,23 @@ function setupLogin() {
 
 async function loadBoard() {
   const board = document.getElementById('board');
-  const plRes = await fetch('/pipelines', { headers: apiHeaders() });
-  if (!plRes.ok) return (board.textContent = 'Failed to load');
-  const pipelines = await plRes.json();
+  const res = await fetch('/pipelines/board', { headers: apiHeaders() });
+  if (!res.ok) return (board.textContent = 'Failed to load');
+  const pipelines = await res.json();
   board.innerHTML = '';
   for (const p of pipelines) {
     const col = document.createElement('div');
     col.className = 'column';
     col.innerHTML = `<h3>${p.name}</h3>`;
-    const stRes = await fetch(`/pipelines/${p.id}/stages`, { headers: apiHeaders() });
-    if (stRes.ok) {
-      const stages = await stRes.json();
-      for (const s of stages) {
-        const stageDiv = document.createElement('div');
-        stageDiv.innerHTML = `<strong>${s.name}</strong>`;
-        col.appendChild(stageDiv);
-        const nRes = await fetch(`/pipelines/${p.id}/stages/${s.id}/negotiations`, { headers: apiHeaders() });
-        if (nRes.ok) {
-          const negotiations = await nRes.json();
-          for (const n of negotiations) {
-            const card = document.createElement('div');
-            card.className = 'card';
-            card.textContent = n.title;
-            col.appendChild(card);
-          }
-        }
+    for (const s of p.stages) {
+      const stageDiv = document.createElement('div');
+      stageDiv.innerHTML = `<strong>${s.name}</strong>`;
+      col.appendChild(stageDiv);
+      for (const n of s.negotiations) {
+        const card = document.createElement('div');
+        card.className = 'card';
+        card.textContent = n.title;
+        col.appendChild(card);
       }
     }
     board.appendChild(col);
@@ -73,16 +65,49 @@ function showCreatePipeline() {
 
 async function loadDashboard() {
   const container = document.getElementById('dashboard');
-  const plRes = await fetch('/pipelines', { headers: apiHeaders() });
-  if (!plRes.ok) return (container.textContent = 'Failed to load');
-  const pipelines = await plRes.json();
-  container.innerHTML = `<pre>${JSON.stringify(pipelines, null, 2)}</pre>`;
+  const res = await fetch('/kpis?top=5', { headers: apiHeaders() });
+  if (!res.ok) return (container.textContent = 'Failed to load');
+  const kpis = await res.json();
+  const money = v => v.toLocaleString(undefined, { maximumFractionDigits: 2 });
+  const percent = v => `${(v * 100).toFixed(1)}%`;
+  container.innerHTML = `
+    <h3>Account</h3>
+    <div>Value ${money(kpis.total_value)} · Open ${kpis.open_deals} · Win rate ${percent(kpis.win_rate)}</div>
+    <h3>Pipelines</h3>
+    <table class="pipelines"><tr><th>Pipeline</th><th>Value</th><th>Open</th><th>Win rate</th></tr></table>
+    <h3>Top sellers</h3>
+    <ol class="sellers"></ol>`;
+  const table = container.querySelector('.pipelines');
+  for (const p of kpis.pipelines) {
+    const row = table.insertRow();
+    for (const text of [p.name, money(p.total_value), p.open_deals, percent(p.win_rate)]) {
+      row.insertCell().textContent = text;
+    }
+  }
+  const sellers = container.querySelector('.sellers');
+  for (const s of kpis.top_sellers) {
+    const item = document.createElement('li');
+    item.textContent = `${s.seller_name}: ${money(s.value)} (${s.deals} deals, ${s.won_deals} won)`;
+    sellers.appendChild(item);
+  }
 }
 
-async function loadAdmin() {
+async function loadAdmin(cursor) {
   const container = document.getElementById('admin');
-  const res = await fetch('/admin/users', { headers: apiHeaders() });
+  const params = new URLSearchParams({ limit: 100 });
+  if (cursor) params.set('cursor', cursor);
+  const res = await fetch(`/admin/users?${params}`, { headers: apiHeaders() });
   if (!res.ok) return (container.textContent = 'Failed to load');
   const users = await res.json();
-  container.innerHTML = `<pre>${JSON.stringify(users, null, 2)}</pre>`;
+  if (!cursor) container.innerHTML = '<pre></pre>';
+  const list = container.querySelector('pre');
+  list.textContent += users.map(u => JSON.stringify(u)).join('\n') + '\n';
+  container.querySelector('button')?.remove();
+  const next = res.headers.get('X-Next-Cursor');
+  if (next) {
+    const more = document.createElement('button');
+    more.textContent = 'Load more';
+    more.addEventListener('click', () => loadAdmin(next));
+    container.appendChild(more);
+  }
 }
@@ -0,0 +1,74 @@
+"""Time deleting a large pipeline: a soft delete request, the background
+purge in bounded batches and, for comparison, a plain DELETE request that
+relies on ON DELETE CASCADE in one transaction.
+
+    python -m benchmarks.bench_delete --deals 200000
+"""
+import argparse
+import time
+
+from sqlalchemy import event
+
+from app import db
+from app.pipelines.purge import purge_deleted
+
+from .bench_kpis import seed
+from .common import make_app
+
+
+class CommitTimer:
+    """Longest gap between two commits, i.e. the longest purge transaction."""
+
+    def __init__(self):
+        self.longest = 0.0
+        self.commits = 0
+        self._last = time.perf_counter()
+
+    def __call__(self, session):
+        now = time.perf_counter()
+        self.longest = max(self.longest, now - self._last)
+        self.commits += 1
+        self._last = now
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--deals', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    opts = parser.parse_args()
+
+    app = make_app()
+    app.config['PURGE_IN_BACKGROUND'] = False
+    app.extensions['purge_worker'].enabled = False
+    with app.app_context():
+        pipeline_id = seed(opts.deals)
+        db.session.remove()
+        headers = {'X-API-Key': 'bench-token'}
+        client = app.test_client()
+        start = time.perf_counter()
+        status = client.delete(f'/pipelines/{pipeline_id}',
+                               headers={**headers, 'Prefer': 'respond-async'}).status_code
+        print(f'DELETE /pipelines/<id> (respond-async): {status} in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+        timer = CommitTimer()
+        event.listen(db.session, 'after_commit', timer)
+        start = time.perf_counter()
+        pipelines, stages, rows = purge_deleted(opts.batch_size)
+        total = time.perf_counter() - start
+        event.remove(db.session, 'after_commit', timer)
+        print(f'purge: {rows} rows in {total:.2f} s, {timer.commits} transactions, '
+              f'longest {timer.longest * 1000:.1f} ms')
+
+    app = make_app()
+    app.extensions['purge_worker'].enabled = False
+    with app.app_context():
+        pipeline_id = seed(opts.deals)
+        db.session.remove()
+        start = time.perf_counter()
+        status = app.test_client().delete(f'/pipelines/{pipeline_id}', headers=headers).status_code
+        print(f'DELETE /pipelines/<id>: {status} in {(time.perf_counter() - start) * 1000:.0f} ms '
+              f'in one transaction')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Compare the NumPy funnel engine with a per-row Python loop over the same
+transitions, separating the database load from the computation.
+
+    python -m benchmarks.bench_funnel --transitions 10000000
+"""
+import argparse
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from app import db
+from app.models import Pipeline, Stage, StageTransition
+from app.pipelines.analytics import DWELL_PERCENTILES, funnel_metrics, load_transitions
+
+from .common import make_app, seed_supervisor, timed
+
+
+def seed(transitions, stages=8, sellers=50, batch=50000):
+    """Insert about ``transitions`` rows: deals walk forward through the
+    stages with the occasional step back, a few hours per stay."""
+    seed_supervisor()
+    pipeline = Pipeline(name='Bench', account_id=1, position=1)
+    db.session.add(pipeline)
+    db.session.flush()
+    stage_ids = []
+    for i in range(stages):
+        stage = Stage(name=f'Stage {i}', pipeline_id=pipeline.id, position=i + 1)
+        db.session.add(stage)
+        db.session.flush()
+        stage_ids.append(stage.id)
+    db.session.commit()
+
+    rng = np.random.default_rng(42)
+    stage_ids = np.array(stage_ids)
+    written = deal = 0
+    start = np.datetime64('2024-01-01T00:00:00')
+    table = StageTransition.__table__
+    while written < transitions:
+        count = min(batch, transitions - written)
+        steps = rng.integers(1, stages + 1, size=count // 4 + 1)
+        lengths = steps[np.cumsum(steps) <= count]
+        total = int(lengths.sum())
+        if not total:
+            lengths, total = np.array([count]), count
+        ids = np.repeat(np.arange(deal, deal + len(lengths)), lengths)
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        ranks = np.clip(offsets - (rng.random(total) < 0.1), 0, stages - 1)
+        owners = np.repeat(rng.integers(100, 100 + sellers, size=len(lengths)), lengths)
+        hours = rng.exponential(36, size=total).cumsum()
+        moved = start + (hours * 3600).astype('timedelta64[s]')
+        db.session.execute(table.insert(), [
+            {'pipeline_id': pipeline.id, 'negotiation_id': int(i), 'from_stage_id': None,
+             'to_stage_id': int(s), 'owner_id': int(o), 'moved_at': m.item()}
+            for i, s, o, m in zip(ids, stage_ids[ranks], owners, moved)])
+        db.session.commit()
+        written += total
+        deal += len(lengths)
+    return pipeline.id, [(int(sid), f'Stage {i}') for i, sid in enumerate(stage_ids)]
+
+
+def python_funnel(stages, ids, stage_ids, owner_ids, seconds):
+    """Reference implementation walking the rows one at a time."""
+    rank_of = {sid: rank for rank, (sid, _) in enumerate(stages)}
+    furthest = {}
+    dwell = defaultdict(list)
+    seller_moves = defaultdict(list)
+    previous = None
+    for nid, sid, owner, at in zip(ids.tolist(), stage_ids.tolist(), owner_ids.tolist(), seconds.tolist()):
+        rank = rank_of.get(sid)
+        if rank is None:
+            continue
+        furthest[nid] = max(furthest.get(nid, rank), rank)
+        if previous is not None and previous[0] == nid:
+            dwell[previous[1]].append(at - previous[3])
+            seller_moves[previous[2]].append((at - previous[3], rank > previous[1]))
+        previous = (nid, rank, owner, at)
+    reached = [sum(1 for r in furthest.values() if r >= rank) for rank in range(len(stages))]
+    stage_dwell = {rank: np.percentile(values, DWELL_PERCENTILES) for rank, values in dwell.items()}
+    sellers = {owner: (len(moves), sum(a for _, a in moves), float(np.median([d for d, _ in moves])))
+               for owner, moves in seller_moves.items()}
+    return reached, stage_dwell, sellers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--transitions', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    opts = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        started = time.perf_counter()
+        pipeline_id, stages = seed(opts.transitions)
+        print(f'seeded {opts.transitions} transitions in {time.perf_counter() - started:.0f} s')
+        arrays = []
+        load_ms = timed(lambda: arrays.append(load_transitions(pipeline_id)), 1)
+        arrays = arrays[0]
+        numpy_ms = timed(lambda: funnel_metrics(stages, *arrays), opts.repeat)
+        python_ms = timed(lambda: python_funnel(stages, *arrays), 1)
+        print(f'load transitions   {load_ms:>10.0f} ms')
+        print(f'numpy metrics      {numpy_ms:>10.0f} ms')
+        print(f'python loop        {python_ms:>10.0f} ms  ({python_ms / numpy_ms:.0f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Compare the KPI paths: the former one-query-per-figure version, the
+single conditional-aggregation scan over raw negotiations and the rollups.
+
+    python -m benchmarks.bench_kpis --deals 500000
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import Pipeline, Stage, Negotiation, User
+from app.pipelines.kpis import parse_kpi_args, kpi_rows, raw_kpi_rows, summarize_kpis
+from app.pipelines.rollups import rebuild_rollups
+
+from .common import make_app, seed_supervisor, timed, StatementCounter
+
+STATUSES = ('open', 'open', 'open', 'won', 'lost')
+
+
+def seed(deals, stages=8, sellers=50, days=365, batch=10000):
+    seed_supervisor()
+    db.session.add_all(User(user_id=100 + i, user_email=f'seller{i}@example.com',
+                            user_name=f'Seller {i}', account_id=1) for i in range(sellers))
+    pipeline = Pipeline(name='Bench', account_id=1, position=1)
+    db.session.add(pipeline)
+    db.session.flush()
+    stage_ids = []
+    for i in range(stages):
+        stage = Stage(name=f'Stage {i}', pipeline_id=pipeline.id, position=i + 1)
+        db.session.add(stage)
+        db.session.flush()
+        stage_ids.append(stage.id)
+    db.session.commit()
+
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1)
+    rows = []
+    for i in range(deals):
+        rows.append({
+            'title': f'Deal {i}', 'position': i, 'stage_id': rng.choice(stage_ids),
+            'owner_id': 100 + rng.randrange(sellers), 'value': rng.randint(100, 10000),
+            'status': rng.choice(STATUSES), 'created_at': start + timedelta(minutes=rng.randrange(days * 1440)),
+        })
+        if len(rows) == batch:
+            db.session.execute(db.insert(Negotiation), rows)
+            rows = []
+    if rows:
+        db.session.execute(db.insert(Negotiation), rows)
+    db.session.commit()
+    rebuild_rollups()
+    return pipeline.id
+
+
+def legacy_kpis(pipeline_id, start_dt=None, end_dt=None, seller_id=None):
+    """The previous implementation: one query per figure, filters rebuilt three times."""
+    def filtered(query):
+        if seller_id:
+            query = query.filter(Negotiation.owner_id == seller_id)
+        if start_dt:
+            query = query.filter(Negotiation.created_at >= start_dt)
+        if end_dt:
+            query = query.filter(Negotiation.created_at <= end_dt)
+        return query
+
+    query = filtered(Negotiation.query.join(Stage).filter(Stage.pipeline_id == pipeline_id))
+    total_value = query.with_entities(db.func.coalesce(db.func.sum(Negotiation.value), 0)).scalar() or 0
+    total_open = query.filter(Negotiation.status == 'open').count()
+    total_count = query.count()
+    won_count = query.filter(Negotiation.status == 'won').count()
+    deals_per_stage = filtered(
+        db.session.query(Stage.name, db.func.count(Negotiation.id))
+        .join(Negotiation).filter(Stage.pipeline_id == pipeline_id)
+    ).group_by(Stage.name).all()
+    value_per_seller = filtered(
+        db.session.query(User.user_id, User.user_name, db.func.coalesce(db.func.sum(Negotiation.value), 0))
+        .join(Negotiation, Negotiation.owner_id == User.user_id)
+        .join(Stage, Negotiation.stage_id == Stage.id)
+        .filter(Stage.pipeline_id == pipeline_id)
+    ).group_by(User.user_id, User.user_name).all()
+    return total_value, total_open, total_count, won_count, deals_per_stage, value_per_seller
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--deals', type=int, default=500000)
+    parser.add_argument('--sellers', type=int, default=50)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=5)
+    opts = parser.parse_args()
+
+    app = make_app()
+    with app.app_context():
+        pipeline_id = seed(opts.deals, sellers=opts.sellers, days=opts.days)
+        cases = {
+            'all time': {},
+            'date range': {'start_date': '2024-03-01', 'end_date': '2024-09-30'},
+            'one seller': {'seller_id': '101'},
+        }
+        print(f'{opts.deals} deals, median of {opts.repeat} runs (ms / statements)')
+        print(f'{"case":<12} {"legacy":>14} {"single scan":>14} {"rollups":>14}')
+        for label, args in cases.items():
+            query = parse_kpi_args(args)
+            raw_filters = []
+            if query.start:
+                raw_filters.append(Negotiation.created_at >= query.start)
+            if query.end:
+                raw_filters.append(Negotiation.created_at <= query.end)
+            runs = [
+                lambda: legacy_kpis(pipeline_id, query.start, query.end, query.seller_id),
+                lambda: summarize_kpis(raw_kpi_rows(pipeline_id, query, raw_filters)),
+                lambda: summarize_kpis(kpi_rows(pipeline_id, query)),
+            ]
+            cells = []
+            for run in runs:
+                with StatementCounter(db.engine) as counter:
+                    ms = timed(run, opts.repeat)
+                cells.append(f'{ms:>8.1f} / {counter.count // opts.repeat:<3}')
+            print(f'{label:<12} ' + ' '.join(cells))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Statement count and latency of reordering a stage, per row vs set-based.
+
+    python -m benchmarks.bench_reorder --sizes 100 1000 10000
+"""
+import argparse
+import random
+
+from app import db
+from app.models import Pipeline, Stage, Negotiation
+from app.pipelines.ordering import POSITION_GAP, set_positions
+
+from .common import make_app, seed_supervisor, timed, StatementCounter
+
+
+def seed_stage(size):
+    pipeline = Pipeline(name=f'Reorder {size}', account_id=1, position=1)
+    db.session.add(pipeline)
+    db.session.flush()
+    stage = Stage(name='Stage', pipeline_id=pipeline.id, position=1)
+    db.session.add(stage)
+    db.session.flush()
+    db.session.execute(db.insert(Negotiation), [
+        {'title': f'Deal {i}', 'stage_id': stage.id, 'position': i * POSITION_GAP}
+        for i in range(1, size + 1)
+    ])
+    db.session.commit()
+    return [nid for (nid,) in db.session.query(Negotiation.id).filter_by(stage_id=stage.id)]
+
+
+def per_row(ids):
+    for pos, nid in enumerate(ids, start=1):
+        Negotiation.query.filter_by(id=nid).update({'position': pos * POSITION_GAP})
+    db.session.commit()
+
+
+def set_based(ids):
+    set_positions(Negotiation.__table__, ids, step=POSITION_GAP)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    opts = parser.parse_args()
+
+    app = make_app()
+    rng = random.Random(7)
+    with app.app_context():
+        seed_supervisor()
+        print(f'median of {opts.repeat} runs (ms / statements)')
+        print(f'{"items":>7} {"per row":>16} {"set-based":>16}')
+        for size in opts.sizes:
+            ids = seed_stage(size)
+            cells = []
+            for run in (per_row, set_based):
+                with StatementCounter(db.engine) as counter:
+                    ms = timed(lambda: run(rng.sample(ids, len(ids))), opts.repeat)
+                cells.append(f'{ms:>9.1f} / {counter.count // opts.repeat:<5}')
+            print(f'{size:>7} ' + ' '.join(cells))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Hold N board event streams open and time the fan-out of each move.
+
+Starts gunicorn with ``gunicorn.conf.py`` (gevent workers) against a
+throw-away database, opens ``--streams`` connections to
+``/pipelines/<id>/events``, then moves a negotiation ``--moves`` times and
+reports how long each event takes to reach every stream, plus the
+resident memory of the server.
+
+    python -m benchmarks.bench_sse --streams 2000 --moves 20
+"""
+import argparse
+import http.client
+import json
+import os
+import resource
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from app import db
+from app.models import Negotiation, Pipeline, Stage
+
+from .common import make_app, seed_supervisor
+
+
+def seed_board():
+    pipeline = Pipeline(name='Live', account_id=1, position=1)
+    db.session.add(pipeline)
+    db.session.flush()
+    stages = [Stage(name=name, pipeline_id=pipeline.id, position=i) for i, name in enumerate(('A', 'B'), 1)]
+    db.session.add_all(stages)
+    db.session.flush()
+    deal = Negotiation(title='Deal', stage_id=stages[0].id, owner_id=1, position=1024)
+    db.session.add(deal)
+    db.session.commit()
+    return pipeline.id, [s.id for s in stages], deal.id
+
+
+def start_server(database_url, port, workers):
+    env = dict(os.environ, DATABASE_URL=database_url, GUNICORN_BIND=f'127.0.0.1:{port}',
+               GUNICORN_WORKERS=str(workers))
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'run:app'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit('gunicorn did not start')
+
+
+def server_rss_mb(pid):
+    """Resident memory of the gunicorn master and its workers."""
+    pids = [pid]
+    for candidate in os.listdir('/proc'):
+        if candidate.isdigit():
+            try:
+                with open(f'/proc/{candidate}/stat') as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(candidate))
+            except OSError:
+                continue
+    total = 0
+    for p in pids:
+        with open(f'/proc/{p}/status') as f:
+            total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS'))
+    return total / 1024
+
+
+def open_streams(port, pipeline_id, token, count):
+    selector = selectors.DefaultSelector()
+    request = (f'GET /pipelines/{pipeline_id}/events HTTP/1.1\r\nHost: localhost\r\n'
+               f'X-API-Key: {token}\r\nAccept: text/event-stream\r\n\r\n').encode()
+    pending = set()
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(request)
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, data={'buffer': b'', 'events': 0})
+        pending.add(sock)
+    # Wait until every stream has sent its first frame.
+    while pending:
+        for key, _ in selector.select(timeout=10):
+            state = key.data
+            state['buffer'] += key.fileobj.recv(65536)
+            if b'retry:' in state['buffer']:
+                pending.discard(key.fileobj)
+    return selector
+
+
+def move(port, token, negotiation_id, stage_id):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', f'/negotiations/{negotiation_id}/move', body=json.dumps({'stage_id': stage_id}),
+                 headers={'X-API-Key': token, 'Content-Type': 'application/json'})
+    assert conn.getresponse().status == 200
+    conn.close()
+
+
+def wait_for_event(selector, expected, timeout=30):
+    """Seconds until each stream has received ``expected`` move events."""
+    start = time.perf_counter()
+    latencies = []
+    waiting = {key.fileobj for key in selector.get_map().values() if key.data['events'] < expected}
+    while waiting and time.perf_counter() - start < timeout:
+        for key, _ in selector.select(timeout=1):
+            state = key.data
+            chunk = key.fileobj.recv(65536)
+            state['buffer'] += chunk
+            state['events'] += chunk.count(b'event: negotiation.moved')
+            state['buffer'] = state['buffer'][-64:]
+            if state['events'] >= expected and key.fileobj in waiting:
+                waiting.discard(key.fileobj)
+                latencies.append(time.perf_counter() - start)
+    if waiting:
+        raise SystemExit(f'{len(waiting)} stream(s) missed event {expected}')
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', type=int, default=500)
+    parser.add_argument('--moves', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    app = make_app()
+    with app.app_context():
+        headers = seed_supervisor()
+        pipeline_id, stage_ids, negotiation_id = seed_board()
+        database_url = db.engine.url.render_as_string(hide_password=False)
+    token = headers['X-API-Key']
+    server = start_server(database_url, args.port, args.workers)
+    try:
+        idle_rss = server_rss_mb(server.pid)
+        start = time.perf_counter()
+        selector = open_streams(args.port, pipeline_id, token, args.streams)
+        connect_s = time.perf_counter() - start
+        print(f'{args.streams} streams open in {connect_s:.2f}s; '
+              f'server RSS {idle_rss:.0f} MB -> {server_rss_mb(server.pid):.0f} MB')
+        fan_out = []
+        for i in range(1, args.moves + 1):
+            move(args.port, token, negotiation_id, stage_ids[i % 2])
+            latencies = wait_for_event(selector, i)
+            fan_out.append(max(latencies))
+            fan_out_p50 = statistics.median(latencies)
+        print(f'{args.moves} moves: last stream reached after median {statistics.median(fan_out) * 1000:.0f} ms, '
+              f'max {max(fan_out) * 1000:.0f} ms (median stream {fan_out_p50 * 1000:.0f} ms on the final move)')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Helpers shared by the benchmark scripts.
+
+Benchmarks run against a throw-away SQLite file by default; set
+``BENCH_DATABASE_URL`` to point them at Postgres instead.
+"""
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.api_keys import issue_api_key
+from app.models import Account, User
+
+
+def make_app():
+    url = os.getenv('BENCH_DATABASE_URL')
+    if not url:
+        path = os.path.join(tempfile.mkdtemp(prefix='kanban-bench-'), 'bench.db')
+        url = f'sqlite:///{path}'
+
+    class BenchConfig:
+        SQLALCHEMY_DATABASE_URI = url
+        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        SECRET_KEY = 'bench-secret'
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def seed_supervisor(account_id=1, user_id=1, token='bench-token'):
+    """Create an account with a supervisor and return request headers for it."""
+    account = Account(id=account_id, name=f'Account {account_id}')
+    user = User(user_id=user_id, user_email=f'bench{user_id}@example.com',
+                user_name=f'Bench {user_id}', role='supervisor', account=account)
+    db.session.add_all([account, user])
+    db.session.flush()
+    issue_api_key(user_id, token=token)
+    db.session.commit()
+    return {'X-API-Key': token}
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _record(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+def timed(fn, repeat=5):
+    """Run ``fn`` ``repeat`` times and return the median wall time in ms."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
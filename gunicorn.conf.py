@@ -0,0 +1,23 @@
+"""Gunicorn settings used by the Docker image.
+
+Board event streams (``/pipelines/<id>/events``) stay open for as long as
+a board is on screen.  gevent workers serve each connection from a
+greenlet, so thousands of idle streams share a handful of processes;
+psycogreen makes psycopg2 yield to other greenlets while it waits on
+Postgres.
+"""
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+# Concurrent connections per gevent worker, open event streams included.
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 2000))
+# Streams are long-lived by design; the keep-alive frames prove liveness.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,54 @@
+"""cascade pipeline and stage deletes in the database, add soft delete
+
+Revision ID: 10_cascade_deletes
+Revises: 9_add_stage_counters
+Create Date: 2026-10-18 18:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '10_cascade_deletes'
+down_revision = '9_add_stage_counters'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table) of every foreign key that gains ON DELETE CASCADE.
+CASCADES = [
+    ('stages', 'pipeline_id', 'pipelines'),
+    ('negotiations', 'stage_id', 'stages'),
+    ('pipeline_users', 'pipeline_id', 'pipelines'),
+    ('stage_users', 'stage_id', 'stages'),
+]
+# The initial migration left these constraints unnamed; on SQLite batch
+# mode names them through this convention when reflecting the table.
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def _replace_foreign_keys(ondelete):
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    for table, column, referred in CASCADES:
+        name = f'{table}_{column}_fkey'
+        if sqlite:
+            with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, referred, [column], ['id'], ondelete=ondelete)
+        else:
+            # Postgres' default name for an unnamed constraint.
+            op.drop_constraint(name, table, type_='foreignkey')
+            op.create_foreign_key(name, table, referred, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    op.add_column('pipelines', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('stages', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_pipelines_deleted_at', 'pipelines', ['deleted_at'])
+    op.create_index('ix_stages_deleted_at', 'stages', ['deleted_at'])
+    _replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    _replace_foreign_keys(None)
+    op.drop_index('ix_stages_deleted_at', table_name='stages')
+    op.drop_index('ix_pipelines_deleted_at', table_name='pipelines')
+    op.drop_column('stages', 'deleted_at')
+    op.drop_column('pipelines', 'deleted_at')
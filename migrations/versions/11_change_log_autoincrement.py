@@ -0,0 +1,31 @@
+"""keep change log seqs increasing on SQLite
+
+Revision ID: 11_change_log_autoincrement
+Revises: 10_cascade_deletes
+Create Date: 2026-10-19 10:00:00
+"""
+from alembic import op
+
+revision = '11_change_log_autoincrement'
+down_revision = '10_cascade_deletes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created before 5_add_change_log declared AUTOINCREMENT
+    # reuse the seqs of compacted rows. Postgres sequences never go back.
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('change_log', recreate='always',
+                              table_kwargs={'sqlite_autoincrement': True}):
+        pass
+    # Seqs already handed out and compacted away must not come back either.
+    op.execute("DELETE FROM sqlite_sequence WHERE name = 'change_log'")
+    op.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'change_log', MAX("
+               "(SELECT COALESCE(MAX(seq), 0) FROM change_log), "
+               "(SELECT COALESCE(MAX(changes_floor), 0) FROM pipelines))")
+
+
+def downgrade():
+    pass
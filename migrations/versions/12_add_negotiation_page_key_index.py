@@ -0,0 +1,22 @@
+"""index the negotiation list page key with NULL positions coalesced
+
+Revision ID: 12_add_negotiation_page_key_index
+Revises: 11_change_log_autoincrement
+Create Date: 2026-10-19 11:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '12_add_negotiation_page_key_index'
+down_revision = '11_change_log_autoincrement'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_negotiations_stage_page_key', 'negotiations',
+                    ['stage_id', sa.text('coalesce(position, 0)'), 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_negotiations_stage_page_key', table_name='negotiations')
@@ -0,0 +1,31 @@
+"""add indexes for negotiation hot paths
+
+Revision ID: 2_add_hot_path_indexes
+Revises: 1_add_kpi_fields
+Create Date: 2026-10-18 09:00:00
+"""
+from alembic import op
+
+revision = '2_add_hot_path_indexes'
+down_revision = '1_add_kpi_fields'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_pipelines_account_position', 'pipelines', ['account_id', 'position'])
+    op.create_index('ix_pipeline_users_user_id', 'pipeline_users', ['user_id'])
+    op.create_index('ix_stages_pipeline_position', 'stages', ['pipeline_id', 'position'])
+    op.create_index('ix_negotiations_stage_position', 'negotiations', ['stage_id', 'position'])
+    op.create_index('ix_negotiations_stage_status_created', 'negotiations',
+                    ['stage_id', 'status', 'created_at'])
+    op.create_index('ix_negotiations_owner_created', 'negotiations', ['owner_id', 'created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_negotiations_owner_created', table_name='negotiations')
+    op.drop_index('ix_negotiations_stage_status_created', table_name='negotiations')
+    op.drop_index('ix_negotiations_stage_position', table_name='negotiations')
+    op.drop_index('ix_stages_pipeline_position', table_name='stages')
+    op.drop_index('ix_pipeline_users_user_id', table_name='pipeline_users')
+    op.drop_index('ix_pipelines_account_position', table_name='pipelines')
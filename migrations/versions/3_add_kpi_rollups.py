@@ -0,0 +1,47 @@
+"""add kpi rollup table
+
+Revision ID: 3_add_kpi_rollups
+Revises: 2_add_hot_path_indexes
+Create Date: 2026-10-18 10:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '3_add_kpi_rollups'
+down_revision = '2_add_hot_path_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('kpi_rollups',
+    sa.Column('pipeline_id', sa.Integer(), nullable=False),
+    sa.Column('stage_id', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('deal_count', sa.Integer(), nullable=False),
+    sa.Column('value_sum', sa.Numeric(14, 2), nullable=False),
+    sa.ForeignKeyConstraint(['pipeline_id'], ['pipelines.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['stage_id'], ['stages.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('pipeline_id', 'stage_id', 'owner_id', 'status', 'day')
+    )
+    op.create_index('ix_kpi_rollups_pipeline_day', 'kpi_rollups', ['pipeline_id', 'day'])
+    op.create_index('ix_kpi_rollups_pipeline_owner_day', 'kpi_rollups', ['pipeline_id', 'owner_id', 'day'])
+    op.create_index('ix_negotiations_stage_created', 'negotiations', ['stage_id', 'created_at'])
+
+    day = 'date(n.created_at)' if op.get_bind().dialect.name == 'sqlite' else 'CAST(n.created_at AS DATE)'
+    op.execute(f"""
+        INSERT INTO kpi_rollups (pipeline_id, stage_id, owner_id, status, day, deal_count, value_sum)
+        SELECT s.pipeline_id, n.stage_id, COALESCE(n.owner_id, 0), COALESCE(n.status, ''),
+               COALESCE({day}, '0001-01-01'), COUNT(n.id), COALESCE(SUM(n.value), 0)
+        FROM negotiations n JOIN stages s ON s.id = n.stage_id
+        GROUP BY 1, 2, 3, 4, 5
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_negotiations_stage_created', table_name='negotiations')
+    op.drop_index('ix_kpi_rollups_pipeline_owner_day', table_name='kpi_rollups')
+    op.drop_index('ix_kpi_rollups_pipeline_day', table_name='kpi_rollups')
+    op.drop_table('kpi_rollups')
@@ -0,0 +1,21 @@
+"""add pipeline version counter
+
+Revision ID: 4_add_pipeline_version
+Revises: 3_add_kpi_rollups
+Create Date: 2026-10-18 11:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '4_add_pipeline_version'
+down_revision = '3_add_kpi_rollups'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('pipelines', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('pipelines', 'version')
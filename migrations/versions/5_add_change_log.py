@@ -0,0 +1,37 @@
+"""add change log for the incremental board feed
+
+Revision ID: 5_add_change_log
+Revises: 4_add_pipeline_version
+Create Date: 2026-10-18 13:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '5_add_change_log'
+down_revision = '4_add_pipeline_version'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'change_log',
+        sa.Column('seq', sa.Integer(), primary_key=True),
+        sa.Column('pipeline_id', sa.Integer(), nullable=False),
+        sa.Column('entity', sa.String(length=20), nullable=False),
+        sa.Column('entity_id', sa.Integer(), nullable=True),
+        sa.Column('action', sa.String(length=30), nullable=False),
+        sa.Column('payload', sa.JSON(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sqlite_autoincrement=True,
+    )
+    op.create_index('ix_change_log_pipeline_seq', 'change_log', ['pipeline_id', 'seq'])
+    op.create_index('ix_change_log_created_at', 'change_log', ['created_at'])
+    op.add_column('pipelines', sa.Column('changes_floor', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('pipelines', 'changes_floor')
+    op.drop_index('ix_change_log_created_at', table_name='change_log')
+    op.drop_index('ix_change_log_pipeline_seq', table_name='change_log')
+    op.drop_table('change_log')
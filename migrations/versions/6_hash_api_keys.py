@@ -0,0 +1,81 @@
+"""store api keys as hashes with expiry and last-used tracking
+
+Revision ID: 6_hash_api_keys
+Revises: 5_add_change_log
+Create Date: 2026-10-18 14:00:00
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '6_hash_api_keys'
+down_revision = '5_add_change_log'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+api_keys = sa.table(
+    'api_keys',
+    sa.column('id', sa.Integer),
+    sa.column('key', sa.String),
+    sa.column('key_hash', sa.String),
+    sa.column('key_prefix', sa.String),
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = {c['name'] for c in sa.inspect(bind).get_columns('api_keys')}
+    with op.batch_alter_table('api_keys') as batch:
+        if 'scopes' not in columns:
+            # The model gained this column without a migration.
+            batch.add_column(sa.Column('scopes', sa.String(length=255), nullable=True))
+        batch.add_column(sa.Column('key_hash', sa.String(length=64), nullable=True))
+        batch.add_column(sa.Column('key_prefix', sa.String(length=8), nullable=True))
+        batch.add_column(sa.Column('expires_at', sa.DateTime(), nullable=True))
+        batch.add_column(sa.Column('last_used_at', sa.DateTime(), nullable=True))
+        batch.add_column(sa.Column('nonce', sa.String(length=32), nullable=True))
+
+    # Existing keys keep working: expires_at stays NULL (no expiry) so the
+    # upgrade does not lock integrations out 30 days later. Revoke them
+    # through the API to retire them.
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.select(api_keys.c.id, api_keys.c.key)
+                            .where(api_keys.c.id > last_id)
+                            .order_by(api_keys.c.id)
+                            .limit(BATCH_SIZE)).all()
+        if not rows:
+            break
+        for key_id, key in rows:
+            bind.execute(api_keys.update().where(api_keys.c.id == key_id).values(
+                key_hash=hashlib.sha256(key.encode()).hexdigest(), key_prefix=key[:8]))
+        last_id = rows[-1][0]
+
+    with op.batch_alter_table('api_keys') as batch:
+        batch.drop_column('key')
+        batch.alter_column('key_hash', existing_type=sa.String(length=64), nullable=False)
+        batch.alter_column('key_prefix', existing_type=sa.String(length=8), nullable=False)
+        batch.create_unique_constraint('uq_api_keys_key_hash', ['key_hash'])
+    op.create_index('ix_api_keys_key_prefix', 'api_keys', ['key_prefix'])
+    op.create_index('ix_api_keys_expires_at', 'api_keys', ['expires_at'])
+    op.create_index('ix_api_keys_user_id', 'api_keys', ['user_id'])
+
+
+def downgrade():
+    # Tokens cannot be recovered from their hashes; every key is dropped.
+    op.execute(api_keys.delete())
+    op.drop_index('ix_api_keys_user_id', table_name='api_keys')
+    op.drop_index('ix_api_keys_expires_at', table_name='api_keys')
+    op.drop_index('ix_api_keys_key_prefix', table_name='api_keys')
+    with op.batch_alter_table('api_keys') as batch:
+        batch.drop_constraint('uq_api_keys_key_hash', type_='unique')
+        batch.drop_column('nonce')
+        batch.drop_column('last_used_at')
+        batch.drop_column('expires_at')
+        batch.drop_column('key_prefix')
+        batch.drop_column('key_hash')
+        batch.add_column(sa.Column('key', sa.String(length=255), nullable=False))
+        batch.create_unique_constraint('uq_api_keys_key', ['key'])
@@ -0,0 +1,22 @@
+"""add indexes for the paginated admin user listing
+
+Revision ID: 7_add_user_listing_indexes
+Revises: 6_hash_api_keys
+Create Date: 2026-10-18 15:00:00
+"""
+from alembic import op
+
+revision = '7_add_user_listing_indexes'
+down_revision = '6_hash_api_keys'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_users_account_user', 'users', ['account_id', 'user_id'])
+    op.create_index('ix_users_role_user', 'users', ['role', 'user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_users_role_user', table_name='users')
+    op.drop_index('ix_users_account_user', table_name='users')
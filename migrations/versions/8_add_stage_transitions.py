@@ -0,0 +1,42 @@
+"""add stage transition history
+
+Revision ID: 8_add_stage_transitions
+Revises: 7_add_user_listing_indexes
+Create Date: 2026-10-18 16:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '8_add_stage_transitions'
+down_revision = '7_add_user_listing_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stage_transitions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('pipeline_id', sa.Integer(), nullable=False),
+    sa.Column('negotiation_id', sa.Integer(), nullable=False),
+    sa.Column('from_stage_id', sa.Integer(), nullable=True),
+    sa.Column('to_stage_id', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.Integer(), nullable=True),
+    sa.Column('moved_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['pipeline_id'], ['pipelines.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_stage_transitions_pipeline_negotiation', 'stage_transitions',
+                    ['pipeline_id', 'negotiation_id', 'moved_at'])
+
+    # Earlier moves were never recorded: seed one creation transition per
+    # negotiation into the stage it sits in today.
+    op.execute("""
+        INSERT INTO stage_transitions (pipeline_id, negotiation_id, from_stage_id, to_stage_id, owner_id, moved_at)
+        SELECT s.pipeline_id, n.id, NULL, n.stage_id, n.owner_id, COALESCE(n.created_at, CURRENT_TIMESTAMP)
+        FROM negotiations n JOIN stages s ON s.id = n.stage_id
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_stage_transitions_pipeline_negotiation', table_name='stage_transitions')
+    op.drop_table('stage_transitions')
@@ -0,0 +1,31 @@
+"""add per-stage deal counters
+
+Revision ID: 9_add_stage_counters
+Revises: 8_add_stage_transitions
+Create Date: 2026-10-18 17:00:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '9_add_stage_counters'
+down_revision = '8_add_stage_transitions'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('stages', sa.Column('deal_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('stages', sa.Column('deal_value_sum', sa.Numeric(14, 2), nullable=False, server_default='0'))
+    op.add_column('stages', sa.Column('open_count', sa.Integer(), nullable=False, server_default='0'))
+    op.execute("""
+        UPDATE stages SET
+            deal_count = (SELECT COUNT(*) FROM negotiations n WHERE n.stage_id = stages.id),
+            deal_value_sum = (SELECT COALESCE(SUM(n.value), 0) FROM negotiations n WHERE n.stage_id = stages.id),
+            open_count = (SELECT COUNT(*) FROM negotiations n WHERE n.stage_id = stages.id AND n.status = 'open')
+    """)
+
+
+def downgrade():
+    op.drop_column('stages', 'open_count')
+    op.drop_column('stages', 'deal_value_sum')
+    op.drop_column('stages', 'deal_count')
@@ -0,0 +1,81 @@
+import json
+
+from app import db
+from app.api_keys import issue_api_key
+from app.models import Account, User
+from .test_routes import app, client, get_token, count_queries  # noqa: F401
+
+
+def super_admin_headers():
+    if db.session.get(Account, 1) is None:
+        db.session.add(Account(id=1, name='Account 1'))
+    admin = User(user_id=99, user_email='admin@example.com', user_name='Admin',
+                 role='super_admin', account_id=1)
+    db.session.add(admin)
+    db.session.flush()
+    issue_api_key(admin.user_id, token='admin-token')
+    db.session.commit()
+    return {'X-API-Key': 'admin-token'}
+
+
+def test_user_sync_diffs_in_batches(client):
+    agent_headers = {'X-API-Key': get_token(client)}
+    headers = super_admin_headers()
+    users = [{'account_id': 1 + i % 2, 'user_id': 100 + i, 'email': f'agent{i}@example.com',
+              'name': f'Agent {i}', 'role': 'agent'} for i in range(50)]
+    with count_queries() as queries:
+        resp = client.post('/admin/users/sync', json=users, headers=headers)
+    assert resp.status_code == 200
+    assert resp.get_json() == {'accounts_created': 1, 'created': 50, 'updated': 0, 'unchanged': 0,
+                               'failed': 0, 'errors': []}
+    assert len(queries) < 10
+    assert User.query.filter(User.user_id >= 100).count() == 50
+    assert db.session.get(Account, 2) is not None
+
+    users[0]['name'] = 'Renamed'
+    body = '\n'.join(json.dumps(u) for u in users) + '\n'
+    body += json.dumps({'account_id': 1, 'user_id': 1, 'email': 'test@example.com',
+                        'name': 'Tester', 'role': 'agent'}) + '\n'
+    body += json.dumps({'account_id': 1, 'user_id': 500, 'email': 'agent1@example.com', 'name': 'Dup'}) + '\n'
+    body += 'not json\n'
+    resp = client.post('/admin/users/sync', data=body, headers=headers, content_type='application/x-ndjson')
+    summary = resp.get_json()
+    assert (summary['created'], summary['updated'], summary['unchanged'], summary['failed']) == (0, 2, 49, 2)
+    assert [e['line'] for e in summary['errors']] == [52, 53]
+    assert db.session.get(User, 100).user_name == 'Renamed'
+    # The demoted supervisor's cached principal is dropped.
+    assert client.get('/pipelines', headers=agent_headers).status_code == 403
+
+
+def test_user_sync_requires_super_admin(client):
+    headers = {'X-API-Key': get_token(client)}
+    assert client.post('/admin/users/sync', json=[], headers=headers).status_code == 403
+
+
+def test_user_listing_pages_filters_and_streams(client):
+    headers = super_admin_headers()
+    users = [{'account_id': 1 + i % 3, 'user_id': 100 + i, 'email': f'agent{i}@example.com',
+              'name': f'Agent {i}', 'role': 'supervisor' if i % 5 == 0 else 'agent'} for i in range(30)]
+    client.post('/admin/users/sync', json=users, headers=headers)
+
+    seen, cursor = [], None
+    while True:
+        args = {'account_id': 2, 'limit': 4, **({'cursor': cursor} if cursor else {})}
+        resp = client.get('/admin/users', query_string=args, headers=headers)
+        assert resp.status_code == 200
+        seen.extend(u['user_id'] for u in resp.get_json())
+        cursor = resp.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert seen == [100 + i for i in range(30) if i % 3 == 1]
+
+    resp = client.get('/admin/users', query_string={'role': 'supervisor', 'account_id': 1}, headers=headers)
+    assert [u['user_id'] for u in resp.get_json()] == [100, 115]
+    assert 'X-Next-Cursor' not in resp.headers
+
+    resp = client.get('/admin/users', query_string={'format': 'ndjson', 'role': 'agent'}, headers=headers)
+    assert resp.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert len(rows) == 24 and all(r['role'] == 'agent' for r in rows)
+    assert client.get('/admin/users', query_string={'limit': 0}, headers=headers).status_code == 400
+    assert client.get('/admin/users', query_string={'cursor': 'x'}, headers=headers).status_code == 400
@@ -0,0 +1,81 @@
+import os
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+from app import db, load_secret_key
+from app.api_keys import hash_token
+from app.models import ApiKey, Pipeline
+from app.pipelines import get_current_user
+from .test_routes import app, client, get_token  # noqa: F401
+
+SIGN_IN = {'account_id': 1, 'user_id': 1, 'user_email': 'test@example.com', 'user_name': 'Tester'}
+
+
+def test_keys_are_stored_hashed_and_reused_by_the_webhook(app, client):
+    app.config['SECRET_KEY'] = 'test-secret'
+    token = client.get('/auth/webhook', query_string=SIGN_IN).get_json()['token']
+    key = ApiKey.query.one()
+    assert key.key_hash == hash_token(token) and key.key_prefix == token[:8]
+    assert key.expires_at > datetime.utcnow() + timedelta(days=29)
+    assert client.get('/auth/webhook', query_string=SIGN_IN).get_json()['token'] == token
+    assert ApiKey.query.count() == 1
+
+    # A key past half of its lifetime is replaced rather than handed out.
+    key.expires_at = datetime.utcnow() + timedelta(days=1)
+    db.session.commit()
+    assert client.get('/auth/webhook', query_string=SIGN_IN).get_json()['token'] != token
+    assert ApiKey.query.count() == 2
+
+
+def test_missing_secret_key_is_generated_once_and_shared(tmp_path):
+    apps = [Flask('app', instance_path=str(tmp_path / 'instance')) for _ in range(2)]
+    for flask_app in apps:
+        load_secret_key(flask_app)
+    secret = apps[0].config['SECRET_KEY']
+    assert len(secret) == 64 and apps[1].config['SECRET_KEY'] == secret
+    assert os.listdir(tmp_path / 'instance') == ['secret_key']
+    assert os.stat(tmp_path / 'instance' / 'secret_key').st_mode & 0o777 == 0o600
+
+    configured = Flask('app', instance_path=str(tmp_path / 'other'))
+    configured.config['SECRET_KEY'] = 'set'
+    load_secret_key(configured)
+    assert configured.config['SECRET_KEY'] == 'set' and not (tmp_path / 'other').exists()
+
+
+def test_expired_keys_are_rejected_and_pruned(app, client):
+    token = get_token(client)
+    headers = {'X-API-Key': token}
+    assert client.get('/pipelines', headers=headers).status_code == 200
+    key = ApiKey.query.one()
+    assert key.last_used_at is not None
+
+    key.expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    app.extensions['api_key_cache'].clear()
+    assert client.get('/pipelines', headers=headers).status_code == 403
+
+    result = app.test_cli_runner().invoke(args=['api-keys', 'prune', '--batch-size', '1'])
+    assert result.exit_code == 0, result.output
+    assert 'Removed 1 expired key(s)' in result.output
+    assert ApiKey.query.count() == 0
+
+
+def test_recording_key_use_leaves_the_view_session_alone(app, client):
+    token = get_token(client)
+    with app.test_request_context(headers={'X-API-Key': token}):
+        db.session.add(Pipeline(name='Draft', account_id=1))
+        db.session.flush()
+        assert get_current_user().user_id == 1
+        db.session.rollback()
+    assert Pipeline.query.filter_by(name='Draft').count() == 0
+    assert ApiKey.query.one().last_used_at is not None
+
+
+def test_created_keys_accept_an_expiry(client):
+    headers = {'X-API-Key': get_token(client)}
+    resp = client.post('/api-keys', json={'expires_in_days': 0}, headers=headers)
+    assert resp.status_code == 201
+    assert resp.get_json()['expires_at'] is None
+    assert client.get('/pipelines', headers={'X-API-Key': resp.get_json()['token']}).status_code == 200
+    assert client.post('/api-keys', json={'expires_in_days': -1}, headers=headers).status_code == 400
@@ -0,0 +1,162 @@
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import ChangeLog, Negotiation, Pipeline
+from .test_routes import app, client, get_token, create_board  # noqa: F401
+
+
+def changes(client, headers, pipeline_id, since=0, **args):
+    return client.get(f'/pipelines/{pipeline_id}/changes', headers=headers,
+                      query_string={'since': since, **args})
+
+
+def test_change_feed_returns_only_new_writes(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    deal_id = client.post(f'/pipelines/{pipeline_id}/negotiations',
+                          json={'title': 'Deal', 'stage_id': stage_ids[1]}, headers=headers).get_json()['id']
+    resp = changes(client, headers, pipeline_id)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert [(c['entity'], c['action']) for c in data['changes']] == [
+        ('pipeline', 'created'), ('stage', 'created'), ('stage', 'created'), ('negotiation', 'created')]
+    assert data['changes'][-1]['entity_id'] == deal_id
+    cursor = data['cursor']
+
+    client.post(f'/negotiations/{deal_id}/move', json={'stage_id': stage_ids[0], 'position': 1},
+                headers=headers)
+    client.put(f'/pipelines/{pipeline_id}/stages/{stage_ids[1]}', json={'name': 'Closed'}, headers=headers)
+    client.post(f'/pipelines/{pipeline_id}/negotiations/import?format=ndjson',
+                data='{"title": "bulk", "stage": "Lead"}\n', headers=headers)
+    data = changes(client, headers, pipeline_id, cursor).get_json()
+    assert [(c['entity'], c['entity_id'], c['action']) for c in data['changes']] == [
+        ('negotiation', deal_id, 'moved'), ('stage', stage_ids[1], 'updated'),
+        ('pipeline', pipeline_id, 'imported')]
+    assert data['changes'][0]['payload'] == {'from_stage_id': stage_ids[1], 'stage_id': stage_ids[0],
+                                             'position': 1}
+    bulk = Negotiation.query.filter_by(title='bulk').one()
+    assert data['changes'][2]['payload'] == {'negotiation_ids': [bulk.id], 'stage_ids': [stage_ids[0]]}
+    assert changes(client, headers, pipeline_id, data['cursor']).get_json()['changes'] == []
+
+    page = changes(client, headers, pipeline_id, limit=2).get_json()
+    assert len(page['changes']) == 2 and page['has_more']
+
+
+def test_import_commits_and_logs_one_change_per_batch(client, monkeypatch):
+    monkeypatch.setattr('app.pipelines.imports.IMPORT_BATCH_SIZE', 2)
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    cursor = changes(client, headers, pipeline_id).get_json()['cursor']
+    version = db.session.get(Pipeline, pipeline_id).version
+    body = ''.join('{"title": "bulk %d", "stage": "%s"}\n' % (i, 'Lead' if i % 2 else 'Won') for i in range(5))
+    resp = client.post(f'/pipelines/{pipeline_id}/negotiations/import?format=ndjson', data=body,
+                       headers=headers)
+    assert resp.get_json()['created'] == 5
+    entries = changes(client, headers, pipeline_id, cursor).get_json()['changes']
+    assert [c['action'] for c in entries] == ['imported'] * 3
+    assert [len(c['payload']['negotiation_ids']) for c in entries] == [2, 2, 1]
+    db.session.expire_all()
+    assert db.session.get(Pipeline, pipeline_id).version == version + 3
+
+
+def test_compaction_makes_stale_cursors_gone(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    latest = changes(client, headers, pipeline_id).get_json()['cursor']
+    ChangeLog.query.update({'created_at': datetime.utcnow() - timedelta(days=30)})
+    db.session.commit()
+    client.put(f'/pipelines/{pipeline_id}', json={'name': 'Renamed'}, headers=headers)
+
+    result = app.test_cli_runner().invoke(args=['changes', 'compact', '--older-than-days', '7'])
+    assert result.exit_code == 0, result.output
+    assert ChangeLog.query.count() == 1
+    assert db.session.get(Pipeline, pipeline_id).changes_floor == latest
+
+    assert changes(client, headers, pipeline_id, 0).status_code == 410
+    data = changes(client, headers, pipeline_id, latest).get_json()
+    assert [c['action'] for c in data['changes']] == ['updated']
+
+
+def test_seqs_are_not_reused_after_compaction(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, _ = create_board(client, headers, deals=2)
+    latest = changes(client, headers, pipeline_id).get_json()['cursor']
+    ChangeLog.query.update({'created_at': datetime.utcnow() - timedelta(days=30)})
+    db.session.commit()
+    app.test_cli_runner().invoke(args=['changes', 'compact', '--older-than-days', '7'])
+    assert ChangeLog.query.count() == 0
+
+    client.put(f'/pipelines/{pipeline_id}', json={'name': 'Renamed'}, headers=headers)
+    data = changes(client, headers, pipeline_id, latest).get_json()
+    assert [c['action'] for c in data['changes']] == ['updated']
+    assert data['cursor'] > latest
+
+
+def test_board_cursor_resumes_the_feed(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=1)
+    board = client.get(f'/pipelines/{pipeline_id}/board', headers=headers).get_json()
+    assert board['cursor'] == changes(client, headers, pipeline_id).get_json()['cursor']
+    client.put(f'/pipelines/{pipeline_id}/stages/{stage_ids[0]}', json={'name': 'New'}, headers=headers)
+    data = changes(client, headers, pipeline_id, board['cursor']).get_json()
+    assert [(c['entity'], c['action']) for c in data['changes']] == [('stage', 'updated')]
+
+    # After compaction a reloaded board still hands out a valid cursor.
+    ChangeLog.query.update({'created_at': datetime.utcnow() - timedelta(days=30)})
+    db.session.commit()
+    app.test_cli_runner().invoke(args=['changes', 'compact', '--older-than-days', '7'])
+    assert changes(client, headers, pipeline_id, board['cursor']).status_code == 410
+    board = client.get('/pipelines/board', headers=headers).get_json()[0]
+    assert board['cursor'] == data['cursor']
+    assert changes(client, headers, pipeline_id, board['cursor']).get_json()['changes'] == []
+
+
+def read_event(frames, attempts=100):
+    """Next ``id:`` frame of an SSE stream, skipping keep-alives."""
+    for _ in range(attempts):
+        frame = next(frames)
+        frame = frame.decode() if isinstance(frame, bytes) else frame
+        if frame.startswith('id:'):
+            return frame
+    raise AssertionError('no event received')
+
+
+def test_event_stream_pushes_committed_changes(app, client):
+    app.config['EVENTS_HEARTBEAT'] = 0.05
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    deal_id = client.post(f'/pipelines/{pipeline_id}/negotiations',
+                          json={'title': 'Deal', 'stage_id': stage_ids[0]}, headers=headers).get_json()['id']
+    bus = app.extensions['event_bus']
+
+    resp = client.get(f'/pipelines/{pipeline_id}/events', headers=headers, buffered=False)
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+    frames = iter(resp.response)
+    assert next(frames).startswith(b'retry:')
+    client.post(f'/negotiations/{deal_id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    bus.poll()
+    frame = read_event(frames)
+    assert 'event: negotiation.moved' in frame
+    assert f'"entity_id": {deal_id}' in frame
+    seq = int(frame.split('\n')[0].split(': ')[1])
+    resp.close()
+    assert bus.connections() == 0
+
+    # A reconnecting client replays what it missed from the change log.
+    resp = client.get(f'/pipelines/{pipeline_id}/events',
+                      headers={**headers, 'Last-Event-ID': str(seq - 1)}, buffered=False)
+    frames = iter(resp.response)
+    next(frames)
+    assert read_event(frames).startswith(f'id: {seq}\n')
+    resp.close()
+
+
+def test_event_stream_rejects_backlog_larger_than_a_page(app, client, monkeypatch):
+    monkeypatch.setattr('app.pipelines.MAX_CHANGES_PAGE_SIZE', 2)
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, _ = create_board(client, headers, deals=2)
+    resp = client.get(f'/pipelines/{pipeline_id}/events',
+                      headers={**headers, 'Last-Event-ID': '0'}, buffered=False)
+    assert resp.status_code == 410
+    assert app.extensions['event_bus'].connections() == 0
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app import db
+from app.models import Negotiation, StageTransition
+from app.pipelines.analytics import funnel_metrics
+from .test_routes import app, client, get_token, create_board  # noqa: F401
+
+
+def test_moves_and_imports_record_transitions(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=1)
+    deal = Negotiation.query.filter_by(stage_id=stage_ids[0]).first()
+    client.post(f'/negotiations/{deal.id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    client.put(f'/negotiations/{deal.id}', json={'title': 'renamed'}, headers=headers)
+    resp = client.post(f'/pipelines/{pipeline_id}/negotiations/import', headers=headers,
+                       data='{"title": "imported", "stage": "Won"}\n',
+                       content_type='application/x-ndjson')
+    assert resp.status_code == 200
+    history = [(t.from_stage_id, t.to_stage_id) for t in
+               StageTransition.query.filter_by(negotiation_id=deal.id).order_by(StageTransition.id)]
+    assert history == [(None, stage_ids[0]), (stage_ids[0], stage_ids[1])]
+    imported = Negotiation.query.filter_by(title='imported').one()
+    assert StageTransition.query.filter_by(negotiation_id=imported.id).one().pipeline_id == pipeline_id
+
+
+def test_funnel_metrics_are_vectorised_per_stage_and_seller():
+    stages = [(10, 'Lead'), (11, 'Demo'), (12, 'Won')]
+    hour = 3600.0
+    # Deal 1 goes Lead -> Demo -> Won, deal 2 Lead -> Demo -> Lead, deal 3
+    # stays in Lead and deal 4 was moved into a stage that no longer exists.
+    rows = [
+        (1, 10, 7, 0), (1, 11, 7, 2 * hour), (1, 12, 7, 5 * hour),
+        (2, 10, 8, 0), (2, 11, 8, 4 * hour), (2, 10, 8, 5 * hour),
+        (3, 10, 7, 0),
+        (4, 99, 0, 0),
+    ]
+    ids, stage_ids, owner_ids, seconds = (np.array(col) for col in zip(*rows))
+    result = funnel_metrics(stages, ids, stage_ids, owner_ids, seconds.astype(float))
+    assert result['deals'] == 3
+    lead, demo, won = result['stages']
+    assert [s['reached'] for s in result['stages']] == [3, 2, 1]
+    assert [s['entered'] for s in result['stages']] == [4, 2, 1]
+    assert (lead['conversion'], demo['conversion'], won['conversion']) == (0.6667, 0.5, None)
+    assert lead['dwell_hours']['p50'] == 3.0
+    assert demo['dwell_hours'] == {'p50': 2.0, 'p90': 2.8}
+    assert won['dwell_hours'] == {'p50': None, 'p90': None}
+    sellers = {s['seller_id']: s for s in result['sellers']}
+    assert (sellers[7]['moves'], sellers[7]['advances'], sellers[7]['median_hours_per_move']) == (2, 2, 2.5)
+    assert (sellers[8]['moves'], sellers[8]['advances']) == (2, 1)
+
+
+def test_funnel_endpoint(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    deal = Negotiation.query.filter_by(stage_id=stage_ids[0]).first()
+    StageTransition.query.filter_by(negotiation_id=deal.id).update(
+        {'moved_at': datetime.utcnow() - timedelta(hours=6)})
+    db.session.commit()
+    client.post(f'/negotiations/{deal.id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    resp = client.get(f'/pipelines/{pipeline_id}/funnel', headers=headers)
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body['deals'] == 4
+    assert [s['reached'] for s in body['stages']] == [4, 3]
+    assert 5.9 < body['stages'][0]['dwell_hours']['p50'] < 6.1
+    assert body['sellers'][0]['seller_id'] == 1
+    assert body['sellers'][0]['moves'] == 1
@@ -0,0 +1,179 @@
+from datetime import datetime
+
+from app import db
+from app.models import KpiRollup, Negotiation, Stage
+from app.pipelines.counters import verify_counters
+from app.pipelines.kpis import parse_kpi_args, raw_kpi_rows, summarize_kpis
+from app.pipelines.rollups import verify_rollups
+from .test_routes import app, client, get_token, create_board, count_queries  # noqa: F401
+
+
+def add_deals(stage_ids):
+    deals = [
+        ('a', stage_ids[0], 1, 10, 'open', datetime(2024, 3, 1, 9, 30)),
+        ('b', stage_ids[0], None, 20, 'open', datetime(2024, 3, 1, 23, 59)),
+        ('c', stage_ids[1], 1, 40, 'won', datetime(2024, 3, 2, 12, 0)),
+        ('d', stage_ids[1], 1, 80, 'lost', datetime(2024, 3, 3, 0, 0)),
+        ('e', stage_ids[0], 1, 160, 'open', datetime(2024, 3, 3, 18, 0)),
+        ('f', stage_ids[0], 1, 320, 'open', None),
+    ]
+    for title, stage_id, owner_id, value, status, created_at in deals:
+        db.session.add(Negotiation(title=title, stage_id=stage_id, owner_id=owner_id, position=1,
+                                   value=value, status=status, created_at=created_at))
+    db.session.commit()
+
+
+def test_rollups_follow_negotiation_writes(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    add_deals(stage_ids)
+    assert verify_rollups() == []
+    deal = Negotiation.query.filter_by(title='a').first()
+    resp = client.post(f'/negotiations/{deal.id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    assert resp.status_code == 200
+    client.put(f'/negotiations/{deal.id}', json={'title': 'renamed'}, headers=headers)
+    deal = Negotiation.query.filter_by(title='e').first()
+    deal.status = 'won'
+    deal.value = 1
+    db.session.commit()
+    db.session.delete(Negotiation.query.filter_by(title='b').first())
+    db.session.commit()
+    assert verify_rollups() == []
+    moved = KpiRollup.query.filter_by(stage_id=stage_ids[1], owner_id=1, status='open').one()
+    assert (moved.deal_count, float(moved.value_sum)) == (1, 10)
+
+
+def test_kpi_ranges_match_raw_aggregation(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    add_deals(stage_ids)
+    ranges = [
+        {},
+        {'start_date': '2024-03-01T12:00:00'},
+        {'end_date': '2024-03-03'},
+        {'start_date': '2024-03-01', 'end_date': '2024-03-03T12:00:00'},
+        {'start_date': '2024-03-01T10:00:00', 'end_date': '2024-03-01T23:59:59'},
+        {'start_date': '2024-03-02', 'end_date': '2024-03-02', 'seller_id': '1'},
+    ]
+    for args in ranges:
+        query = parse_kpi_args(args)
+        filters = []
+        if query.start:
+            filters.append(Negotiation.created_at >= query.start)
+        if query.end:
+            filters.append(Negotiation.created_at <= query.end)
+        expected = summarize_kpis(raw_kpi_rows(pipeline_id, query, filters))
+        resp = client.get(f'/pipelines/{pipeline_id}/kpis', query_string=args, headers=headers)
+        assert resp.get_json() == expected, args
+
+
+def test_rebuild_command_repairs_drift(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    add_deals(stage_ids)
+    KpiRollup.query.filter_by(stage_id=stage_ids[1]).delete()
+    db.session.commit()
+    url = f'/pipelines/{pipeline_id}/kpis'
+    drifted = client.get(url, headers=headers)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['kpis', 'rebuild', '--check-only'])
+    assert result.exit_code == 1
+    result = runner.invoke(args=['kpis', 'rebuild'])
+    assert result.exit_code == 0, result.output
+    assert 'verified' in result.output
+    assert verify_rollups() == []
+    # Cached responses and ETags of the drifted figures are invalidated.
+    fresh = client.get(url, headers={**headers, 'If-None-Match': drifted.headers['ETag']})
+    assert fresh.status_code == 200
+    assert fresh.get_json()['total_value'] > drifted.get_json()['total_value']
+
+
+def test_kpi_series_buckets_and_fills_gaps(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    add_deals(stage_ids)
+
+    def series(**args):
+        resp = client.get(f'/pipelines/{pipeline_id}/kpis/series', query_string=args, headers=headers)
+        assert resp.status_code == 200, resp.get_json()
+        return resp.get_json()['series']
+
+    days = series(bucket='day', start_date='2024-02-29', end_date='2024-03-04')
+    assert [d['start'] for d in days] == ['2024-02-29', '2024-03-01', '2024-03-02', '2024-03-03', '2024-03-04']
+    assert [d['deals'] for d in days] == [0, 2, 1, 2, 0]
+    assert days[2] == {'start': '2024-03-02', 'deals': 1, 'total_value': 40.0, 'open_deals': 0,
+                       'won_deals': 1, 'win_rate': 1.0}
+    assert [d['deals'] for d in series(bucket='day', end_date='2024-03-04')] == [2, 1, 2, 0]
+
+    weeks = series(bucket='week', end_date='2024-03-10')
+    assert [(w['start'], w['deals']) for w in weeks] == [('2024-02-26', 5), ('2024-03-04', 0)]
+    assert weeks[0]['total_value'] == 310.0
+    months = series(bucket='month', seller_id='1', end_date='2024-03-31')
+    assert [(m['start'], m['deals'], m['open_deals']) for m in months] == [('2024-03-01', 4, 2)]
+
+    resp = client.get(f'/pipelines/{pipeline_id}/kpis/series?bucket=year', headers=headers)
+    assert resp.status_code == 400
+    resp = client.get(f'/pipelines/{pipeline_id}/kpis/series', headers=headers,
+                      query_string={'start_date': '2000-01-01', 'end_date': '2024-01-01'})
+    assert resp.status_code == 400
+
+
+def test_account_kpis_group_pipelines_in_constant_queries(client):
+    headers = {'X-API-Key': get_token(client)}
+    first_id, first_stages = create_board(client, headers, deals=0)
+    add_deals(first_stages)
+    args = {'start_date': '2024-03-01T12:00:00', 'end_date': '2024-03-03T12:00:00', 'top': '1'}
+    with count_queries() as small:
+        resp = client.get('/kpis', query_string=args, headers=headers)
+    assert resp.status_code == 200
+    second_id, _ = create_board(client, headers, stages=('A', 'B', 'C'), deals=2)
+    with count_queries() as large:
+        resp = client.get('/kpis', query_string=args, headers=headers)
+    assert len(large) == len(small)
+    data = resp.get_json()
+    assert [p['pipeline_id'] for p in data['pipelines']] == [first_id, second_id]
+    first = data['pipelines'][0]
+    expected = client.get(f'/pipelines/{first_id}/kpis', query_string=args, headers=headers).get_json()
+    assert {k: first[k] for k in expected} == expected
+    assert data['total_value'] == first['total_value'] + data['pipelines'][1]['total_value']
+    assert data['top_sellers'] == [{'seller_id': 1, 'seller_name': 'Tester', 'value': 120.0,
+                                    'deals': 2, 'won_deals': 1}]
+
+    compared = client.get('/kpis', query_string={'pipeline_ids': str(second_id)}, headers=headers).get_json()
+    assert [p['pipeline_id'] for p in compared['pipelines']] == [second_id]
+    assert client.get('/kpis?pipeline_ids=999', headers=headers).status_code == 403
+    assert client.get('/kpis?top=0', headers=headers).status_code == 400
+
+
+def test_stage_counters_follow_writes_and_reconcile(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    deal = Negotiation.query.filter_by(stage_id=stage_ids[0]).first()
+    client.post(f'/negotiations/{deal.id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    deal.value = 25
+    deal.status = 'won'
+    db.session.delete(Negotiation.query.filter_by(stage_id=stage_ids[0]).first())
+    db.session.commit()
+    client.post(f'/pipelines/{pipeline_id}/negotiations/import', headers=headers,
+                data='{"title": "imported", "stage": "Lead", "value": 7}\n', content_type='application/x-ndjson')
+
+    with count_queries() as queries:
+        stages = client.get(f'/pipelines/{pipeline_id}/stages', headers=headers).get_json()
+    assert not any('negotiations' in stmt for stmt in queries.statements)
+    assert [(s['deal_count'], s['deal_value_sum'], s['open_count']) for s in stages] == [(1, 7.0, 1), (3, 45.0, 2)]
+    board = client.get(f'/pipelines/{pipeline_id}/board', headers=headers).get_json()
+    assert [s['deal_count'] for s in board['stages']] == [len(s['negotiations']) for s in board['stages']]
+
+    Stage.query.filter_by(id=stage_ids[1]).update({'deal_count': 0})
+    db.session.commit()
+    stale_etag = client.get(f'/pipelines/{pipeline_id}/stages', headers=headers).headers['ETag']
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['stages', 'reconcile', '--check-only'])
+    assert result.exit_code == 1
+    result = runner.invoke(args=['stages', 'reconcile'])
+    assert result.exit_code == 0, result.output
+    assert verify_counters() == []
+    assert db.session.get(Stage, stage_ids[1]).deal_count == 3
+    resp = client.get(f'/pipelines/{pipeline_id}/stages', headers={**headers, 'If-None-Match': stale_etag})
+    assert resp.status_code == 200
+    assert resp.get_json()[1]['deal_count'] == 3
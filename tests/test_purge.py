@@ -0,0 +1,97 @@
+from app import db
+from app.models import ChangeLog, KpiRollup, Negotiation, Pipeline, Stage, StageTransition, pipeline_users
+from .test_routes import app, client, get_token, create_board, count_queries  # noqa: F401
+
+SOFT = {'Prefer': 'respond-async'}
+
+
+def test_deleted_pipeline_is_hidden_then_purged_in_batches(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=3)
+    kept_id, _ = create_board(client, headers, deals=1)
+    members = db.select(pipeline_users).where(pipeline_users.c.pipeline_id == pipeline_id)
+    assert db.session.execute(members).all()
+
+    with count_queries() as queries:
+        assert client.delete(f'/pipelines/{pipeline_id}', headers={**headers, **SOFT}).status_code == 202
+    assert not any('FROM negotiations' in stmt or 'DELETE' in stmt for stmt in queries.statements)
+    assert client.get(f'/pipelines/{pipeline_id}', headers=headers).status_code == 404
+    assert [p['id'] for p in client.get('/pipelines', headers=headers).get_json()] == [kept_id]
+    assert [p['id'] for p in client.get('/pipelines/board', headers=headers).get_json()] == [kept_id]
+    deal = Negotiation.query.filter_by(stage_id=stage_ids[0]).first()
+    assert client.get(f'/negotiations/{deal.id}', headers=headers).status_code == 404
+
+    with count_queries() as queries:
+        result = app.test_cli_runner().invoke(args=['purge', 'run', '--batch-size', '2'])
+    assert result.exit_code == 0, result.output
+    assert 'Purged 1 pipeline(s), 0 stage(s)' in result.output
+    assert len([s for s in queries.statements if s.startswith('DELETE FROM negotiations')]) == 4
+    assert db.session.get(Pipeline, pipeline_id) is None
+    for model in (Stage, KpiRollup, StageTransition):
+        assert model.query.filter_by(pipeline_id=pipeline_id).count() == 0
+    assert Negotiation.query.filter(Negotiation.stage_id.in_(stage_ids)).count() == 0
+    assert db.session.execute(members).all() == []
+    assert db.session.get(Pipeline, kept_id) is not None
+    # Feed clients still get to see the deletion; compaction removes it later.
+    last = ChangeLog.query.filter_by(pipeline_id=pipeline_id).order_by(ChangeLog.seq.desc()).first()
+    assert (last.entity, last.action) == ('pipeline', 'deleted')
+
+
+def test_deleted_stage_disappears_from_reads(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    resp = client.delete(f'/pipelines/{pipeline_id}/stages/{stage_ids[1]}', headers={**headers, **SOFT})
+    assert resp.status_code == 202
+
+    stages = client.get(f'/pipelines/{pipeline_id}/stages', headers=headers).get_json()
+    assert [s['id'] for s in stages] == [stage_ids[0]]
+    kpis = client.get(f'/pipelines/{pipeline_id}/kpis', headers=headers).get_json()
+    assert kpis['total_value'] == 20
+    deal = Negotiation.query.filter_by(stage_id=stage_ids[0]).first()
+    resp = client.post(f'/negotiations/{deal.id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    assert resp.status_code == 404
+
+    worker = app.extensions['purge_worker']
+    worker.enabled = True
+    worker.wake()
+    worker.stop(timeout=10)
+    assert db.session.get(Stage, stage_ids[1]) is None
+    assert Negotiation.query.count() == 2
+
+
+def test_worker_sweeps_leftovers_on_its_first_request(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, _ = create_board(client, headers, deals=2)
+    client.delete(f'/pipelines/{pipeline_id}', headers={**headers, **SOFT})
+    assert db.session.get(Pipeline, pipeline_id) is not None
+
+    # As after a restart: nothing calls wake, the first request starts the sweep.
+    worker = app.extensions['purge_worker']
+    worker.enabled = True
+    client.get('/pipelines', headers=headers)
+    worker.stop(timeout=10)
+    db.session.expire_all()
+    assert db.session.get(Pipeline, pipeline_id) is None
+
+
+def test_delete_without_prefer_removes_rows_at_once(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    assert client.delete(f'/pipelines/{pipeline_id}/stages/{stage_ids[1]}', headers=headers).status_code == 204
+    assert db.session.get(Stage, stage_ids[1]) is None
+    assert client.delete(f'/pipelines/{pipeline_id}', headers=headers).status_code == 204
+    assert db.session.get(Pipeline, pipeline_id) is None
+    assert Negotiation.query.filter(Negotiation.stage_id.in_(stage_ids)).count() == 0
+
+
+def test_orm_delete_relies_on_database_cascade(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=5)
+    db.session.expunge_all()
+    pipeline = db.session.get(Pipeline, pipeline_id)
+    with count_queries() as queries:
+        db.session.delete(pipeline)
+        db.session.commit()
+    assert not any('FROM negotiations' in stmt for stmt in queries.statements)
+    assert Stage.query.filter_by(pipeline_id=pipeline_id).count() == 0
+    assert Negotiation.query.filter(Negotiation.stage_id.in_(stage_ids)).count() == 0
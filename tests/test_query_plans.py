@@ -0,0 +1,94 @@
+import re
+
+import pytest
+from app import db
+from app.models import Negotiation
+from .test_routes import app, client, get_token, count_queries  # noqa: F401
+
+# Tables that grow with customer data; a full scan of any of them on a
+# request path is a regression.
+HOT_TABLES = {'pipelines', 'pipeline_users', 'stages', 'negotiations', 'api_keys', 'kpi_rollups', 'users',
+              'stage_transitions'}
+FULL_SCAN = re.compile(r'^SCAN (\w+)')
+
+
+def full_scans(statement, parameters):
+    if parameters and isinstance(parameters[0], (tuple, list)):
+        # executemany: one parameter set is enough for the plan.
+        parameters = parameters[0]
+    plan = db.session.connection().exec_driver_sql(
+        'EXPLAIN QUERY PLAN ' + statement, tuple(parameters)).all()
+    scans = []
+    for row in plan:
+        match = FULL_SCAN.match(row[-1])
+        if match and match.group(1) in HOT_TABLES:
+            scans.append(row[-1])
+    return scans
+
+
+@pytest.fixture()
+def seeded(client):
+    token = get_token(client)
+    headers = {'X-API-Key': token}
+    pipeline_id = client.post('/pipelines', json={'name': 'Sales'}, headers=headers).get_json()['id']
+    stage_ids = [
+        client.post(f'/pipelines/{pipeline_id}/stages', json={'name': name}, headers=headers).get_json()['id']
+        for name in ('Lead', 'Won')
+    ]
+    for i in range(5):
+        db.session.add(Negotiation(title=f'Deal {i}', stage_id=stage_ids[0], owner_id=1,
+                                   position=i + 1, value=10))
+    db.session.commit()
+    return headers, pipeline_id, stage_ids
+
+
+def endpoint_calls(pipeline_id, stage_ids, negotiation_id):
+    return [
+        ('get', '/pipelines', None),
+        ('get', f'/pipelines/{pipeline_id}', None),
+        ('get', f'/pipelines/{pipeline_id}/stages', None),
+        ('get', f'/pipelines/{pipeline_id}/negotiations', None),
+        ('get', f'/pipelines/{pipeline_id}/board', None),
+        ('get', '/pipelines/board', None),
+        ('get', f'/pipelines/{pipeline_id}/stages/{stage_ids[0]}/negotiations', None),
+        ('get', f'/negotiations/{negotiation_id}', None),
+        ('post', f'/negotiations/{negotiation_id}/move', {'stage_id': stage_ids[1], 'position': 1}),
+        ('get', f'/pipelines/{pipeline_id}/kpis?start_date=2020-01-01&end_date=2100-01-01&seller_id=1', None),
+        ('get', f'/pipelines/{pipeline_id}/kpis/series?bucket=week&seller_id=1', None),
+        ('get', f'/pipelines/{pipeline_id}/funnel', None),
+        ('get', '/kpis?start_date=2020-01-01T12:00:00&end_date=2100-01-01T12:00:00&top=5', None),
+    ]
+
+
+def test_endpoint_queries_use_indexes(client, seeded):
+    headers, pipeline_id, stage_ids = seeded
+    negotiation_id = Negotiation.query.first().id
+    captured = []
+
+    for method, url, body in endpoint_calls(pipeline_id, stage_ids, negotiation_id):
+        with count_queries() as queries:
+            resp = getattr(client, method)(url, json=body, headers=headers)
+        assert resp.status_code < 400, url
+        captured.extend((url, stmt, params) for stmt, params in queries.executed)
+
+    offenders = []
+    for url, statement, parameters in captured:
+        if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            continue
+        scans = full_scans(statement, parameters)
+        if scans:
+            offenders.append((url, statement, scans))
+    assert not offenders, offenders
+
+
+def test_admin_user_listing_uses_indexes(client):
+    from .test_admin import super_admin_headers
+    headers = super_admin_headers()
+    offenders = []
+    for args in ({'account_id': 1}, {'role': 'agent'}, {'account_id': 1, 'cursor': 'WzFd'}):
+        with count_queries() as queries:
+            assert client.get('/admin/users', query_string=args, headers=headers).status_code == 200
+        for statement, parameters in queries.executed:
+            if 'FROM users' in statement and full_scans(statement, parameters):
+                offenders.append((args, statement))
+    assert not offenders, offenders
@@ -1,11 +1,23 @@
+from datetime import datetime, timedelta
+
 import pytest
+from sqlalchemy import event
 from app import create_app, db
-from app.models import Account, User, ApiKey, Pipeline
+from app.api_keys import hash_token, issue_api_key
+from app.models import Account, User, ApiKey, Pipeline, Negotiation
+from app.cache import RedisCache
+from app.pipelines import invalidate_user_keys
+from app.pipelines.listing import encode_cursor
 
 class TestConfig:
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SECRET_KEY = 'test-secret'
+    # Tests share one in-memory connection; purges and event polls are run
+    # explicitly.
+    PURGE_IN_BACKGROUND = False
+    EVENTS_IN_BACKGROUND = False
 
 @pytest.fixture()
 def app():
@@ -64,3 +76,547 @@ def test_create_and_list_pipelines(client):
 def test_access_without_token_forbidden(client):
     resp = client.get('/pipelines')
     assert resp.status_code == 403
+
+class count_queries:
+    def __init__(self):
+        self.statements = []
+        self.executed = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+        self.executed.append((statement, parameters))
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def __len__(self):
+        return len(self.statements)
+
+def test_cached_api_key_skips_database(app, client):
+    token = get_token(client)
+    headers = {'X-API-Key': token}
+    client.post('/pipelines', json={'name': 'Sales'}, headers=headers)
+    with count_queries() as queries:
+        resp = client.get('/pipelines', headers=headers)
+    assert resp.status_code == 200
+    assert not any('api_keys' in stmt for stmt in queries.statements)
+    assert app.extensions['api_key_cache'].stats()['hits'] >= 1
+
+def test_revoked_api_key_is_invalidated(client):
+    token = get_token(client)
+    headers = {'X-API-Key': token}
+    assert client.get('/pipelines', headers=headers).status_code == 200
+    key_id = ApiKey.query.filter_by(key_hash=hash_token(token)).first().id
+    assert client.delete(f'/api-keys/{key_id}', headers=headers).status_code == 204
+    assert client.get('/pipelines', headers=headers).status_code == 403
+
+def test_role_change_invalidates_cached_principal(client):
+    token = get_token(client)
+    headers = {'X-API-Key': token}
+    assert client.get('/pipelines', headers=headers).status_code == 200
+    admin = User(user_id=99, user_email='admin@example.com', user_name='Admin',
+                 role='super_admin', account_id=1)
+    db.session.add(admin)
+    db.session.flush()
+    issue_api_key(admin.user_id, token='admin-token')
+    db.session.commit()
+    resp = client.put('/admin/users/1/role', json={'role': 'agent'},
+                      headers={'X-API-Key': 'admin-token'})
+    assert resp.status_code == 200
+    assert client.get('/pipelines', headers=headers).status_code == 403
+
+def test_expired_api_key_rejected_on_cache_hit(app, client):
+    token = get_token(client)
+    headers = {'X-API-Key': token}
+    assert client.get('/pipelines', headers=headers).status_code == 200
+    cache = app.extensions['api_key_cache']
+    principal = cache.get(hash_token(token))
+    cache.set(hash_token(token), principal._replace(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+    ApiKey.query.filter_by(key_hash=hash_token(token)).update(
+        {'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+    assert client.get('/pipelines', headers=headers).status_code == 403
+
+def test_revocation_on_another_worker_is_seen_on_cache_hit(app, client):
+    redis = FakeRedis()
+    app.extensions['api_key_revocations'] = RedisCache(ttl=60, client=redis)
+    token = get_token(client)
+    headers = {'X-API-Key': token}
+    assert client.get('/pipelines', headers=headers).status_code == 200
+    # Another worker deletes the key; only the shared marker reaches this one.
+    ApiKey.query.filter_by(key_hash=hash_token(token)).delete()
+    db.session.commit()
+    assert client.get('/pipelines', headers=headers).status_code == 200
+    other = create_app(TestConfig)
+    other.extensions['api_key_revocations'] = RedisCache(ttl=60, client=redis)
+    with other.app_context():
+        invalidate_user_keys(1)
+    assert client.get('/pipelines', headers=headers).status_code == 403
+
+def create_board(client, headers, stages=('Lead', 'Won'), deals=3):
+    pipeline_id = client.post('/pipelines', json={'name': 'Sales'}, headers=headers).get_json()['id']
+    stage_ids = [
+        client.post(f'/pipelines/{pipeline_id}/stages', json={'name': name}, headers=headers).get_json()['id']
+        for name in stages
+    ]
+    for stage_id in stage_ids:
+        for i in range(deals):
+            db.session.add(Negotiation(title=f'Deal {stage_id}-{i}', stage_id=stage_id,
+                                       owner_id=1, position=deals - i, value=10))
+    db.session.commit()
+    return pipeline_id, stage_ids
+
+def test_pipeline_board_snapshot(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers)
+    resp = client.get(f'/pipelines/{pipeline_id}/board', headers=headers)
+    assert resp.status_code == 200
+    board = resp.get_json()
+    assert [s['id'] for s in board['stages']] == stage_ids
+    titles = [n['title'] for n in board['stages'][0]['negotiations']]
+    assert titles == [f'Deal {stage_ids[0]}-{i}' for i in (2, 1, 0)]
+
+def test_account_board_query_count_is_constant(client):
+    headers = {'X-API-Key': get_token(client)}
+    create_board(client, headers, stages=('A',))
+    with count_queries() as small:
+        client.get('/pipelines/board', headers=headers)
+    create_board(client, headers, stages=('A', 'B', 'C', 'D'))
+    with count_queries() as large:
+        resp = client.get('/pipelines/board', headers=headers)
+    assert len(resp.get_json()) == 2
+    assert len(large) == len(small)
+
+def test_pipeline_kpis_from_rollups(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    db.session.add(Negotiation(title='Won deal', stage_id=stage_ids[1], owner_id=1,
+                               position=9, value=30, status='won'))
+    db.session.add(Negotiation(title='Unowned', stage_id=stage_ids[0], position=9, value=5))
+    db.session.commit()
+    with count_queries() as queries:
+        resp = client.get(f'/pipelines/{pipeline_id}/kpis', headers=headers)
+    assert resp.status_code == 200
+    assert len([s for s in queries.statements if 'kpi_rollups' in s]) == 1
+    assert not any('FROM negotiations' in s for s in queries.statements)
+    data = resp.get_json()
+    assert data['total_value'] == 75
+    assert data['open_deals'] == 5
+    assert data['win_rate'] == 1 / 6
+    assert data['deals_per_stage'] == [{'stage': 'Lead', 'count': 3}, {'stage': 'Won', 'count': 3}]
+    assert data['value_per_seller'] == [{'seller_id': 1, 'seller_name': 'Tester', 'value': 70.0}]
+
+def test_pipeline_kpis_rejects_bad_filters(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, _ = create_board(client, headers, deals=0)
+    resp = client.get(f'/pipelines/{pipeline_id}/kpis?start_date=nope', headers=headers)
+    assert resp.status_code == 400
+    resp = client.get(f'/pipelines/{pipeline_id}/kpis?seller_id=abc', headers=headers)
+    assert resp.get_json() == {'error': 'Invalid seller_id'}
+
+def test_list_responses_cached_until_pipeline_changes(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=1)
+    url = f'/pipelines/{pipeline_id}/negotiations'
+    first = client.get(url, headers=headers).get_json()
+    with count_queries() as queries:
+        assert client.get(url, headers=headers).get_json() == first
+    assert not any('FROM negotiations' in s for s in queries.statements)
+
+    deal_id = first[0]['id']
+    client.post(f'/negotiations/{deal_id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    moved = client.get(url, headers=headers).get_json()
+    assert next(n for n in moved if n['id'] == deal_id)['stage_id'] == stage_ids[1]
+    assert Pipeline.query.get(pipeline_id).version > 1
+
+class FakeRedis:
+    """The subset of ``redis.Redis`` used by ``RedisCache``, kept in a dict."""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+        self.expiry[key] = ex
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in list(self.data) if key.startswith(match.rstrip('*'))]
+
+
+def test_redis_backend_serves_and_invalidates_responses(app, client):
+    redis = FakeRedis()
+    app.extensions['response_cache'] = RedisCache(ttl=120, client=redis)
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=1)
+    url = f'/pipelines/{pipeline_id}/negotiations'
+    first = client.get(url, headers=headers)
+    assert [key.split(':')[:3] for key in redis.data] == [['kanban', 'pipeline', str(pipeline_id)]]
+    assert set(redis.expiry.values()) == {120}
+    with count_queries() as queries:
+        cached = client.get(url, headers=headers)
+    assert cached.get_json() == first.get_json()
+    assert cached.headers.get('X-Next-Cursor') == first.headers.get('X-Next-Cursor')
+    assert not any('FROM negotiations' in s for s in queries.statements)
+
+    deal_id = first.get_json()[0]['id']
+    client.post(f'/negotiations/{deal_id}/move', json={'stage_id': stage_ids[1]}, headers=headers)
+    moved = client.get(url, headers=headers).get_json()
+    assert next(n for n in moved if n['id'] == deal_id)['stage_id'] == stage_ids[1]
+    assert len(redis.data) == 2
+    assert app.extensions['response_cache'].stats() == {'backend': 'redis', 'hits': 1, 'misses': 2}
+    app.extensions['response_cache'].clear()
+    assert redis.data == {}
+
+def stage_titles(client, headers, pipeline_id, stage_id):
+    url = f'/pipelines/{pipeline_id}/stages/{stage_id}/negotiations'
+    return [n['title'] for n in client.get(url, headers=headers).get_json()]
+
+def test_move_writes_only_the_moved_row(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=4)
+    target = stage_ids[1]
+    client.post(f'/stages/{target}/negotiations/reorder', headers=headers, json={
+        'negotiation_ids': [n.id for n in Negotiation.query.filter_by(stage_id=target).order_by(Negotiation.id)]})
+    moving = Negotiation.query.filter_by(stage_id=stage_ids[0]).first()
+    with count_queries() as queries:
+        resp = client.post(f'/negotiations/{moving.id}/move', json={'stage_id': target, 'position': 2},
+                           headers=headers)
+    assert resp.status_code == 200
+    updates = [s for s in queries.statements if s.startswith('UPDATE negotiations')]
+    assert len(updates) == 1
+    titles = stage_titles(client, headers, pipeline_id, target)
+    assert titles[1] == moving.title
+    assert len(titles) == 5
+
+def test_move_rebalances_when_gap_is_exhausted(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=3)
+    target = stage_ids[1]
+    before = stage_titles(client, headers, pipeline_id, target)
+    moving = Negotiation.query.filter_by(stage_id=stage_ids[0]).all()
+    # Fixture positions are dense (1, 2, 3): every insert needs a rebalance
+    # or a fresh midpoint, and the visible order must follow the index.
+    for index, deal in zip((1, 3, 2), moving):
+        resp = client.post(f'/negotiations/{deal.id}/move', json={'stage_id': target, 'position': index},
+                           headers=headers)
+        assert resp.status_code == 200
+    titles = stage_titles(client, headers, pipeline_id, target)
+    assert titles == [moving[0].title, moving[2].title, before[0], moving[1].title] + before[1:]
+    positions = [n.position for n in Negotiation.query.filter_by(stage_id=target)]
+    assert len(set(positions)) == len(positions)
+
+def test_move_by_index_treats_null_positions_as_zero(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    target = stage_ids[1]
+    db.session.add(Negotiation(title='Raw', stage_id=target))
+    db.session.commit()
+    assert stage_titles(client, headers, pipeline_id, target)[0] == 'Raw'
+    moving = Negotiation.query.filter_by(stage_id=stage_ids[0]).first()
+    resp = client.post(f'/negotiations/{moving.id}/move', json={'stage_id': target, 'position': 2},
+                       headers=headers)
+    assert resp.status_code == 200
+    titles = stage_titles(client, headers, pipeline_id, target)
+    assert titles[:2] == ['Raw', moving.title] and len(titles) == 4
+
+def test_rebalance_command_restores_gaps(app, client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=3)
+    result = app.test_cli_runner().invoke(args=['positions', 'rebalance'])
+    assert 'Rebalanced 2 stage(s)' in result.output
+    positions = sorted(n.position for n in Negotiation.query.filter_by(stage_id=stage_ids[0]))
+    assert positions == [1024, 2048, 3072]
+
+def test_reorder_negotiations_is_set_based(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=5)
+    ids = [n.id for n in Negotiation.query.filter_by(stage_id=stage_ids[0]).order_by(Negotiation.id.desc())]
+    with count_queries() as queries:
+        resp = client.post(f'/stages/{stage_ids[0]}/negotiations/reorder',
+                           json={'negotiation_ids': ids}, headers=headers)
+    assert resp.status_code == 204
+    assert len([s for s in queries.statements if s.startswith('UPDATE negotiations')]) == 1
+    listed = client.get(f'/pipelines/{pipeline_id}/stages/{stage_ids[0]}/negotiations', headers=headers)
+    assert [n['id'] for n in listed.get_json()] == ids
+
+def test_reorder_stages_and_pipelines(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, stages=('A', 'B', 'C'), deals=0)
+    other_id, _ = create_board(client, headers, stages=(), deals=0)
+    resp = client.post(f'/pipelines/{pipeline_id}/stages/reorder',
+                       json={'stage_ids': stage_ids[::-1]}, headers=headers)
+    assert resp.status_code == 204
+    listed = client.get(f'/pipelines/{pipeline_id}/stages', headers=headers).get_json()
+    assert [s['id'] for s in listed] == stage_ids[::-1]
+    resp = client.post('/pipelines/reorder', json={'pipeline_ids': [other_id, pipeline_id]}, headers=headers)
+    assert resp.status_code == 204
+    assert [p['id'] for p in client.get('/pipelines', headers=headers).get_json()] == [other_id, pipeline_id]
+
+def test_batch_move_reports_per_item_results(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=3)
+    lead = [n.id for n in Negotiation.query.filter_by(stage_id=stage_ids[0]).order_by(Negotiation.id)]
+    foreign = Negotiation(title='Foreign', stage_id=stage_ids[0], owner_id=1, position=99)
+    other_account = Account(id=2, name='Other')
+    other_pipeline = Pipeline(name='Theirs', account=other_account, position=1)
+    db.session.add_all([foreign, other_account, other_pipeline])
+    db.session.flush()
+    from app.models import Stage
+    other_stage = Stage(name='X', pipeline_id=other_pipeline.id, position=1)
+    db.session.add(other_stage)
+    db.session.commit()
+
+    moves = [
+        {'negotiation_id': lead[0], 'stage_id': stage_ids[1]},
+        {'negotiation_id': lead[1], 'stage_id': stage_ids[1], 'position': 1},
+        {'negotiation_id': lead[2], 'stage_id': stage_ids[1]},
+        {'negotiation_id': lead[0], 'stage_id': stage_ids[0]},
+        {'negotiation_id': foreign.id, 'stage_id': other_stage.id},
+        {'negotiation_id': 999999, 'stage_id': stage_ids[1]},
+        {'negotiation_id': lead[0], 'stage_id': stage_ids[1], 'position': 0},
+    ]
+    with count_queries() as queries:
+        resp = client.post('/negotiations/move', json={'moves': moves}, headers=headers)
+    assert resp.status_code == 200
+    statuses = [r['status'] for r in resp.get_json()['results']]
+    assert statuses == [200, 200, 200, 400, 403, 404, 400]
+    assert len([s for s in queries.statements if s.startswith('COMMIT')]) <= 1
+
+    titles = [n['title'] for n in client.get(
+        f'/pipelines/{pipeline_id}/stages/{stage_ids[1]}/negotiations', headers=headers).get_json()]
+    moved = {n.id: n.title for n in Negotiation.query.filter(Negotiation.id.in_(lead))}
+    assert titles[0] == moved[lead[1]]
+    assert titles[-2:] == [moved[lead[0]], moved[lead[2]]]
+
+def test_batch_move_places_by_index_with_constant_statements(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=60)
+    lead = [n['id'] for n in client.get(f'/pipelines/{pipeline_id}/stages/{stage_ids[0]}/negotiations',
+                                        headers=headers, query_string={'limit': 1000}).get_json()]
+    target_url = f'/pipelines/{pipeline_id}/stages/{stage_ids[1]}/negotiations'
+    won = [n['id'] for n in client.get(target_url, headers=headers, query_string={'limit': 1000}).get_json()]
+
+    def move(ids, index):
+        moves = [{'negotiation_id': nid, 'stage_id': stage_ids[1], 'position': index} for nid in ids]
+        with count_queries() as queries:
+            resp = client.post('/negotiations/move', json={'moves': moves}, headers=headers)
+        assert [r['status'] for r in resp.get_json()['results']] == [200] * len(ids)
+        return len(queries)
+
+    # Every move lands at index 2, so each one goes in front of the last.
+    few = move(lead[:5], 2)
+    many = move(lead[5:], 2)
+    assert many == few
+    expected = [won[0], *reversed(lead), *won[1:]]
+    listed = client.get(target_url, headers=headers, query_string={'limit': 1000}).get_json()
+    assert [n['id'] for n in listed] == expected
+
+
+def test_batch_move_and_reorder_reject_non_integer_ids(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=1)
+    deal_id = Negotiation.query.filter_by(stage_id=stage_ids[0]).first().id
+    moves = [{'negotiation_id': deal_id, 'stage_id': stage_ids[1]},
+             {'negotiation_id': [deal_id], 'stage_id': stage_ids[1]},
+             {'negotiation_id': deal_id + 1, 'stage_id': {'id': stage_ids[1]}}]
+    resp = client.post('/negotiations/move', json={'moves': moves}, headers=headers)
+    assert [r['status'] for r in resp.get_json()['results']] == [200, 400, 400]
+    assert client.post('/pipelines/reorder', json={'pipeline_ids': [[pipeline_id]]},
+                       headers=headers).status_code == 400
+    assert client.post(f'/pipelines/{pipeline_id}/stages/reorder', json={'stage_ids': [{}]},
+                       headers=headers).status_code == 400
+    assert client.post(f'/stages/{stage_ids[0]}/negotiations/reorder', json={'negotiation_ids': [[1]]},
+                       headers=headers).status_code == 400
+
+
+def test_create_negotiation(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    resp = client.post(f'/pipelines/{pipeline_id}/negotiations', headers=headers,
+                       json={'title': 'New deal', 'stage_id': stage_ids[0], 'value': 12.5, 'position': 1})
+    assert resp.status_code == 201
+    data = resp.get_json()
+    assert data['owner_id'] == 1 and data['value'] == 12.5 and data['status'] == 'open'
+    listed = client.get(f'/pipelines/{pipeline_id}/stages/{stage_ids[0]}/negotiations', headers=headers)
+    assert listed.get_json()[0]['title'] == 'New deal'
+    resp = client.post(f'/pipelines/{pipeline_id}/negotiations', headers=headers,
+                       json={'title': 'Bad', 'stage_id': 999})
+    assert resp.status_code == 400
+
+def test_import_negotiations_ndjson_and_csv(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    ndjson = '\n'.join([
+        '{"title": "A", "stage": "Lead", "value": 10}',
+        '{"title": "B", "stage_id": %d, "status": "won", "value": "5.5"}' % stage_ids[1],
+        'not json',
+        '{"title": "C", "stage": "Nope"}',
+        '',
+        '{"title": "D", "stage": "Lead", "owner_id": 42}',
+    ])
+    resp = client.post(f'/pipelines/{pipeline_id}/negotiations/import', data=ndjson.encode(),
+                       headers={**headers, 'Content-Type': 'application/x-ndjson'})
+    assert resp.status_code == 200
+    summary = resp.get_json()
+    assert (summary['created'], summary['failed']) == (2, 3)
+    assert [e['line'] for e in summary['errors']] == [3, 4, 6]
+
+    csv_body = 'title,stage,value,created_at\nE,Won,1,2024-01-02T10:00:00\nF,Lead,2,\n,Lead,3,\n'
+    resp = client.post(f'/pipelines/{pipeline_id}/negotiations/import', data=csv_body.encode(),
+                       headers={**headers, 'Content-Type': 'text/csv'})
+    summary = resp.get_json()
+    assert (summary['created'], summary['failed']) == (2, 1)
+    assert summary['errors'] == [{'line': 4, 'error': 'Missing title'}]
+
+    board = client.get(f'/pipelines/{pipeline_id}/board', headers=headers).get_json()
+    assert [[n['title'] for n in s['negotiations']] for s in board['stages']] == [['A', 'F'], ['B', 'E']]
+    from app.pipelines.rollups import verify_rollups
+    assert verify_rollups() == []
+
+def test_export_streams_ndjson_and_csv(client):
+    import csv
+    import io
+    import json
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=3)
+    resp = client.get(f'/pipelines/{pipeline_id}/negotiations/export', headers=headers)
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert len(rows) == 6
+    assert rows[0]['stage'] == 'Lead' and rows[0]['value'] == 10.0
+    assert [r['stage_id'] for r in rows] == sorted(r['stage_id'] for r in rows)
+
+    resp = client.get(f'/pipelines/{pipeline_id}/negotiations/export?format=csv', headers=headers)
+    reader = csv.DictReader(io.StringIO(resp.get_data(as_text=True)))
+    assert [r['title'] for r in reader] == [r['title'] for r in rows]
+    assert client.get(f'/pipelines/{pipeline_id}/negotiations/export?format=xml',
+                      headers=headers).status_code == 400
+
+
+def test_negotiation_lists_paginate_with_keyset_cursor(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=3)
+    url = f'/pipelines/{pipeline_id}/negotiations'
+    seen = []
+    cursor = None
+    while True:
+        query = {'limit': 4, 'fields': 'value,status'}
+        if cursor:
+            query['cursor'] = cursor
+        resp = client.get(url, headers=headers, query_string=query)
+        assert resp.status_code == 200
+        page = resp.get_json()
+        assert all(set(item) == {'id', 'value', 'status'} for item in page)
+        seen.extend(item['id'] for item in page)
+        cursor = resp.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    full = client.get(url, headers=headers).get_json()
+    assert seen == [item['id'] for item in full]
+    assert len(seen) == 6
+    # A cached page still carries its cursor.
+    first = client.get(url, headers=headers, query_string={'limit': 4})
+    assert first.headers['X-Next-Cursor']
+
+    stage_url = f'/pipelines/{pipeline_id}/stages/{stage_ids[0]}/negotiations'
+    page = client.get(stage_url, headers=headers, query_string={'limit': 2}).get_json()
+    assert [set(item) for item in page] == [{'id', 'title'}] * 2
+    assert client.get(url, headers=headers, query_string={'fields': 'secret'}).status_code == 400
+    assert client.get(url, headers=headers, query_string={'cursor': 'nope'}).status_code == 400
+    assert client.get(url, headers=headers, query_string={'limit': 0}).status_code == 400
+
+
+def test_negotiation_list_without_limit_returns_every_row(client, monkeypatch):
+    monkeypatch.setattr('app.pipelines.listing.DEFAULT_PAGE_SIZE', 2)
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, _ = create_board(client, headers)
+    url = f'/pipelines/{pipeline_id}/negotiations'
+    full = client.get(url, headers=headers)
+    assert len(full.get_json()) == 6 and 'X-Next-Cursor' not in full.headers
+    first = client.get(url, headers=headers, query_string={'limit': 2})
+    rest = client.get(url, headers=headers, query_string={'cursor': first.headers['X-Next-Cursor']})
+    assert len(rest.get_json()) == 2 and rest.headers['X-Next-Cursor']
+
+
+def test_keyset_cursor_handles_null_positions(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=0)
+    for i in range(4):
+        db.session.add(Negotiation(title=f'Raw {i}', stage_id=stage_ids[0]))
+    db.session.commit()
+    url = f'/pipelines/{pipeline_id}/negotiations'
+    first = client.get(url, headers=headers, query_string={'limit': 2})
+    rest = client.get(url, headers=headers, query_string={'cursor': first.headers['X-Next-Cursor']})
+    assert rest.status_code == 200
+    titles = [item['title'] for item in first.get_json() + rest.get_json()]
+    assert titles == [f'Raw {i}' for i in range(4)]
+    # Cursors issued before NULL positions were coalesced still work.
+    ids = [item['id'] for item in first.get_json()]
+    old = encode_cursor([stage_ids[0], None, ids[1]])
+    assert len(client.get(url, headers=headers, query_string={'cursor': old}).get_json()) == 2
+
+
+def test_conditional_get_returns_304_until_pipeline_changes(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=2)
+    urls = [f'/pipelines/{pipeline_id}/board', f'/pipelines/{pipeline_id}/negotiations',
+            f'/pipelines/{pipeline_id}/stages', f'/pipelines/{pipeline_id}/kpis', '/pipelines',
+            '/pipelines/board']
+    etags = {}
+    for url in urls:
+        resp = client.get(url, headers=headers)
+        assert resp.status_code == 200
+        etags[url] = resp.headers['ETag']
+        with count_queries() as queries:
+            resp = client.get(url, headers={**headers, 'If-None-Match': etags[url]})
+        assert resp.status_code == 304
+        assert resp.data == b''
+        # Only the access/marker lookup runs.
+        assert len(queries) <= 1
+
+    negotiation_id = client.get(urls[1], headers=headers).get_json()[0]['id']
+    neg_url = f'/negotiations/{negotiation_id}'
+    neg_etag = client.get(neg_url, headers=headers).headers['ETag']
+    assert client.get(neg_url, headers={**headers, 'If-None-Match': neg_etag}).status_code == 304
+
+    client.put(f'/pipelines/{pipeline_id}', json={'name': 'Renamed'}, headers=headers)
+    for url in urls:
+        resp = client.get(url, headers={**headers, 'If-None-Match': etags[url]})
+        assert resp.status_code == 200
+    assert client.get(neg_url, headers={**headers, 'If-None-Match': neg_etag}).status_code == 200
+
+
+def test_access_checks_use_memoized_pipeline_ids(client):
+    headers = {'X-API-Key': get_token(client)}
+    pipeline_id, stage_ids = create_board(client, headers, deals=1)
+    other = client.get('/auth/webhook', query_string={
+        'account_id': 2, 'user_id': 3, 'user_email': 'other@example.com', 'user_name': 'Other'})
+    other_headers = {'X-API-Key': other.get_json()['token']}
+    assert client.get(f'/pipelines/{pipeline_id}/board', headers=other_headers).status_code == 403
+    db.session.get(Pipeline, pipeline_id).users.append(db.session.get(User, 3))
+    db.session.commit()
+    with count_queries() as queries:
+        assert client.get(f'/pipelines/{pipeline_id}/board', headers=other_headers).status_code == 200
+    assert sum('pipeline_users' in s for s in queries.statements) == 1
+
+    negotiation_id = client.get(f'/pipelines/{pipeline_id}/negotiations', headers=headers).get_json()[0]['id']
+    with count_queries() as queries:
+        resp = client.post(f'/negotiations/{negotiation_id}/move', json={'stage_id': stage_ids[0]},
+                           headers=headers)
+    assert resp.status_code == 200
+    selects = [s for s in queries.statements if s.lstrip().upper().startswith('SELECT')]
+    # Negotiation + its pipeline, target stage + its pipeline, next position.
+    assert len(selects) == 3
@@ -0,0 +1,90 @@
+"""Concurrent sign-ins through the auth webhook.
+
+Runs against a SQLite file (shared between threads) and against Postgres:
+``TEST_POSTGRES_URL`` when it points at a scratch database, otherwise a
+throwaway server started with ``testing.postgresql`` (requirements-dev.txt).
+The Postgres case is skipped, with the reason, when neither is available.
+"""
+import os
+import threading
+
+import pytest
+
+from app import create_app, db
+from app.models import Account, ApiKey, User
+
+
+@pytest.fixture(scope='module')
+def postgres_url():
+    if os.getenv('TEST_POSTGRES_URL'):
+        yield os.environ['TEST_POSTGRES_URL']
+        return
+    try:
+        import testing.postgresql
+    except ImportError:
+        pytest.skip('set TEST_POSTGRES_URL or install testing.postgresql from requirements-dev.txt')
+    try:
+        server = testing.postgresql.Postgresql()
+    except RuntimeError as exc:
+        pytest.skip(f'cannot start a Postgres stand-in: {exc}')
+    yield server.url()
+    server.stop()
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def concurrent_app(request, tmp_path):
+    url = (f'sqlite:///{tmp_path / "webhook.db"}' if request.param == 'sqlite'
+           else request.getfixturevalue('postgres_url'))
+
+    class Config:
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = url
+        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}} if request.param == 'sqlite' else {}
+        SECRET_KEY = 'test-secret'
+
+    app = create_app(Config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.drop_all()
+        db.engine.dispose()
+
+
+def test_concurrent_sign_ins_provision_each_user_once(concurrent_app):
+    threads_count, accounts, users = 32, 3, 8
+    barrier = threading.Barrier(threads_count)
+    statuses = []
+
+    def sign_in(n):
+        client = concurrent_app.test_client()
+        user_id = n % users + 1
+        barrier.wait()
+        for _ in range(3):
+            resp = client.get('/auth/webhook', query_string={
+                'account_id': user_id % accounts + 1, 'user_id': user_id,
+                'user_email': f'agent{user_id}@example.com', 'user_name': f'Agent {user_id}'})
+            statuses.append(resp.status_code)
+
+    threads = [threading.Thread(target=sign_in, args=(n,)) for n in range(threads_count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert statuses == [200] * threads_count * 3
+    with concurrent_app.app_context():
+        assert Account.query.count() == accounts
+        assert User.query.count() == users
+        assert ApiKey.query.count() >= users
+
+
+def test_conflicting_sign_in_is_rejected(concurrent_app):
+    client = concurrent_app.test_client()
+    args = {'account_id': 1, 'user_id': 1, 'user_email': 'a@example.com', 'user_name': 'A'}
+    assert client.get('/auth/webhook', query_string=args).status_code == 200
+    assert client.get('/auth/webhook', query_string={**args, 'user_name': 'B'}).status_code == 400
+    # The same email under another user id is a conflict, not a server error.
+    assert client.get('/auth/webhook', query_string={**args, 'user_id': 2}).status_code == 400